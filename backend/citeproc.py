@@ -5,19 +5,36 @@
 # The strategy in the first case will be to check wether we have the DOI in our system and if the last update is not to long ago, we just skip.
 # This has the reason, that a users might wait if they refresh their profile.
 
+import ijson
 import logging
 import re
 import requests
 
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
 from datetime import date
 from datetime import datetime
 from datetime import timedelta
+from functools import partial
 
 from django.conf import settings
+from django.db import connections
 from django.utils import timezone
 
 from backend.doiprefixes import free_doi_prefixes
+from backend.instrumentation import FETCH
+from backend.instrumentation import IngestMetrics
+from backend.instrumentation import PAPER_SAVE
+from backend.instrumentation import PARSE
+from backend.instrumentation import TRANSLATE
+from backend.instrumentation import ingest_stage
+from backend.lookups import LookupCache
+from backend.lookups import find_journal
+from backend.lookups import find_publisher
+from backend.lookups import get_oaisource
 from backend.pubtype_translations import CITEPROC_PUBTYPE_TRANSLATION
+from backend.utils import get_redis_client
+from backend.utils import prefetch
 from backend.utils import request_retry
 from backend.utils import utf8_truncate
 from papers.baremodels import BareName
@@ -26,6 +43,7 @@ from papers.baremodels import BarePaper
 from papers.doi import doi_to_crossref_identifier
 from papers.doi import doi_to_url
 from papers.doi import to_doi
+from papers.models import HarvestedDay
 from papers.models import OaiSource
 from papers.models import OaiRecord
 from papers.models import Paper
@@ -37,8 +55,6 @@ from papers.utils import tolerant_datestamp_to_datetime
 from papers.utils import validate_orcid
 from papers.utils import valid_publication_date
 from publishers.models import AliasPublisher
-from publishers.models import Journal
-from publishers.models import Publisher
 
 
 logger = logging.getLogger('dissemin.' + __name__)
@@ -106,15 +122,17 @@ class Citeproc():
         """
         if not isinstance(data, dict):
             raise CiteprocError('Invalid metadaformat, expecting dict')
-        bare_paper_data = cls._get_paper_data(data)
-        bare_oairecord_data = cls._get_oairecord_data(data)
+        with ingest_stage(TRANSLATE):
+            bare_paper_data = cls._get_paper_data(data)
+            bare_oairecord_data = cls._get_oairecord_data(data)
 
-        bare_paper = BarePaper.create(**bare_paper_data)
-        bare_oairecord = BareOaiRecord(paper=bare_paper, **bare_oairecord_data)
-        bare_paper.add_oairecord(bare_oairecord)
-        bare_paper.update_availability()
+            bare_paper = BarePaper.create(**bare_paper_data)
+            bare_oairecord = BareOaiRecord(paper=bare_paper, **bare_oairecord_data)
+            bare_paper.add_oairecord(bare_oairecord)
+            bare_paper.update_availability()
 
-        paper = Paper.from_bare(bare_paper)
+        with ingest_stage(PAPER_SAVE):
+            paper = Paper.from_bare(bare_paper)
         paper.update_index()
         return paper
 
@@ -238,39 +256,59 @@ class Citeproc():
         :returns: Returns a dict, ready to passed to a BarePaper instance
         :raises: CiteprocError
         """
+        return cls._lookup_oairecord_data(cls._parse_oairecord_data(data))
+
+
+    @classmethod
+    def _lookup_oairecord_data(cls, bare_oairecord_data):
+        """
+        The part of :meth:`_get_oairecord_data` which looks up the journal,
+        publisher and source in the database.
+
+        :param bare_oairecord_data: a dict returned by :meth:`_parse_oairecord_data`,
+            which is completed
+        :returns: the dict
+        """
+        journal = find_journal(issn=bare_oairecord_data['issn'], title=bare_oairecord_data['journal_title'])
+        bare_oairecord_data['journal'] = journal
+        bare_oairecord_data['publisher'] = cls._get_publisher(bare_oairecord_data['publisher_name'], journal)
+        bare_oairecord_data['source'] = get_oaisource('crossref')
+
+        return bare_oairecord_data
+
+
+    @classmethod
+    def _parse_oairecord_data(cls, data):
+        """
+        The part of :meth:`_get_oairecord_data` which does not look
+        anything up in the database: the journal, publisher and source
+        are missing.
+
+        :param data: citeproc metadata
+        :returns: a dict of the fields of the record read from the metadata
+        :raises: CiteprocError
+        """
         doi = cls._get_doi(data)
         splash_url = doi_to_url(doi)
         licenses = data.get('licenses', [])
         pdf_url = cls._get_pdf_url(doi, licenses, splash_url)
 
-        journal_title = cls._get_container(data)
-        issn = cls._get_issn(data)
-        journal = Journal.find(issn=issn, title=journal_title)
-
-        publisher_name = data.get('publisher', '')[:512]
-        publisher = cls._get_publisher(publisher_name, journal)
-
-        bare_oairecord_data = {
+        return {
             'doi' : doi,
             'description' : cls._get_abstract(data),
             'identifier' : doi_to_crossref_identifier(doi),
-            'issn' : issn,
+            'issn' : cls._get_issn(data),
             'issue' : data.get('issue', ''),
-            'journal' : journal,
-            'journal_title' : journal_title,
+            'journal_title' : cls._get_container(data),
             'pages' : data.get('page', ''),
             'pdf_url' : pdf_url,
             'pubdate' : cls._get_pubdate(data),
-            'publisher' : publisher,
-            'publisher_name' : publisher_name,
+            'publisher_name' : data.get('publisher', '')[:512],
             'pubtype' : cls._get_pubtype(data),
-            'source' : OaiSource.objects.get(identifier='crossref'),
             'splash_url' : splash_url,
             'volume' : data.get('volume', ''),
         }
 
-        return bare_oairecord_data
-
 
     @staticmethod
     def _get_orcid(author_elem):
@@ -354,7 +392,7 @@ class Citeproc():
             publisher = journal.publisher
             AliasPublisher.increment(name, publisher)
         else:
-            publisher = Publisher.find(name)
+            publisher = find_publisher(name)
         return publisher
 
 
@@ -457,8 +495,20 @@ class CrossRef(Citeproc):
     """
 
     batch_length = 30
+    #: Number of batches of :meth:`fetch_batch` fetched at the same time
+    batch_workers = 4
+    #: Number of days fetched at the same time by :meth:`fetch_latest_records`,
+    #: which must stay within the rate limits of the polite pool of CrossRef
+    concurrent_days = 3
+    #: Number of pages of a day fetched ahead of the page being saved
+    prefetch_pages = 1
     emit_status_every = 10
     rows = 500
+    #: Fields of the works read by :meth:`to_paper`, the only ones we request
+    selected_fields = [
+        'abstract', 'author', 'container-title', 'created', 'deposited', 'DOI', 'ISSN',
+        'issue', 'issued', 'page', 'publisher', 'title', 'type', 'volume',
+    ]
 
     @classmethod
     def _fetch_day(cls, day):
@@ -473,34 +523,21 @@ class CrossRef(Citeproc):
                 'filter' : ','.join('{}:{}'.format(key, value) for key, value in filters.items()),
                 'rows' : cls.rows,
                 'mailto' : settings.CROSSREF_MAILTO,
+                'select' : ','.join(cls.selected_fields),
         }
         url = 'https://api.crossref.org/works'
         headers = {
             'User-Agent':  settings.CROSSREF_USER_AGENT,
         }
 
-        s = requests.Session()
-        cursor = '*'
         total_results = 0
         loop_runs = 0
         new_papers = 0
-        while cursor:
-            params['cursor'] = cursor
-            r = request_retry(
-                url,
-                params=params,
-                headers=headers,
-                timeout=30,
-                session=s,
-            )
-            if cursor == '*':
-                total_results = jpath('message/total-results', r.json(), 0)
+        # The next page is fetched while the current one is saved
+        for total_results, items in prefetch(cls._fetch_pages(url, params, headers), cls.prefetch_pages):
+            if loop_runs == 0:
                 logger.info('Fetch for day: {}, number results: {}'.format(day.isoformat(), total_results))
-            cursor = jpath('message/next-cursor', r.json())
-            items = jpath('message/items', r.json(), [])
-            if len(items) == 0:
-                cursor = False
-            else:
+            with LookupCache().activate():
                 for item in items:
                     try:
                         cls.to_paper(item)
@@ -519,6 +556,74 @@ class CrossRef(Citeproc):
 
         logger.info('For day {} have {} paper been added or updated out of {}.'.format(day.isoformat(), new_papers, total_results))
 
+    @classmethod
+    def _fetch_pages(cls, url, params, headers):
+        """
+        Fetches the pages of results of a query with a deep paging cursor.
+        Only the total number of results and the cursor are decoded here,
+        the items are decoded one by one while they are iterated over.
+        The body of each page is downloaded as a whole, since the cursor of
+        the next page must be known before the page is saved.
+
+        :returns: generator of (total number of results, iterator of the items)
+            pairs, up to the first empty page (excluded)
+        """
+        s = requests.Session()
+        params = dict(params, cursor='*')
+        while params['cursor']:
+            with ingest_stage(FETCH):
+                r = request_retry(
+                    url,
+                    params=params,
+                    headers=headers,
+                    timeout=30,
+                    session=s,
+                )
+            with ingest_stage(PARSE):
+                total_results, next_cursor, has_items = cls._read_page_header(r.content)
+            if not has_items:
+                return
+            yield total_results, cls._read_page_items(r.content)
+            params['cursor'] = next_cursor
+
+    @staticmethod
+    def _read_page_header(content):
+        """
+        Reads the total number of results and the next cursor of a page of
+        results, without decoding its items
+
+        :param content: the JSON body of the page
+        :returns: (total number of results, next cursor, whether the page has items)
+        """
+        total_results, next_cursor, has_items = 0, None, False
+        found = set()
+        for prefix, event, value in ijson.parse(content):
+            if prefix == 'message.total-results' and event == 'number':
+                total_results = value
+                found.add(prefix)
+            elif prefix == 'message.next-cursor' and event == 'string':
+                next_cursor = value
+                found.add(prefix)
+            elif prefix == 'message.items.item' and event == 'start_map':
+                has_items = True
+                found.add(prefix)
+            if len(found) == 3:
+                break
+        return total_results, next_cursor, has_items
+
+    @staticmethod
+    def _read_page_items(content):
+        """
+        Decodes the items of a page of results one by one
+        """
+        items = ijson.items(content, 'message.items.item', use_float=True)
+        while True:
+            with ingest_stage(PARSE):
+                item = next(items, None)
+            if item is None:
+                return
+            yield item
+
 
     @staticmethod
     def _get_container(data):
@@ -546,22 +651,71 @@ class CrossRef(Citeproc):
     @classmethod
     def fetch_latest_records(cls):
         """
-        Fetches the latest records from CrossRef API
+        Fetches the latest records from CrossRef API, up to
+        `concurrent_days` days at a time.
+
+        Days can finish in any order, so finished days are recorded
+        as :class:`HarvestedDay` and the last update of the source only
+        advances over the days finished without interruption: a day that
+        fails is fetched again on the next run, together with the days
+        after it that are not recorded.
         """
         source = OaiSource.objects.get(identifier='crossref')
-        update_date = source.last_update + timedelta(days=1)
         today = date.today()
-        while update_date.date() < today:
-            try:
-                cls._fetch_day(update_date.date())
-            except requests.exceptions.RequestException as e:
-                logger.exception(e)
-                break
-            else:
-                source.last_update = update_date
-                source.save()
-                logger.info("Updated up to {}".format(update_date))
-                update_date += timedelta(days=1)
+        harvested = set(HarvestedDay.objects.filter(source=source).values_list('day', flat=True))
+        days = []
+        day = source.last_update.date() + timedelta(days=1)
+        while day < today:
+            if day not in harvested:
+                days.append(day)
+            day += timedelta(days=1)
+
+        with ThreadPoolExecutor(max_workers=cls.concurrent_days) as executor:
+            futures = {executor.submit(cls._fetch_day_in_thread, day): day for day in days}
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+                day = futures[future]
+                try:
+                    future.result()
+                except requests.exceptions.RequestException as e:
+                    logger.exception(e)
+                    for f in futures:
+                        f.cancel()
+                    continue
+                HarvestedDay.objects.get_or_create(source=source, day=day)
+                cls._advance_last_update(source)
+
+    @classmethod
+    def _fetch_day_in_thread(cls, day):
+        """
+        Fetches the records of a day in a thread of
+        :meth:`fetch_latest_records`
+        """
+        try:
+            with IngestMetrics('crossref').activate():
+                cls._fetch_day(day)
+        finally:
+            # Each thread has its own database connection
+            connections.close_all()
+
+    @staticmethod
+    def _advance_last_update(source):
+        """
+        Advances the last update of the source over the contiguous
+        harvested days following it, and forgets these days.
+        """
+        harvested = set(HarvestedDay.objects.filter(source=source).values_list('day', flat=True))
+        update_date = source.last_update + timedelta(days=1)
+        advanced = False
+        while update_date.date() in harvested:
+            source.last_update = update_date
+            update_date += timedelta(days=1)
+            advanced = True
+        if advanced:
+            source.save()
+            HarvestedDay.objects.filter(source=source, day__lte=source.last_update.date()).delete()
+            logger.info("Updated up to {}".format(source.last_update))
 
     @staticmethod
     def _filter_dois_by_comma(dois):
@@ -589,46 +743,59 @@ class CrossRef(Citeproc):
         # We filter DOIs with comma, we do not batch them, but return them as `None`
         dois_to_fetch = cls._filter_dois_by_comma(dois)
 
-        headers = {
-            'User-Agent' : settings.CROSSREF_USER_AGENT
-        }
-        url = 'https://api.crossref.org/works'
+        batches = [dois_to_fetch[i:i+cls.batch_length] for i in range(0, len(dois_to_fetch), cls.batch_length)]
         s = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=cls.batch_workers)
+        s.mount('https://', adapter)
 
-        while len(dois_to_fetch):
-            dois_batch = dois_to_fetch[:cls.batch_length]
-            dois_to_fetch = dois_to_fetch[cls.batch_length:]
-            params = {
-                'filter' : ','.join(['doi:{}'.format(doi) for doi in dois_batch]),
-                'mailto' : settings.CROSSREF_MAILTO,
-                'rows' : cls.batch_length,
-            }
-            try:
-                r = request_retry(
-                    url,
-                    params=params,
-                    headers=headers,
-                    session=s,
-                    retries=0, # There is probably a user waiting
-                )
-            except requests.exceptions.RequestException as e:
-                # We skip the DOIs since we could not reach
-                logger.info(e)
-                continue
-            items = jpath('message/items', r.json(), [])
-            for item in items:
-                try:
-                    p = cls.to_paper(item)
-                except CiteprocError:
-                    logger.debug(item)
-                else:
-                    papers[p.get_doi()] = p
+        # The batches are fetched concurrently, and saved in the current thread as they arrive
+        with ThreadPoolExecutor(max_workers=cls.batch_workers) as executor, LookupCache().activate():
+            for items in executor.map(partial(cls._fetch_batch_items, session=s), batches):
+                for item in items:
+                    try:
+                        p = cls.to_paper(item)
+                    except CiteprocError:
+                        logger.debug(item)
+                    else:
+                        papers[p.get_doi()] = p
 
         p = [papers.get(doi.lower(), None) for doi in dois]
 
         return p
 
 
+    @classmethod
+    def _fetch_batch_items(cls, dois, session):
+        """
+        Fetches the items of a batch of DOIs, in a thread of :meth:`fetch_batch`
+        :param dois: list of at most `batch_length` DOIs
+        :returns: list of citeproc items, empty if CrossRef could not be reached
+        """
+        headers = {
+            'User-Agent' : settings.CROSSREF_USER_AGENT
+        }
+        url = 'https://api.crossref.org/works'
+        params = {
+            'filter' : ','.join(['doi:{}'.format(doi) for doi in dois]),
+            'mailto' : settings.CROSSREF_MAILTO,
+            'rows' : cls.batch_length,
+            'select' : ','.join(cls.selected_fields),
+        }
+        try:
+            r = request_retry(
+                url,
+                params=params,
+                headers=headers,
+                session=session,
+                retries=0, # There is probably a user waiting
+            )
+        except requests.exceptions.RequestException as e:
+            # We skip the DOIs since we could not reach
+            logger.info(e)
+            return []
+        return jpath('message/items', r.json(), [])
+
+
     @staticmethod
     def remove_unapproved_characters(doi):
         """
@@ -651,6 +818,8 @@ class DOIResolver(Citeproc):
         'Accept' : 'application/citeproc+json',
     }
     timeout = 0.500 # half a second as timeout, the might user waiting
+    #: Prefix of the Redis keys of the DOIs which could not be resolved
+    negative_cache_prefix = 'doi-resolution-failed:'
 
 
     @staticmethod
@@ -658,16 +827,56 @@ class DOIResolver(Citeproc):
         """
         Checks if doi is already in the database and wheter it is up to date
         :param doi: DOI to check
-        :returns: True/False
+        :returns: the OaiRecord with this DOI, or None
+        """
+        return DOIResolver._up_to_date_records([doi]).get(doi.lower())
+
+
+    @staticmethod
+    def _up_to_date_records(dois):
+        """
+        Same as :meth:`_is_up_to_date` for many DOIs, with a single query
+        :param dois: list of DOIs to check
+        :returns: dict of the up to date OaiRecords, with the lowered DOIs as keys
         """
+        records = OaiRecord.objects.select_related('about').filter(
+            doi__in=[doi.lower() for doi in dois],
+            source__identifier='crossref',
+            last_update__gte=timezone.now() - settings.DOI_OUTDATED_DURATION
+        )
+        return {record.doi : record for record in records}
+
+
+    @classmethod
+    def _failed_dois(cls, dois):
+        """
+        :param dois: list of DOIs
+        :returns: the set of the lowered DOIs which could not be resolved recently
+        """
+        redis_client = get_redis_client()
+        if redis_client is None or not dois:
+            return set()
+        dois = [doi.lower() for doi in dois]
         try:
-            return OaiRecord.objects.select_related('about').get(
-                doi=doi,
-                source__identifier='crossref',
-                last_update__gte=timezone.now() - settings.DOI_OUTDATED_DURATION
-            )
-        except OaiRecord.DoesNotExist:
-            return None
+            failed = redis_client.mget([cls.negative_cache_prefix + doi for doi in dois])
+        except Exception:
+            logger.warning('Could not read the DOIs which failed resolution', exc_info=True)
+            return set()
+        return {doi for doi, value in zip(dois, failed) if value is not None}
+
+
+    @classmethod
+    def _remember_failure(cls, doi):
+        """
+        Stores that a DOI could not be resolved, for DOI_NEGATIVE_CACHE_DURATION
+        """
+        redis_client = get_redis_client()
+        if redis_client is None or not settings.DOI_NEGATIVE_CACHE_DURATION:
+            return
+        try:
+            redis_client.setex(cls.negative_cache_prefix + doi.lower(), settings.DOI_NEGATIVE_CACHE_DURATION, 1)
+        except Exception:
+            logger.warning('Could not store that DOI {} failed resolution'.format(doi), exc_info=True)
 
 
     @classmethod
@@ -676,12 +885,54 @@ class DOIResolver(Citeproc):
         Fetches a single DOI and updates if necessary
         :param doi: A (valid) DOI
         :returns: Paper object
-        :raises: CiteprocError or RequestException
+        :raises: CiteprocError, RequestException, or ValueError if the paper is invalid
         """
+        if cls._failed_dois([doi]):
+            raise CiteprocDOIError('DOI {} could not be resolved recently'.format(doi))
+
         record = cls._is_up_to_date(doi)
         if record is not None:
             return record.about
 
+        return cls._resolve_doi(doi)
+
+
+    @classmethod
+    def save_dois(cls, dois):
+        """
+        Same as :meth:`save_doi` for many DOIs, checking with one query which
+        ones are up to date and skipping the ones which could not be resolved
+        recently
+        :param dois: list of (valid) DOIs
+        :returns: list of Paper objects (or None if the DOI could not be saved), aligned with the DOIs
+        """
+        failed = cls._failed_dois(dois)
+        records = cls._up_to_date_records(dois)
+
+        papers = []
+        for doi in dois:
+            paper = None
+            if doi.lower() in records:
+                paper = records[doi.lower()].about
+            elif doi.lower() not in failed:
+                try:
+                    paper = cls._resolve_doi(doi)
+                except (CiteprocError, ValueError) as e:
+                    logger.info(e)
+                except requests.exceptions.RequestException as e:
+                    logger.info(e)
+            papers.append(paper)
+        return papers
+
+
+    @classmethod
+    def _resolve_doi(cls, doi):
+        """
+        Fetches the metadata of a DOI with content negotiation and saves it.
+        DOIs which are not found or whose metadata cannot be used are remembered as failed.
+        :returns: Paper object
+        :raises: CiteprocError, RequestException, or ValueError if the paper is invalid
+        """
         url = '{}{}'.format(settings.DOI_RESOLVER_ENDPOINT, doi)
         r = requests.get(
             url=url,
@@ -689,8 +940,17 @@ class DOIResolver(Citeproc):
             timeout=cls.timeout,
         )
 
-        r.raise_for_status()
+        try:
+            r.raise_for_status()
+        except requests.exceptions.HTTPError:
+            if r.status_code == 404:
+                cls._remember_failure(doi)
+            raise
 
-        p = cls.to_paper(r.json())
+        try:
+            p = cls.to_paper(r.json())
+        except (CiteprocError, ValueError):
+            cls._remember_failure(doi)
+            raise
 
         return p
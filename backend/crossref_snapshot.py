@@ -0,0 +1,206 @@
+# -*- encoding: utf-8 -*-
+
+# Dissemin: open access policy enforcement tool
+# Copyright (C) 2014 Antonin Delpeuch
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+
+"""
+Bulk loading of the public metadata snapshot of CrossRef.
+
+The snapshot is a directory of gzipped JSON files (once its tarball is
+extracted), each holding a list of works under ``items``, in the same
+format as the items served by ``api.crossref.org/works``. The files are
+parsed incrementally, so only the current batch of items is in memory.
+
+The items are parsed by worker processes, and saved in batches by the
+current process. The search index is not updated, it should be rebuilt
+once the snapshot is loaded.
+"""
+
+import gzip
+import ijson
+import json
+import logging
+import os
+import re
+
+from itertools import islice
+
+from django.db import connections
+from django.db import transaction
+
+from backend.citeproc import CiteprocError
+from backend.citeproc import CrossRef
+from backend.instrumentation import IngestMetrics
+from backend.instrumentation import PAPER_SAVE
+from backend.instrumentation import PARSE
+from backend.instrumentation import TRANSLATE
+from backend.instrumentation import ingest_stage
+from backend.lookups import LookupCache
+from backend.utils import parallel_map
+from backend.utils import write_json_atomically
+from papers.baremodels import BareOaiRecord
+from papers.baremodels import BarePaper
+from papers.models import Paper
+
+logger = logging.getLogger('dissemin.' + __name__)
+
+
+def snapshot_files(path):
+    """
+    The names of the files of a snapshot, in numerical order
+    """
+    names = [name for name in os.listdir(path) if name.endswith('.json.gz')]
+    return sorted(names, key=lambda name: [int(part) if part.isdigit() else part
+                                           for part in re.split(r'(\d+)', name)])
+
+
+class CrossRefSnapshot(object):
+    """
+    Loads a CrossRef snapshot into the database
+    """
+
+    #: Number of items parsed and saved together
+    batch_size = 500
+    #: Number of batches parsed ahead of the saving
+    lookahead = 10
+
+    def __init__(self, workers=None):
+        """
+        :param workers: the number of processes parsing the items,
+            if None they are parsed by the current process
+        """
+        self.workers = workers
+        self.metrics = IngestMetrics('crossref')
+
+    def read_snapshot(self, path, start_file=None, start_offset=0):
+        """
+        Enumerates the items of the snapshot in batches, optionally
+        starting from a given offset in a given file.
+
+        :returns: generator of (file name, offset, items) triples, where
+            the offset is the position of the first item in the file
+        """
+        names = snapshot_files(path)
+        if start_file is not None:
+            if start_file not in names:
+                raise ValueError('{} is not a file of the snapshot'.format(start_file))
+            names = names[names.index(start_file):]
+        for name in names:
+            offset = start_offset if name == start_file else 0
+            with gzip.open(os.path.join(path, name), 'rb') as f:
+                items = ijson.items(f, 'items.item', use_float=True)
+                for _ in islice(items, offset):
+                    pass
+                while True:
+                    with ingest_stage(PARSE):
+                        batch = list(islice(items, self.batch_size))
+                    if not batch:
+                        break
+                    yield name, offset, batch
+                    offset += len(batch)
+
+    def parse_batch(self, batch):
+        """
+        Parses a batch of items, as returned by :meth:`read_snapshot`,
+        without looking anything up in the database.
+
+        :returns: a (file name, offset of the next batch, parsed items)
+            triple. The parsed items are (paper data, record data) pairs,
+            the items which could not be parsed are left out.
+        """
+        name, offset, items = batch
+        parsed = []
+        with ingest_stage(TRANSLATE, len(items)):
+            for item in items:
+                try:
+                    parsed.append((CrossRef._get_paper_data(item), CrossRef._parse_oairecord_data(item)))
+                except (CiteprocError, ValueError) as e:
+                    logger.debug(e)
+        if self.workers:
+            # worker processes are terminated without leaving the
+            # context of the metrics, so we push them batch by batch
+            self.metrics.push()
+        return name, offset + len(items), parsed
+
+    def save_batch(self, parsed):
+        """
+        Saves parsed items, as returned by :meth:`parse_batch`.
+
+        The papers which do not collide with existing ones are inserted
+        in bulk, the others are saved one by one so that they get merged.
+        """
+        bare_papers = []
+        for bare_paper_data, bare_oairecord_data in parsed:
+            try:
+                CrossRef._lookup_oairecord_data(bare_oairecord_data)
+                bare_paper = BarePaper.create(**bare_paper_data)
+                bare_paper.add_oairecord(BareOaiRecord(paper=bare_paper, **bare_oairecord_data))
+            except ValueError as e:
+                logger.debug(e)
+            else:
+                bare_papers.append(bare_paper)
+
+        try:
+            with ingest_stage(PAPER_SAVE, len(bare_papers)), transaction.atomic():
+                colliding = Paper.bulk_from_bare(bare_papers)
+        except ValueError:
+            logger.warning("Bulk insert failed, saving the batch paper by paper", exc_info=True)
+            colliding = bare_papers
+
+        for bare_paper in colliding:
+            try:
+                with ingest_stage(PAPER_SAVE), transaction.atomic():
+                    Paper.from_bare(bare_paper)
+            except ValueError:
+                logger.exception("Ignoring invalid paper {}".format(bare_paper.title))
+
+    def load_snapshot(self, path, checkpoint=None):
+        """
+        Loads the snapshot stored in a directory.
+
+        :param checkpoint: the path of a JSON file where the position of
+            the next item to load is saved after each batch. If it exists,
+            the loading resumes from that position.
+        """
+        start_file, start_offset = None, 0
+        if checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint, 'r') as f:
+                position = json.load(f)
+            start_file, start_offset = position['file'], position['offset']
+            logger.info('Resuming from item {} of {}'.format(start_offset, start_file))
+
+        with self.metrics.activate(), LookupCache().activate():
+            batches = self.read_snapshot(path, start_file, start_offset)
+            if self.workers:
+                # The workers are forked and must not share our connection to the database
+                connections.close_all()
+                parsed_batches = parallel_map(self.parse_batch, batches, self.workers, self.lookahead)
+            else:
+                parsed_batches = map(self.parse_batch, batches)
+
+            for name, next_offset, parsed in parsed_batches:
+                self.save_batch(parsed)
+                if checkpoint:
+                    self.save_checkpoint(checkpoint, name, next_offset)
+
+    @staticmethod
+    def save_checkpoint(checkpoint, name, offset):
+        """
+        Saves the position of the next item to load
+        """
+        write_json_atomically(checkpoint, {'file': name, 'offset': offset})
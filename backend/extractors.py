@@ -55,6 +55,41 @@ class URLExtractor(object):
         return urls
 
 
+group_reference_re = re.compile(r'\\(\d+)|\\g<(\d+)>')
+
+
+def parse_skeleton(skeleton, offset=0):
+    """
+    Parses a substitution skeleton once and for all, as re does on each
+    substitution.
+
+    :param offset: a number to add to the group numbers, for skeletons
+        applied to a regex embedded in a bigger one
+    :returns: a pair of the list of the parts of the skeleton, literal
+        strings and group numbers (None if the skeleton contains other
+        escapes than group references), and the skeleton itself
+    """
+    parts = []
+    pos = 0
+    for match in group_reference_re.finditer(skeleton):
+        parts.append(skeleton[pos:match.start()])
+        parts.append(offset + int(match.group(1) or match.group(2)))
+        pos = match.end()
+    parts.append(skeleton[pos:])
+    if any('\\' in part for part in parts if isinstance(part, str)):
+        return None, skeleton
+    return [part for part in parts if part != ''], skeleton
+
+
+def expand_skeleton(match, parts):
+    """
+    Same as match.expand(skeleton), for skeleton parts returned
+    by :func:`parse_skeleton`.
+    """
+    return ''.join([part if isinstance(part, str) else (match.group(part) or '')
+                    for part in parts])
+
+
 class RegexExtractor(URLExtractor):
 
     def __init__(self, mappings):
@@ -63,16 +98,97 @@ class RegexExtractor(URLExtractor):
         """
         super(RegexExtractor, self).__init__()
         self.mappings = mappings
+        self.combined, self.compiled = self._compile(mappings)
+
+    @staticmethod
+    def _compile(mappings):
+        """
+        Combines the distinct regexes of each field in one alternation,
+        with a named group per regex. Matching a value against it tells
+        in a single pass whether any regex of the field matches, and which
+        one is the first to: the regexes before it do not match, and the
+        match can be reused for the substitution of that regex.
+
+        :returns: a pair of a dict mapping each field to its combined
+            regex (None if its regexes cannot be combined) and the list of
+            the mappings in reverse order, as (field, regex, resource_type,
+            skeleton, index of the regex in the field, skeleton for the
+            combined regex) tuples, where skeletons are parsed with
+            :func:`parse_skeleton`
+        """
+        regexes = {}
+        indices = []
+        for field, regex, _, _ in mappings:
+            field_regexes = regexes.setdefault(field, [])
+            key = (regex.pattern, regex.flags)
+            if key not in field_regexes:
+                field_regexes.append(key)
+            indices.append(field_regexes.index(key))
+
+        combined = {}
+        for field, field_regexes in regexes.items():
+            try:
+                if len(set(flags for _, flags in field_regexes)) > 1:
+                    raise re.error('Incompatible flags')
+                combined[field] = re.compile(
+                    '|'.join('(?P<r%d>%s)' % (i, pattern) for i, (pattern, _) in enumerate(field_regexes)),
+                    field_regexes[0][1])
+            except re.error:
+                combined[field] = None
+
+        compiled = []
+        for (field, regex, resource_type, skeleton), idx in zip(mappings, indices):
+            combined_skeleton = None
+            if combined[field] is not None:
+                combined_skeleton = parse_skeleton(skeleton, combined[field].groupindex['r%d' % idx])
+            compiled.append((field, regex, resource_type, parse_skeleton(skeleton), idx, combined_skeleton))
+        compiled.reverse()
+        return combined, compiled
+
+    def _matching_values(self, field):
+        """
+        The stripped values of the field matching at least one regex,
+        in reverse order, with the index of the first regex they match
+        and the match of the combined regex.
+        """
+        combined = self.combined[field]
+        values = []
+        for val in reversed(self.metadata[field]):
+            val = val.strip()
+            if combined is None:
+                values.append((val, 0, None))
+            else:
+                match = combined.match(val)
+                if match is not None:
+                    values.append((val, int(match.lastgroup[1:]), match))
+        return values
 
     def _urls(self):
 
+        # Each resource type gets the URL of the last mapping matching
+        # one of its values (the last of them), so we go through the
+        # mappings backwards and stop at the first match
         urls = dict()
-        for (field, regex, resource_type, skeleton) in self.mappings:
-            for val in self.metadata[field]:
-                val = val.strip()
-                match = regex.match(val)
+        values = dict()
+        for field, regex, resource_type, skeleton, idx, combined_skeleton in self.compiled:
+            if resource_type in urls:
+                continue
+            if field not in values:
+                values[field] = self._matching_values(field)
+            for val, first, combined_match in values[field]:
+                if idx < first:
+                    continue
+                if idx == first and combined_match is not None:
+                    match, template = combined_match, combined_skeleton
+                else:
+                    match, template = regex.match(val), skeleton
                 if match:
-                    urls[resource_type] = regex.sub(skeleton, val)
+                    if match.end() < len(val) or template[0] is None:
+                        # sub() also replaces the next matches
+                        urls[resource_type] = regex.sub(skeleton[1], val)
+                    else:
+                        urls[resource_type] = expand_skeleton(match, template[0])
+                    break
         return urls
 
 
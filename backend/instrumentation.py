@@ -0,0 +1,221 @@
+# -*- encoding: utf-8 -*-
+
+# Dissemin: open access policy enforcement tool
+# Copyright (C) 2014 Antonin Delpeuch
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+
+"""
+Instrumentation of the ingest pipelines (OAI-PMH, CrossRef, oaDOI).
+
+A pipeline creates an :class:`IngestMetrics` for the source it ingests
+and activates it while it runs. The code it runs, down to the models,
+wraps its stages in :func:`ingest_stage`, which adds the wall time and
+the number of items processed to the active metrics (and does nothing
+when no metrics are active).
+
+The metrics are periodically added to counters stored in Redis, one hash
+per source, and can be exported in the Prometheus text format with
+:func:`prometheus_text` (see the ``ingest_metrics`` management command).
+
+Stages can be nested (saving a paper includes looking up its
+fingerprint), so their times should not be summed.
+"""
+
+import logging
+import threading
+
+from contextlib import contextmanager
+from time import perf_counter
+
+logger = logging.getLogger('dissemin.' + __name__)
+
+FETCH = 'fetch'
+PARSE = 'parse'
+TRANSLATE = 'translate'
+FINGERPRINT_LOOKUP = 'fingerprint_lookup'
+PAPER_SAVE = 'paper_save'
+OAIRECORD_DEDUP = 'oairecord_dedup'
+INDEX_UPDATE = 'index_update'
+
+REDIS_KEY_PREFIX = 'ingest-metrics:'
+
+_active = threading.local()
+
+
+class IngestMetrics(object):
+    """
+    Wall time and number of items per stage of the ingest of a source.
+    """
+
+    #: Number of seconds after which the metrics are pushed to Redis
+    push_every = 10
+
+    def __init__(self, source):
+        """
+        :param source: the name of the source the metrics are about,
+            for instance the identifier of an :class:`OaiSource`
+        """
+        self.source = source
+        self.seconds = {}
+        self.counts = {}
+        self.last_push = perf_counter()
+
+    def record(self, stage, seconds, count=1):
+        """
+        Adds the time spent and the number of items processed in a stage.
+        """
+        self.seconds[stage] = self.seconds.get(stage, 0.) + seconds
+        self.counts[stage] = self.counts.get(stage, 0) + count
+        if perf_counter() - self.last_push > self.push_every:
+            self.push()
+
+    @contextmanager
+    def stage(self, stage, count=1):
+        """
+        Records the wall time spent in the block as the given stage.
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, perf_counter() - start, count)
+
+    @contextmanager
+    def activate(self):
+        """
+        Makes these metrics the ones :func:`ingest_stage` records to,
+        in the current thread, and pushes them when the block is left.
+        """
+        previous = getattr(_active, 'metrics', None)
+        _active.metrics = self
+        try:
+            yield self
+        finally:
+            _active.metrics = previous
+            self.push()
+
+    def as_dict(self):
+        """
+        The metrics recorded since the last push, as a dict mapping
+        each stage to its number of seconds and items.
+        """
+        return {
+            stage: {'seconds': self.seconds[stage], 'count': self.counts[stage]}
+            for stage in self.seconds
+        }
+
+    def push(self):
+        """
+        Adds the metrics to the counters of the source in Redis,
+        and resets them. Failures are only logged, as metrics should
+        never interrupt an ingest.
+        """
+        # imported here, as backend.utils depends on this module
+        from backend.utils import get_redis_client
+
+        self.last_push = perf_counter()
+        redis_client = get_redis_client()
+        if not self.seconds or redis_client is None:
+            return
+        try:
+            pipe = redis_client.pipeline()
+            key = REDIS_KEY_PREFIX + self.source
+            for stage in self.seconds:
+                pipe.hincrbyfloat(key, stage + ':seconds', self.seconds[stage])
+                pipe.hincrby(key, stage + ':count', self.counts[stage])
+            pipe.execute()
+        except Exception:
+            logger.warning('Could not push the ingest metrics of %s', self.source, exc_info=True)
+            return
+        self.seconds = {}
+        self.counts = {}
+
+
+def active_metrics():
+    """
+    The metrics activated in the current thread, or None.
+    """
+    return getattr(_active, 'metrics', None)
+
+
+@contextmanager
+def ingest_stage(stage, count=1):
+    """
+    Records the wall time spent in the block as the given stage,
+    in the active metrics if any.
+    """
+    metrics = active_metrics()
+    if metrics is None:
+        yield
+    else:
+        with metrics.stage(stage, count):
+            yield
+
+
+def read_counters():
+    """
+    Reads the counters of all sources from Redis.
+
+    :returns: a dict mapping each source to a dict mapping each stage
+        to its total number of seconds and items, empty without Redis
+    """
+    from backend.utils import get_redis_client
+
+    redis_client = get_redis_client()
+    counters = {}
+    if redis_client is None:
+        return counters
+    for key in redis_client.scan_iter(REDIS_KEY_PREFIX + '*'):
+        source = key.decode('utf-8')[len(REDIS_KEY_PREFIX):]
+        stages = counters.setdefault(source, {})
+        for field, value in redis_client.hgetall(key).items():
+            stage, kind = field.decode('utf-8').rsplit(':', 1)
+            stages.setdefault(stage, {})[kind] = float(value) if kind == 'seconds' else int(value)
+    return counters
+
+
+def prometheus_text(counters=None):
+    """
+    Renders counters (by default, the ones stored in Redis) in the
+    Prometheus text exposition format.
+    """
+    if counters is None:
+        counters = read_counters()
+    lines = []
+    for metric, kind, help_text in [
+            ('dissemin_ingest_stage_seconds_total', 'seconds', 'Wall time spent in each ingest stage'),
+            ('dissemin_ingest_stage_items_total', 'count', 'Items processed by each ingest stage')]:
+        lines.append('# HELP {} {}'.format(metric, help_text))
+        lines.append('# TYPE {} counter'.format(metric))
+        for source in sorted(counters):
+            for stage in sorted(counters[source]):
+                value = counters[source][stage].get(kind, 0)
+                lines.append('{}{{source="{}",stage="{}"}} {}'.format(metric, source, stage, value))
+    return '\n'.join(lines) + '\n'
+
+
+def reset_counters():
+    """
+    Deletes the counters of all sources from Redis.
+    """
+    from backend.utils import get_redis_client
+
+    redis_client = get_redis_client()
+    if redis_client is None:
+        return
+    for key in redis_client.scan_iter(REDIS_KEY_PREFIX + '*'):
+        redis_client.delete(key)
@@ -0,0 +1,163 @@
+# -*- encoding: utf-8 -*-
+
+# Dissemin: open access policy enforcement tool
+# Copyright (C) 2014 Antonin Delpeuch
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+
+"""
+Caches of the lookups done for each record of a batch (a page of
+CrossRef results, a batch of DOIs, a chunk of an oaDOI dump): OAI
+sources by identifier, journals by ISSN and by title, and publishers
+by name.
+
+A batch activates a :class:`LookupCache` while it runs, and the
+translation looks things up with :func:`get_oaisource`,
+:func:`find_journal` and :func:`find_publisher`, which use the active
+cache (and query the database directly when no cache is active).
+
+Missing journals and publishers are cached as well, so the caches of
+the current thread are invalidated when a journal or a publisher is
+created.
+"""
+
+import threading
+
+from contextlib import contextmanager
+
+from django.db.models.signals import post_save
+
+from papers.models import OaiSource
+from publishers.models import Journal
+from publishers.models import Publisher
+
+_active = threading.local()
+
+
+class LookupCache(object):
+    """
+    Results of the lookups done while a batch is processed.
+    """
+
+    #: Number of entries of a cache after which it is emptied, which
+    #: bounds the memory used by caches activated for long batches
+    max_entries = 10000
+
+    def __init__(self):
+        self.oaisources = {}
+        self.journals_by_issn = {}
+        self.journals_by_title = {}
+        self.publishers = {}
+
+    def _lookup(self, cache, key, func):
+        try:
+            return cache[key]
+        except KeyError:
+            if len(cache) >= self.max_entries:
+                cache.clear()
+            value = cache[key] = func()
+            return value
+
+    def oaisource(self, identifier):
+        """
+        :returns: the :class:`OaiSource` with this identifier
+        :raises: OaiSource.DoesNotExist
+        """
+        return self._lookup(self.oaisources, identifier,
+                            lambda: OaiSource.objects.get(identifier=identifier))
+
+    def journal(self, issn=None, title=None):
+        """
+        Same as :meth:`Journal.find`
+        """
+        journal = None
+        if issn:
+            journal = self._lookup(self.journals_by_issn, issn,
+                                   lambda: Journal.find(issn=issn))
+        if journal is None and title:
+            journal = self._lookup(self.journals_by_title, title.lower(),
+                                   lambda: Journal.find(title=title))
+        return journal
+
+    def publisher(self, name):
+        """
+        Same as :meth:`Publisher.find`
+        """
+        return self._lookup(self.publishers, name, lambda: Publisher.find(name))
+
+    def invalidate_journals(self):
+        self.journals_by_issn = {}
+        self.journals_by_title = {}
+
+    def invalidate_publishers(self):
+        self.publishers = {}
+
+    @contextmanager
+    def activate(self):
+        """
+        Makes this cache the one used by the lookups of the current
+        thread, in the block.
+        """
+        previous = getattr(_active, 'cache', None)
+        _active.cache = self
+        try:
+            yield self
+        finally:
+            _active.cache = previous
+
+
+def active_lookup_cache():
+    """
+    The lookup cache activated in the current thread, or None.
+    """
+    return getattr(_active, 'cache', None)
+
+
+def get_oaisource(identifier):
+    cache = active_lookup_cache()
+    if cache is None:
+        return OaiSource.objects.get(identifier=identifier)
+    return cache.oaisource(identifier)
+
+
+def find_journal(issn=None, title=None):
+    cache = active_lookup_cache()
+    if cache is None:
+        return Journal.find(issn=issn, title=title)
+    return cache.journal(issn=issn, title=title)
+
+
+def find_publisher(name):
+    cache = active_lookup_cache()
+    if cache is None:
+        return Publisher.find(name)
+    return cache.publisher(name)
+
+
+def invalidate_journals(sender, instance, created, **kwargs):
+    cache = active_lookup_cache()
+    if created and cache is not None:
+        cache.invalidate_journals()
+
+
+def invalidate_publishers(sender, instance, created, **kwargs):
+    cache = active_lookup_cache()
+    if created and cache is not None:
+        cache.invalidate_publishers()
+
+
+post_save.connect(invalidate_journals, sender=Journal)
+post_save.connect(invalidate_publishers, sender=Publisher)
@@ -0,0 +1,173 @@
+import bz2
+import cProfile
+import glob
+import gzip
+import io
+import json
+import os
+import pstats
+import sys
+
+from collections import Counter
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from oaipmh.metadata import MetadataRegistry
+
+from backend.citeproc import CiteprocError
+from backend.citeproc import CrossRef
+from backend.oaireader import base_dc_streaming_reader
+from backend.oaireader import oai_dc_streaming_reader
+from backend.oaireader import read_records_page
+from backend.translators import BASEDCTranslator
+from backend.translators import OAIDCTranslator
+from papers.baremodels import BarePaper
+from papers.models import OaiSource
+
+
+def open_dump(path):
+    """
+    Opens a JSON-lines file, possibly compressed with gzip or bzip2
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rt', encoding='utf-8')
+    return io.open(path, 'r', encoding='utf-8')
+
+
+class Command(BaseCommand):
+    help = ('Translate the records of a captured OAI-PMH harvest (see backend.oaicapture) '
+            'or of a CrossRef JSON-lines dump to bare papers, without saving them, and report '
+            'the translation throughput, the rejection rate per reason and the hotspots.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Capture directory of an OAI-PMH harvest, or CrossRef JSON-lines file (.gz and .bz2 are supported).')
+        parser.add_argument('--format', choices=['oai_dc', 'base_dc', 'citeproc'], default='base_dc',
+                            help='Metadata format of the records.')
+        parser.add_argument('--source', default='base',
+                            help='Identifier of the OAI source the records come from, which decides how URLs are extracted.')
+        parser.add_argument('--limit', type=int, default=None, help='Stop after this number of records.')
+        parser.add_argument('--hotspots', type=int, default=20,
+                            help='Number of functions to report from a profile of the translation (0 to disable profiling, which slows it down).')
+
+    def handle(self, *args, **options):
+        self.reasons = Counter()
+        self.nb_records = 0
+        self.parse_time = 0.
+        self.translate_time = 0.
+        self.limit = options['limit']
+
+        profile = cProfile.Profile() if options['hotspots'] else None
+        if options['format'] == 'citeproc':
+            if not os.path.isfile(options['path']):
+                raise CommandError('{} is not a file'.format(options['path']))
+            self.run(self.citeproc_records(options['path']), self.translate_citeproc, profile)
+        else:
+            if not os.path.isdir(options['path']):
+                raise CommandError('{} is not a directory'.format(options['path']))
+            # An unsaved source: nothing is looked up in the database
+            oaisource = OaiSource(identifier=options['source'], name=options['source'],
+                                  default_pubtype='preprint')
+            if options['format'] == 'oai_dc':
+                self.translator = OAIDCTranslator(oaisource)
+            else:
+                self.translator = BASEDCTranslator(oaisource)
+            self.run(self.oai_records(options['path'], options['format']), self.translate_oai, profile)
+
+        self.report(profile, options['hotspots'])
+
+    def run(self, records, translate, profile):
+        """
+        Translates the records, timing the parsing and the translation separately
+        """
+        start = perf_counter()
+        for record in records:
+            self.parse_time += perf_counter() - start
+            start = perf_counter()
+            if profile is not None:
+                profile.enable()
+            reason = translate(record)
+            if profile is not None:
+                profile.disable()
+            self.translate_time += perf_counter() - start
+            self.reasons[reason or 'translated'] += 1
+            self.nb_records += 1
+            if self.limit and self.nb_records >= self.limit:
+                break
+            start = perf_counter()
+
+    def oai_records(self, capture_dir, format):
+        registry = MetadataRegistry()
+        registry.registerReader('oai_dc', oai_dc_streaming_reader)
+        registry.registerReader('base_dc', base_dc_streaming_reader)
+        for path in sorted(glob.glob(os.path.join(capture_dir, '*.xml.gz'))):
+            with gzip.open(path, 'rb') as f:
+                records, _ = read_records_page(f.read(), format, registry)
+            for record in records:
+                yield record
+
+    def translate_oai(self, record):
+        """
+        :returns: the reason why the record was rejected, or None
+        """
+        header, metadata, _ = record
+        if metadata is None:
+            return 'deleted'
+        metadata = metadata.getMap()
+        try:
+            paper = self.translator.translate(header, metadata)
+        except Exception as e:
+            return 'exception: {}'.format(e.__class__.__name__)
+        if paper is not None:
+            return
+        # Rejections are not explained by the translator, we find out why
+        if not metadata.get('title'):
+            return 'no title'
+        if not self.translator.get_oai_authors(metadata):
+            return 'no authors'
+        if not self.translator.find_earliest_oai_date(metadata):
+            return 'no pubdate'
+        return 'invalid'
+
+    def citeproc_records(self, path):
+        with open_dump(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+    def translate_citeproc(self, item):
+        """
+        Same as :meth:`Citeproc.to_paper`, without the lookups of journals,
+        publishers and source in the database.
+
+        :returns: the reason why the record was rejected, or None
+        """
+        try:
+            bare_paper_data = CrossRef._get_paper_data(item)
+            CrossRef._parse_oairecord_data(item)
+            BarePaper.create(**bare_paper_data)
+        except CiteprocError as e:
+            return e.__class__.__name__
+        except ValueError:
+            return 'invalid'
+
+    def report(self, profile, hotspots):
+        total_time = self.parse_time + self.translate_time
+        print('Records: {}'.format(self.nb_records))
+        if not self.nb_records:
+            return
+        print('Parsing: {:.2f}s, translation: {:.2f}s{}'.format(
+            self.parse_time, self.translate_time,
+            ' (profiled)' if profile is not None else ''))
+        print('Throughput: {:.0f} records/s, {:.0f} records/s for the translation only'.format(
+            self.nb_records / total_time if total_time else 0,
+            self.nb_records / self.translate_time if self.translate_time else 0))
+        print('Outcomes:')
+        for reason, count in self.reasons.most_common():
+            print('    {:<40} {:>8} {:>6.1%}'.format(reason, count, count / self.nb_records))
+        if profile is not None:
+            print('Hotspots of the translation:')
+            pstats.Stats(profile, stream=sys.stdout).sort_stats('tottime').print_stats(hotspots)
@@ -0,0 +1,24 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from backend.instrumentation import prometheus_text
+from backend.instrumentation import read_counters
+from backend.instrumentation import reset_counters
+
+
+class Command(BaseCommand):
+    help = 'Print the time spent and the items processed by each stage of the ingest pipelines, per source, in the Prometheus text format.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--json', action='store_true', help='Print the counters as JSON instead.')
+        parser.add_argument('--reset', action='store_true', help='Reset the counters after printing them.')
+
+    def handle(self, *args, **options):
+        counters = read_counters()
+        if options['json']:
+            print(json.dumps(counters, indent=2, sort_keys=True))
+        else:
+            print(prometheus_text(counters), end='')
+        if options['reset']:
+            reset_counters()
@@ -0,0 +1,27 @@
+import os
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from backend.crossref_snapshot import CrossRefSnapshot
+
+
+class Command(BaseCommand):
+    help = ('Load the public metadata snapshot of CrossRef (a directory of gzipped JSON files). '
+            'The search index is not updated and should be rebuilt afterwards.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Directory of the extracted snapshot.')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Number of processes parsing the items.')
+        parser.add_argument('--checkpoint', default=None,
+                            help='JSON file where the position in the snapshot is saved, to resume from it.')
+        parser.add_argument('--batch-size', type=int, default=CrossRefSnapshot.batch_size,
+                            help='Number of items saved together.')
+
+    def handle(self, *args, **options):
+        if not os.path.isdir(options['path']):
+            raise CommandError('{} is not a directory'.format(options['path']))
+        snapshot = CrossRefSnapshot(workers=options['workers'])
+        snapshot.batch_size = options['batch_size']
+        snapshot.load_snapshot(options['path'], checkpoint=options['checkpoint'])
@@ -0,0 +1,39 @@
+import os
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from backend.oadoi import OadoiAPI
+
+
+class Command(BaseCommand):
+    help = 'Load an Unpaywall (oaDOI) dump, a gzipped JSON-lines file, adding the OA locations it lists to the papers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='The gzipped dump.')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Number of processes loading chunks of the dump in parallel.')
+        parser.add_argument('--checkpoint', default=None,
+                            help='JSON file where the position in the dump is saved, to resume from it.')
+        parser.add_argument('--start-doi', default=None, help='Skip the records before this DOI.')
+        parser.add_argument('--update-index', action='store_true', help='Update the search index of the papers.')
+        parser.add_argument('--all', action='store_true',
+                            help='Also load the DOIs whose OA locations did not change since the last dump loaded.')
+        parser.add_argument('--no-missing-dois', action='store_true',
+                            help='Do not create the papers of the DOIs which are not in the database.')
+
+    def handle(self, *args, **options):
+        if not os.path.isfile(options['path']):
+            raise CommandError('{} is not a file'.format(options['path']))
+        oadoi = OadoiAPI()
+        oadoi.skip_unchanged = not options['all']
+        kwargs = {
+            'start_doi': options['start_doi'],
+            'update_index': options['update_index'],
+            'create_missing_dois': not options['no_missing_dois'],
+            'checkpoint': options['checkpoint'],
+        }
+        if options['workers']:
+            oadoi.load_dump_parallel(options['path'], options['workers'], **kwargs)
+        else:
+            oadoi.load_dump(options['path'], **kwargs)
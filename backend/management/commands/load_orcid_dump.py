@@ -0,0 +1,27 @@
+import os
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from backend.orcid_dump import OrcidDump
+
+
+class Command(BaseCommand):
+    help = 'Import the ORCID public data file, a tarball of profiles in the JSON format of the API v2.1, without extracting it.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='The tarball of the data file.')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Number of processes importing batches of profiles in parallel.')
+        parser.add_argument('--checkpoint', default=None,
+                            help='JSON file where the last member imported is saved, to resume after it.')
+        parser.add_argument('--no-papers', action='store_true',
+                            help='Only create the researchers, without fetching their papers.')
+        parser.add_argument('--use-doi', action='store_true', help='Fetch the papers with a DOI from CrossRef.')
+
+    def handle(self, *args, **options):
+        if not os.path.isfile(options['path']):
+            raise CommandError('{} is not a file'.format(options['path']))
+        dump = OrcidDump(workers=options['workers'], fetch_papers=not options['no_papers'],
+                         use_doi=options['use_doi'])
+        dump.load_dump(options['path'], checkpoint=options['checkpoint'])
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from papers.doifilter import rebuild_doi_filter
+from papers.doifilter import shared_doi_filter
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the shared Bloom filter of the DOIs known to Dissemin.'
+
+    def handle(self, *args, **options):
+        doi_filter = shared_doi_filter()
+        if doi_filter is None:
+            raise CommandError('The DOI filter is disabled (no Redis or no DOI_FILTER_CAPACITY)')
+        rebuild_doi_filter(doi_filter)
+        self.stdout.write('Filter of {} bits and {} hashes rebuilt'.format(doi_filter.size, doi_filter.hashes))
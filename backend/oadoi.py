@@ -2,19 +2,35 @@
 
 
 import gzip
+import hashlib
 import json
 import logging
+import os
 from django.db import DataError
+from django.db import connections
+from django.db import transaction
+from functools import partial
 
+from papers.models import OadoiDigest
+from papers.models import OaiRecord
 from papers.models import Paper
 from papers.models import OaiSource
 from papers.baremodels import BareOaiRecord
 from papers.doi import doi_to_crossref_identifier
 from papers.doi import doi_to_url
 from papers.doi import to_doi
+from papers.doifilter import shared_doi_filter
+from backend.citeproc import DOIResolver
 from backend.doiprefixes import free_doi_prefixes
-from papers.errors import MetadataSourceException
+from backend.instrumentation import IngestMetrics
+from backend.instrumentation import PAPER_SAVE
+from backend.instrumentation import PARSE
+from backend.instrumentation import active_metrics
+from backend.instrumentation import ingest_stage
+from backend.lookups import LookupCache
+from backend.utils import parallel_map
 from backend.utils import report_speed
+from backend.utils import write_json_atomically
 
 logger = logging.getLogger('dissemin.' + __name__)
 
@@ -22,6 +38,16 @@ class OadoiAPI(object):
     """
     An interface to import an OAdoi dump into dissemin
     """
+
+    #: Number of records after which the position in the dump is saved
+    checkpoint_every = 10000
+    #: Number of records loaded together by :meth:`load_chunk`
+    chunk_size = 1000
+    #: Number of chunks read ahead of their loading by :meth:`load_dump_parallel`
+    chunks_lookahead = 10
+    #: Skip the DOIs whose OA locations did not change since the last dump loaded
+    skip_unchanged = True
+
     def __init__(self):
         self.oadoi_source, _ = OaiSource.objects.get_or_create(
             identifier='oadoi_repo',
@@ -34,32 +60,141 @@ class OadoiAPI(object):
         self.crossref_source = OaiSource.objects.get(identifier='crossref')
 
     @report_speed(name='oadoi importing speed')
-    def read_dump(self, filename, start_doi=None):
+    def read_dump(self, filename, start_doi=None, checkpoint=None):
         """
-        Enumerates the JSON objects in the dump, optionally starting from the given DOI
+        Enumerates the JSON objects in the dump, optionally starting from the given DOI.
+
+        :param checkpoint: the path of a JSON file where the position of the
+            record about to be enumerated (its line number, its offset in the
+            decompressed dump and its DOI) is saved every
+            :attr:`checkpoint_every` records. If it exists, the enumeration
+            resumes from that position: the lines before it are decompressed
+            but not parsed.
+        """
+        for position, record in self.read_dump_positions(filename, start_doi, checkpoint):
+            if checkpoint and position['line'] % self.checkpoint_every == 0:
+                # All the records before this one have been loaded
+                write_json_atomically(checkpoint, position)
+            yield record
+
+    def read_dump_positions(self, filename, start_doi=None, checkpoint=None):
+        """
+        Same as :meth:`read_dump`, without saving checkpoints (the checkpoint
+        is only read to resume from it).
+
+        :returns: generator of (position, JSON object) pairs
         """
         with gzip.open(filename, 'r') as f:
             start_doi_seen = start_doi is None
-            for line in f:
-                record = json.loads(line.decode('utf-8'))
+            line_nb = 0
+            position = None
+            if checkpoint and os.path.exists(checkpoint):
+                with open(checkpoint, 'r') as checkpoint_file:
+                    position = json.load(checkpoint_file)
+                logger.info('Resuming from line {line} ({doi})'.format(**position))
+                f.seek(position['offset'])
+                line_nb = position['line']
+            while True:
+                offset = f.tell()
+                line = f.readline()
+                if not line:
+                    break
+                with ingest_stage(PARSE):
+                    record = json.loads(line.decode('utf-8'))
+                if position is not None:
+                    if record.get('doi') != position['doi']:
+                        raise ValueError('The checkpoint {} does not match the dump'.format(checkpoint))
+                    position = None
                 if not start_doi_seen and record.get('doi') == start_doi:
                     start_doi_seen = True
                 if start_doi_seen:
-                    yield record
+                    yield {'line': line_nb, 'offset': offset, 'doi': record.get('doi')}, record
+                line_nb += 1
+
+    def read_chunks(self, filename, start_doi=None, checkpoint=None):
+        """
+        Enumerates the JSON objects in the dump in chunks of :attr:`chunk_size`
 
+        :returns: generator of (list of JSON objects, position of the first object of
+            the next chunk) pairs. The position is None for the last chunk.
+        """
+        chunk = []
+        for position, record in self.read_dump_positions(filename, start_doi, checkpoint):
+            if len(chunk) >= self.chunk_size:
+                yield chunk, position
+                chunk = []
+            chunk.append(record)
+        if chunk:
+            yield chunk, None
+
+    def load_dump(self, filename, start_doi=None, update_index=False, create_missing_dois=True, checkpoint=None):
+        """
+        Reads a dump from the disk and loads it to the database, in chunks
+        of :attr:`chunk_size` records (see :meth:`load_chunk`).
+
+        :param checkpoint: the path of a JSON file where the position in the
+            dump is saved after each chunk, to resume from it (see :meth:`read_dump`)
+        """
+        with IngestMetrics('oadoi').activate():
+            for records, next_position in self.read_chunks(filename, start_doi, checkpoint):
+                self.load_chunk(records, update_index, create_missing_dois)
+                if checkpoint and next_position is not None:
+                    write_json_atomically(checkpoint, next_position)
 
-    def load_dump(self, filename, start_doi=None, update_index=False, create_missing_dois=True):
+    def load_dump_parallel(self, filename, workers, start_doi=None, update_index=False, create_missing_dois=True, checkpoint=None):
         """
-        Reads a dump from the disk and loads it to the database.
+        Same as :meth:`load_dump`, with the dump split in chunks of
+        :attr:`chunk_size` records loaded by worker processes
+        (see :meth:`load_chunk`). The checkpoint is saved when all the
+        chunks before it are loaded.
+        """
+        load_chunk = partial(self.load_chunk_in_worker, update_index=update_index,
+                             create_missing_dois=create_missing_dois)
+        with IngestMetrics('oadoi').activate():
+            chunks = self.read_chunks(filename, start_doi, checkpoint)
+            # The workers are forked and must not share our connection to the database
+            connections.close_all()
+            for next_position in parallel_map(load_chunk, chunks, workers, self.chunks_lookahead):
+                if checkpoint and next_position is not None:
+                    write_json_atomically(checkpoint, next_position)
+
+    def load_chunk_in_worker(self, chunk, update_index, create_missing_dois):
+        """
+        Loads a chunk, as returned by :meth:`read_chunks`, in a worker
+        process of :meth:`load_dump_parallel`
+
+        :returns: the position of the next chunk
         """
-        for record in self.read_dump(filename, start_doi=start_doi):
-            self.create_oairecord(record, update_index, create_missing_dois)
+        records, next_position = chunk
+        self.load_chunk(records, update_index, create_missing_dois)
+        # worker processes are terminated without leaving the
+        # context of the metrics, so we push them chunk by chunk
+        metrics = active_metrics()
+        if metrics is not None:
+            metrics.push()
+        return next_position
 
     def create_oairecord(self, record, update_index=True, create_missing_dois=True):
         """
         Given one line of the dump (represented as a dict),
         add it to the corresponding paper (if it exists)
         """
+        self.load_chunk([record], update_index, create_missing_dois)
+
+    @staticmethod
+    def locations_digest(record):
+        """
+        A digest of the OA locations of a line of the dump, as far as
+        :meth:`add_locations` is concerned
+        """
+        locations = [(l['url'], l['host_type']) for l in record.get('oa_locations') or []]
+        return hashlib.md5(json.dumps(locations).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def get_doi(record):
+        """
+        The DOI of a line of the dump, or None if it should not be loaded
+        """
         doi = to_doi(record['doi'])
         if not doi:
             return
@@ -68,19 +203,17 @@ class OadoiAPI(object):
             return
         if not record.get('oa_locations'):
             return
+        return doi
 
-        paper = Paper.get_by_doi(doi)
-        if not paper:
-            if not create_missing_dois:
-                return
-            try:
-                paper = Paper.create_by_doi(doi)
-            except (MetadataSourceException, ValueError):
-                return
-            if not paper:
-                logger.info('no such paper for doi {doi}'.format(doi=doi))
-                return
-        logger.info(doi)
+    def add_locations(self, paper, doi, record, update_index=True):
+        """
+        Adds the OA locations of a line of the dump to the paper with its DOI
+
+        :returns: a pair of booleans: whether the paper was saved with a new
+            PDF URL, and whether all the locations were saved
+        """
+        saved = False
+        complete = True
         paper.cache_oairecords()
 
         for oa_location in record.get('oa_locations') or []:
@@ -88,7 +221,7 @@ class OadoiAPI(object):
 
             # just to speed things up a bit...
             if paper.pdf_url == url:
-                return
+                return saved, complete
 
             identifier='oadoi:'+url
             source = self.oadoi_source
@@ -112,8 +245,64 @@ class OadoiAPI(object):
                 paper.add_oairecord(record, check_by_doi=False)
                 super(Paper, paper).update_availability()
                 if old_pdf_url != paper.pdf_url:
-                    paper.save()
+                    with ingest_stage(PAPER_SAVE):
+                        paper.save()
+                    saved = True
                     if update_index:
                         paper.update_index()
             except (DataError, ValueError):
                 logger.warning('Record does not fit in the DB')
+                complete = False
+        return saved, complete
+
+    def load_chunk(self, records, update_index=False, create_missing_dois=True):
+        """
+        Same as :meth:`create_oairecord` for a list of lines of the dump:
+        the papers are looked up with one query, the missing ones are
+        created in bulk (see :meth:`DOIResolver.save_dois`) and the search
+        index is updated in one request.
+
+        The digest of the locations of a DOI is saved once they are all
+        added, so that the DOI is skipped while they do not change.
+        """
+        digests = {}
+        dois = []
+        for record in records:
+            doi = self.get_doi(record)
+            if doi:
+                digests[doi] = self.locations_digest(record)
+                dois.append((doi, record))
+        if self.skip_unchanged:
+            unchanged = set(OadoiDigest.objects.filter(doi__in=list(digests)).values_list('doi', 'digest'))
+            dois = [(doi, record) for doi, record in dois if (doi, digests[doi]) not in unchanged]
+
+        candidates = [doi for doi, _ in dois]
+        doi_filter = shared_doi_filter()
+        if doi_filter is not None:
+            candidates = [doi for doi, known in zip(candidates, doi_filter.contains_many(candidates)) if known]
+        papers = {}
+        for oairecord in OaiRecord.objects.filter(doi__in=candidates).select_related('about'):
+            papers.setdefault(oairecord.doi, oairecord.about)
+        missing = [doi for doi, _ in dois if doi not in papers]
+        if missing and create_missing_dois:
+            with LookupCache().activate():
+                for doi, paper in zip(missing, DOIResolver.save_dois(missing)):
+                    if paper is not None:
+                        papers[doi] = paper
+
+        saved = []
+        loaded = {}
+        for doi, record in dois:
+            paper = papers.get(doi)
+            if paper is not None:
+                paper_saved, complete = self.add_locations(paper, doi, record, update_index=False)
+                if paper_saved:
+                    saved.append(paper)
+                if complete:
+                    loaded[doi] = digests[doi]
+        if update_index:
+            Paper.bulk_update_index(saved)
+
+        with transaction.atomic():
+            OadoiDigest.objects.filter(doi__in=list(loaded)).delete()
+            OadoiDigest.objects.bulk_create([OadoiDigest(doi=doi, digest=digest) for doi, digest in loaded.items()])
@@ -21,24 +21,58 @@
 
 import logging
 
+from contextlib import nullcontext
 from datetime import datetime
+from functools import partial
 
+from backend.instrumentation import FETCH
+from backend.instrumentation import IngestMetrics
+from backend.instrumentation import PAPER_SAVE
+from backend.instrumentation import PARSE
+from backend.instrumentation import TRANSLATE
+from backend.instrumentation import ingest_stage
+from backend.oaicapture import CapturingClient
+from backend.oaicapture import ReplayClient
 from backend.papersource import PaperSource
+from backend.utils import parallel_map
 
+from django.db import IntegrityError
+from django.db import connections
 from django.db import transaction
+from django.utils import timezone
 from multiprocessing_generator import ParallelGenerator
 from oaipmh.client import Client
+from oaipmh.common import Header
+from oaipmh.common import Metadata
+from oaipmh.datestamp import datetime_to_datestamp
 
+from oaipmh.error import BadResumptionTokenError
 from oaipmh.error import NoRecordsMatchError
 from oaipmh.metadata import MetadataRegistry
-from oaipmh.metadata import oai_dc_reader
 from papers.models import Paper
 from backend.translators import OAIDCTranslator
 from backend.translators import BASEDCTranslator
-from backend.oaireader import base_dc_reader
+from backend.oaireader import base_dc_streaming_reader
+from backend.oaireader import oai_dc_streaming_reader
+from backend.oaireader import read_records_page
 
 logger = logging.getLogger('dissemin.' + __name__)
 
+
+def picklable_record(record):
+    """
+    pyoai records hold the lxml elements they were parsed from, which
+    cannot be sent to another process. This returns a copy of the
+    (header, metadata, about) triple without them.
+    """
+    header, metadata, about = record
+    header = Header(None, header.identifier(), header.datestamp(),
+                    header.setSpec(), header.isDeleted())
+    if metadata is not None:
+        metadata = Metadata(None, metadata.getMap())
+    return header, metadata, about
+
+
 class OaiPaperSource(PaperSource):  # TODO: this should not inherit from PaperSource
     """
     A paper source that fetches records from the OAI-PMH proxy
@@ -50,7 +84,18 @@ class OaiPaperSource(PaperSource):  # TODO: this should not inherit from PaperSo
     the metadata is served in.
     """
 
-    def __init__(self, oaisource, day_granularity=False, *args, **kwargs):
+    #: Number of ListRecords pages after which the progress of
+    #: a harvest is saved on the OAI source (see :meth:`update`)
+    checkpoint_every = 10
+    #: Number of ListRecords pages fetched ahead of the ingestion
+    pages_lookahead = 10
+    #: Number of pages translated ahead of the saving of the records,
+    #: when using translation workers
+    translation_lookahead = 20
+
+    def __init__(self, oaisource, day_granularity=False, batch_size=None,
+                 translation_workers=None, capture_dir=None, replay_dir=None,
+                 db_writers=None, *args, **kwargs):
         """
         This sets up the paper source.
 
@@ -58,20 +103,48 @@ class OaiPaperSource(PaperSource):  # TODO: this should not inherit from PaperSo
         :param day_granularity: should we use day-granular timestamps
             to fetch from the proxy or full timestamps (default: False,
             full timestamps)
+        :param batch_size: if set, records are saved in batches of that
+            size with bulk inserts (see :meth:`save_batch`) instead of
+            one by one (default: None, one by one)
+        :param translation_workers: if set, records are translated to
+            papers by that many worker processes while the current process
+            saves them (default: None, everything in the current process)
+        :param capture_dir: if set, the ListRecords pages fetched from
+            the endpoint are also stored in this directory
+            (see :class:`backend.oaicapture.CapturingClient`)
+        :param replay_dir: if set, the ListRecords pages are read from
+            this capture directory instead of the endpoint
+            (see :class:`backend.oaicapture.ReplayClient`)
+        :param db_writers: if set, a :class:`backend.utils.redis_semaphore`
+            of which a slot is held while saving each page of records, to
+            limit the number of harvests writing to the database at once
 
         See the protocol reference for more information on timestamp
         granularity:
         https://www.openarchives.org/OAI/openarchivesprotocol.html
         """
         super(OaiPaperSource, self).__init__(*args, **kwargs)
-        if not oaisource.endpoint:
+        if not oaisource.endpoint and not replay_dir:
             raise ValueError('No OAI endpoint was configured for this OAI source.')
 
+        self.oaisource = oaisource
+        self.replay_dir = replay_dir
         self.registry = MetadataRegistry()
-        self.registry.registerReader('oai_dc', oai_dc_reader)
-        self.registry.registerReader('base_dc', base_dc_reader)
-        self.client = Client(oaisource.endpoint, self.registry)
+        self.registry.registerReader('oai_dc', oai_dc_streaming_reader)
+        self.registry.registerReader('base_dc', base_dc_streaming_reader)
+        if replay_dir:
+            self.client = ReplayClient(replay_dir, self.registry)
+        elif capture_dir:
+            self.client = CapturingClient(oaisource.endpoint, self.registry, capture_dir)
+        else:
+            self.client = Client(oaisource.endpoint, self.registry)
         self.client._day_granularity = day_granularity
+        self.batch_size = batch_size
+        self.translation_workers = translation_workers
+        self.db_writers = db_writers
+        self.metrics = IngestMetrics(oaisource.identifier)
+        self.last_report = datetime.now()
+        self.processed_since_report = 0
         self.translators = {
             'oai_dc': OAIDCTranslator(oaisource),
             'base_dc': BASEDCTranslator(oaisource),
@@ -94,7 +167,7 @@ class OaiPaperSource(PaperSource):  # TODO: this should not inherit from PaperSo
     # Record ingestion
 
     def ingest(self, from_date=None, metadataPrefix='oai_dc',
-               resumptionToken=None):
+               resumptionToken=None, checkpoint=None):
         """
         Main method to fill Dissemin with papers!
 
@@ -102,14 +175,140 @@ class OaiPaperSource(PaperSource):  # TODO: this should not inherit from PaperSo
                           the proxy (useful for incremental fetching)
         :param metadataPrefix: restrict the ingest for this metadata
                           format
+        :param resumptionToken: resume a previous ListRecords request
+                          from the page designated by this token
+        :param checkpoint: a function called with the resumption token
+                          of the next page and the latest datestamp
+                          seen so far, every :attr:`checkpoint_every`
+                          pages (see :meth:`process_pages`)
+        """
+        with self.metrics.activate():
+            pages = self.list_record_pages(metadataPrefix, from_date=from_date,
+                                           resumptionToken=resumptionToken)
+            self.process_pages(pages, metadataPrefix, checkpoint=checkpoint)
+
+    def update(self, metadataPrefix='oai_dc'):
+        """
+        Fetches the records added or modified since the last update
+        of the OAI source.
+
+        The progress of the harvest is saved on the source every
+        :attr:`checkpoint_every` pages, so that an interrupted harvest
+        is resumed from its last checkpoint rather than from the start.
+        If the resumption token has expired in the meantime, we restart
+        from the latest datestamp seen before the interruption: this
+        assumes that the source serves its records in increasing
+        datestamp order.
+
+        When replaying a capture, this is the same as :meth:`replay`.
+        """
+        if self.replay_dir:
+            return self.replay(metadataPrefix)
+
+        source = self.oaisource
+        try:
+            if source.resumption_token:
+                logger.info("Resuming harvest of %s" % source.identifier)
+                try:
+                    self.ingest(metadataPrefix=metadataPrefix,
+                                resumptionToken=source.resumption_token,
+                                checkpoint=self.save_checkpoint)
+                except BadResumptionTokenError:
+                    logger.warning("Resumption token expired for %s" % source.identifier)
+                    from_date = source.last_datestamp or source.last_update
+                    self.ingest(from_date=from_date.replace(tzinfo=None),
+                                metadataPrefix=metadataPrefix,
+                                checkpoint=self.save_checkpoint)
+            else:
+                self.ingest(from_date=source.last_update.replace(tzinfo=None),
+                            metadataPrefix=metadataPrefix,
+                            checkpoint=self.save_checkpoint)
+        except NoRecordsMatchError:
+            pass
+
+        source.last_update = datetime.now()
+        source.resumption_token = None
+        source.last_datestamp = None
+        source.save()
+
+    def replay(self, metadataPrefix='oai_dc'):
+        """
+        Ingests the pages of the capture given as `replay_dir`.
+
+        Unlike :meth:`update`, the state of the harvest saved on the OAI
+        source is left untouched, so that replaying an old capture does
+        not make the next harvest skip the records published since.
+        """
+        if not self.replay_dir:
+            raise ValueError('No capture to replay for this OAI source.')
+        try:
+            self.ingest(metadataPrefix=metadataPrefix)
+        except NoRecordsMatchError:
+            pass
+
+    def save_checkpoint(self, token, datestamp):
+        """
+        Saves the progress of the current harvest on the OAI source.
+
+        :param token: the resumption token of the next page to fetch
+        :param datestamp: the latest datestamp of the records processed
+        """
+        source = self.oaisource
+        source.resumption_token = token
+        if datestamp is not None:
+            datestamp = timezone.make_aware(datestamp, timezone.utc)
+            if source.last_datestamp is None or source.last_datestamp < datestamp:
+                source.last_datestamp = datestamp
+        source.save(update_fields=['resumption_token', 'last_datestamp'])
+
+    def list_record_pages(self, metadataPrefix, from_date=None, resumptionToken=None):
+        """
+        Issues a ListRecords request and returns a generator of the pages
+        of its results, as (records, token) pairs: the records are
+        (header, metadata, about) triples as returned by pyoai and the
+        token is the resumption token of the next page (None for the last
+        page).
+
+        The first page is fetched straight away, so that errors (such as
+        :class:`NoRecordsMatchError` or :class:`BadResumptionTokenError`)
+        are raised by this method.
         """
-        args = {'metadataPrefix':metadataPrefix}
-        if from_date:
-            args['from_'] = from_date
         if resumptionToken:
-            args['resumptionToken'] = resumptionToken
-        records = self.client.listRecords(**args)
-        self.process_records(records, metadataPrefix)
+            args = {'resumptionToken': resumptionToken}
+        else:
+            args = {'metadataPrefix': metadataPrefix}
+            if from_date:
+                args['from'] = datetime_to_datestamp(from_date, self.client._day_granularity)
+        records, token = self.fetch_page(metadataPrefix, **args)
+        return self._record_pages(metadataPrefix, records, token)
+
+    def _record_pages(self, metadataPrefix, records, token):
+        while True:
+            yield records, token
+            if token is None:
+                break
+            records, token = self.fetch_page(metadataPrefix, resumptionToken=token)
+        # this generator runs in a child process (see process_pages),
+        # which never leaves the context of the metrics
+        self.metrics.push()
+
+    def fetch_page(self, metadataPrefix, **args):
+        """
+        Fetches a page of ListRecords results and reads it incrementally
+        (see :func:`backend.oaireader.read_records_page`). The body of the
+        page is still fetched as a whole by pyoai, and the records of the
+        page are all returned together.
+
+        :returns: a pair of the list of (header, metadata, about) triples
+            and the resumption token of the next page
+        """
+        with ingest_stage(FETCH):
+            xml = self.client.makeRequest(verb='ListRecords', **args)
+        if isinstance(xml, str):
+            # we do not keep the decoded body while the page is parsed
+            xml = xml.encode('utf-8')
+        with ingest_stage(PARSE):
+            return read_records_page(xml, metadataPrefix, self.registry)
 
     def create_paper_by_identifier(self, identifier, metadataPrefix):
         """
@@ -138,24 +337,60 @@ class OaiPaperSource(PaperSource):  # TODO: this should not inherit from PaperSo
         except NoRecordsMatchError:
             return []
 
-    def process_record(self, header, metadata, format):
+    def translate_record(self, header, metadata, format):
         """
-        Saves the record given by the header and metadata (as returned by
-        pyoai) into a Paper, or None if anything failed.
+        Translates the record given by the header and metadata (as returned
+        by pyoai) into a :class:`BarePaper`, or None if anything failed.
         """
         translator = self.translators.get(format)
         if translator is None:
             logger.warning("Unknown metadata format %s, skipping" % header.format())
             return
 
-        paper = translator.translate(header, metadata)
+        return translator.translate(header, metadata)
+
+    def save_record(self, header, paper):
+        """
+        Saves the :class:`BarePaper` translated from the record with the
+        given header into a Paper, or None if anything failed.
+        """
+        try:
+            with ingest_stage(PAPER_SAVE), transaction.atomic():
+                saved = Paper.from_bare(paper)
+            return saved
+        except ValueError:
+            logger.exception("Ignoring invalid paper with header %s" % header.identifier())
+
+    def process_record(self, header, metadata, format):
+        """
+        Saves the record given by the header and metadata (as returned by
+        pyoai) into a Paper, or None if anything failed.
+        """
+        paper = self.translate_record(header, metadata, format)
         if paper is not None:
-            try:
-                with transaction.atomic():
-                    saved = Paper.from_bare(paper)
-                return saved
-            except ValueError:
-                logger.exception("Ignoring invalid paper with header %s" % header.identifier())
+            return self.save_record(header, paper)
+
+    def save_batch(self, batch):
+        """
+        Saves a list of (header, :class:`BarePaper`) pairs.
+
+        The papers which do not collide with existing ones are inserted
+        in bulk, the others are saved one by one with :meth:`save_record`
+        so that they get merged. If the bulk insert fails, the whole batch
+        is saved one by one: this happens with invalid papers, or when
+        another process inserts a colliding paper after the collisions
+        were checked.
+        """
+        headers = {id(paper): header for header, paper in batch}
+        try:
+            with ingest_stage(PAPER_SAVE, len(batch)), transaction.atomic():
+                colliding = Paper.bulk_from_bare([paper for _, paper in batch])
+        except (ValueError, IntegrityError):
+            logger.warning("Bulk insert failed, saving the batch record by record", exc_info=True)
+            colliding = [paper for _, paper in batch]
+
+        for paper in colliding:
+            self.save_record(headers[id(paper)], paper)
 
     def process_records(self, listRecords, format):
         """
@@ -167,23 +402,118 @@ class OaiPaperSource(PaperSource):  # TODO: this should not inherit from PaperSo
             raise ValueError("No OAI translators have been set up: " +
                              "We cannot save any record.")
 
-        last_report = datetime.now()
-        processed_since_report = 0
-
-        with ParallelGenerator(listRecords, max_lookahead=1000) as g:
-            for record in g:
-                header = record[0]
-                metadata = record[1]._map
-
-                self.process_record(header, metadata, format)
-
-                # rate reporting
-                processed_since_report += 1
-                if processed_since_report >= 1000:
-                    td = datetime.now() - last_report
-                    rate = 'infty'
-                    if td.seconds:
-                        rate = str(processed_since_report / td.seconds)
-                    logger.info("current rate: %s records/s" % rate)
-                    processed_since_report = 0
-                    last_report = datetime.now()
+        records = map(picklable_record, listRecords)
+        with self.metrics.activate(), ParallelGenerator(records, max_lookahead=1000) as g:
+            self.save_records(g, format)
+
+    def process_pages(self, pages, format, checkpoint=None):
+        """
+        Save as :class:`Paper` all the records contained in these pages,
+        as returned by :meth:`list_record_pages`.
+
+        If :attr:`translation_workers` is set, the pages are translated
+        by that many worker processes and the current process only saves
+        the translated papers. At most :attr:`translation_lookahead` pages
+        are translated ahead of the saving.
+
+        :param checkpoint: a function called with the resumption token
+            of the next page and the latest datestamp seen so far, once
+            every :attr:`checkpoint_every` pages and after the last page.
+            All the records before that token have been saved when it
+            is called.
+        """
+        if not self.translators:
+            raise ValueError("No OAI translators have been set up: " +
+                             "We cannot save any record.")
+
+        latest_datestamp = None
+        translate_page = partial(self.translate_page, format=format)
+        with ParallelGenerator(pages, max_lookahead=self.pages_lookahead) as g:
+            if self.translation_workers:
+                # The workers are forked and must not share our connection to the database
+                connections.close_all()
+                translated_pages = parallel_map(translate_page, g,
+                    self.translation_workers, self.translation_lookahead)
+            else:
+                translated_pages = map(translate_page, g)
+
+            for page_nb, (translated, token) in enumerate(translated_pages, 1):
+                with self.db_writers.slot() if self.db_writers else nullcontext():
+                    self.save_translated_records(translated)
+
+                for header, _ in translated:
+                    if latest_datestamp is None or header.datestamp() > latest_datestamp:
+                        latest_datestamp = header.datestamp()
+                if checkpoint is not None and (token is None or page_nb % self.checkpoint_every == 0):
+                    checkpoint(token, latest_datestamp)
+
+    def translate_page(self, page, format):
+        """
+        Translates a page of records, as returned by :meth:`list_record_pages`.
+
+        :returns: a pair of the list of (header, :class:`BarePaper`) pairs
+            (see :meth:`translate_records`) and the resumption token
+            of the page
+        """
+        records, token = page
+        translated = list(self.translate_records(records, format))
+        if self.translation_workers:
+            # worker processes are terminated without leaving the
+            # context of the metrics, so we push them page by page
+            self.metrics.push()
+        return translated, token
+
+    def translate_records(self, records, format):
+        """
+        Translates (header, metadata, about) triples to (header,
+        :class:`BarePaper`) pairs. The paper is None for deleted records
+        and the records that could not be translated.
+        """
+        for header, metadata, _ in records:
+            paper = None
+            # deleted records come without metadata
+            if metadata is not None:
+                with ingest_stage(TRANSLATE):
+                    paper = self.translate_record(header, metadata._map, format)
+            yield header, paper
+
+    def save_records(self, records, format):
+        """
+        Save as :class:`Paper` the given (header, metadata, about) triples.
+        """
+        self.save_translated_records(self.translate_records(records, format))
+
+    def save_translated_records(self, translated):
+        """
+        Save as :class:`Paper` the given (header, :class:`BarePaper`)
+        pairs, one by one or in batches of :attr:`batch_size`.
+        """
+        batch = []
+        for header, paper in translated:
+            if paper is not None:
+                if self.batch_size:
+                    batch.append((header, paper))
+                    if len(batch) >= self.batch_size:
+                        self.save_batch(batch)
+                        batch = []
+                else:
+                    self.save_record(header, paper)
+            self.report_rate()
+
+        if batch:
+            self.save_batch(batch)
+
+    def report_rate(self):
+        """
+        Counts a processed record and logs the processing rate
+        every 1000 records.
+        """
+        self.processed_since_report += 1
+        if self.processed_since_report >= 1000:
+            td = datetime.now() - self.last_report
+            rate = 'infty'
+            if td.seconds:
+                rate = str(self.processed_since_report / td.seconds)
+            logger.info("current rate: %s records/s" % rate)
+            self.processed_since_report = 0
+            self.last_report = datetime.now()
@@ -0,0 +1,101 @@
+# -*- encoding: utf-8 -*-
+
+# Dissemin: open access policy enforcement tool
+# Copyright (C) 2014 Antonin Delpeuch
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+
+"""
+Capture of the raw ListRecords pages served by an OAI-PMH endpoint,
+and replay of these pages in place of the endpoint.
+
+A capture directory holds the gzipped XML pages of one harvest: the
+first page is stored under the metadata prefix it was requested in, the
+following ones under (a digest of) the resumption token they were
+requested with. Replaying a capture therefore re-ingests the same
+records, in the same pages, without any network access.
+"""
+
+import gzip
+import hashlib
+import logging
+import os
+
+from oaipmh.client import Client
+
+logger = logging.getLogger('dissemin.' + __name__)
+
+
+def capture_filename(**kw):
+    """
+    The name of the file a ListRecords page is stored in, given the
+    arguments it was requested with.
+    """
+    token = kw.get('resumptionToken')
+    if token:
+        return 'token-%s.xml.gz' % hashlib.sha1(token.encode('utf-8')).hexdigest()
+    return 'first-%s.xml.gz' % kw.get('metadataPrefix')
+
+
+class CapturingClient(Client):
+    """
+    An OAI-PMH client which stores the ListRecords pages it fetches
+    in a capture directory, to be replayed later by :class:`ReplayClient`.
+    """
+
+    def __init__(self, base_url, metadata_registry, capture_dir, **kwargs):
+        """
+        :param capture_dir: the capture directory, which must be empty or
+            not exist yet: mixing the pages of two harvests would make
+            the first page of one lead to the pages of the other
+        """
+        super(CapturingClient, self).__init__(base_url, metadata_registry, **kwargs)
+        if os.path.isdir(capture_dir) and os.listdir(capture_dir):
+            raise ValueError('The capture directory %s is not empty' % capture_dir)
+        self.capture_dir = capture_dir
+        os.makedirs(capture_dir, exist_ok=True)
+
+    def makeRequest(self, **kw):
+        xml = super(CapturingClient, self).makeRequest(**kw)
+        if kw.get('verb') == 'ListRecords':
+            if isinstance(xml, str):
+                xml = xml.encode('utf-8')
+            path = os.path.join(self.capture_dir, capture_filename(**kw))
+            with gzip.open(path, 'wb') as f:
+                f.write(xml)
+        return xml
+
+
+class ReplayClient(Client):
+    """
+    An OAI-PMH client which serves the ListRecords pages stored in
+    a capture directory by :class:`CapturingClient`.
+
+    The first page is served whatever the ``from`` date requested,
+    as the capture only holds the pages of one harvest.
+    """
+
+    def __init__(self, capture_dir, metadata_registry, **kwargs):
+        super(ReplayClient, self).__init__(capture_dir, metadata_registry, **kwargs)
+        self.capture_dir = capture_dir
+
+    def makeRequest(self, **kw):
+        # only the ListRecords pages are captured
+        path = os.path.join(self.capture_dir, capture_filename(**kw))
+        if kw.get('verb') != 'ListRecords' or not os.path.exists(path):
+            raise ValueError('No captured page for request %s in %s' % (kw, self.capture_dir))
+        with gzip.open(path, 'rb') as f:
+            return f.read()
@@ -18,7 +18,17 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 #
 
+from io import BytesIO
+
+from lxml import etree
+from oaipmh import error
+from oaipmh.common import Header
+from oaipmh.common import Metadata
+from oaipmh.datestamp import datestamp_to_datetime
 from oaipmh.metadata import MetadataReader
+from oaipmh.metadata import oai_dc_reader
+
+OAI_NS = '{http://www.openarchives.org/OAI/2.0/}'
 
 base_dc_reader = MetadataReader(
     fields={
@@ -56,3 +66,121 @@ base_dc_reader = MetadataReader(
     'dc' : 'http://purl.org/dc/elements/1.1/'}
     )
 
+
+class StreamingMetadataReader(object):
+    """
+    A replacement for pyoai's :class:`MetadataReader`, producing the same
+    metadata maps. Instead of evaluating one XPath expression per field,
+    it goes over the children of the metadata element once and dispatches
+    their text to the fields they belong to.
+
+    Only fields of the form ``('textList', 'ns:root/ns:child/text()')``
+    are supported, which is what the Dublin Core readers use.
+    """
+
+    def __init__(self, fields, namespaces):
+        self.field_names = list(fields)
+        self.fields = {}
+        for field_name, (field_type, expr) in fields.items():
+            path = expr.split('/')
+            if field_type != 'textList' or len(path) != 3 or path[2] != 'text()':
+                raise ValueError('Unsupported field for streaming: %s' % expr)
+            root, child = [self._clark(tag, namespaces) for tag in path[:2]]
+            self.fields[(root, child)] = field_name
+
+    @staticmethod
+    def _clark(tag, namespaces):
+        prefix, name = tag.split(':')
+        return '{%s}%s' % (namespaces[prefix], name)
+
+    @classmethod
+    def from_reader(cls, reader):
+        """
+        Builds a streaming reader for the same fields as a pyoai
+        :class:`MetadataReader`.
+        """
+        return cls(reader._fields, reader._namespaces)
+
+    def __call__(self, element):
+        map = {field_name: [] for field_name in self.field_names}
+        for root in element:
+            for child in root:
+                field_name = self.fields.get((root.tag, child.tag))
+                if field_name is None:
+                    continue
+                # text() also selects the text following nested elements
+                if child.text is not None:
+                    map[field_name].append(str(child.text))
+                for nested in child:
+                    if nested.tail is not None:
+                        map[field_name].append(str(nested.tail))
+        return Metadata(element, map)
+
+
+base_dc_streaming_reader = StreamingMetadataReader.from_reader(base_dc_reader)
+oai_dc_streaming_reader = StreamingMetadataReader.from_reader(oai_dc_reader)
+
+
+def read_header(element):
+    """
+    Reads an OAI-PMH header element, like pyoai does but without
+    keeping a reference to the element.
+    """
+    datestamp = datestamp_to_datetime(element.findtext(OAI_NS + 'datestamp', ''))
+    setspec = [s.text for s in element.findall(OAI_NS + 'setSpec')]
+    return Header(None, element.findtext(OAI_NS + 'identifier', ''),
+                  datestamp, setspec, element.get('status') == 'deleted')
+
+
+def read_records_page(xml, metadata_prefix, registry):
+    """
+    Reads a ListRecords response incrementally with :func:`etree.iterparse`:
+    each record is read with the reader the registry holds for the
+    metadata prefix as soon as it is parsed, and then discarded,
+    so the whole tree of the page is never in memory. The body of the
+    page and the records read from it are.
+
+    OAI-PMH errors are raised as pyoai does.
+
+    :returns: a pair of the list of (header, metadata, about) triples
+        (without any reference to the XML elements) and the resumption
+        token of the next page, or None for the last page
+    """
+    if isinstance(xml, str):
+        xml = xml.encode('utf-8')
+    records = []
+    token = None
+    tags = [OAI_NS + 'record', OAI_NS + 'resumptionToken', OAI_NS + 'error']
+    try:
+        for _, element in etree.iterparse(BytesIO(xml), tag=tags):
+            if element.tag == OAI_NS + 'record':
+                header = read_header(element.find(OAI_NS + 'header'))
+                metadata = None
+                metadata_node = element.find(OAI_NS + 'metadata')
+                if metadata_node is not None:
+                    metadata = Metadata(None, registry.readMetadata(
+                        metadata_prefix, metadata_node).getMap())
+                records.append((header, metadata, None))
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+            elif element.tag == OAI_NS + 'resumptionToken':
+                token = (element.text or '').strip() or None
+            else:
+                raise_oai_error(element)
+    except etree.XMLSyntaxError as e:
+        raise error.XMLSyntaxError(str(e))
+    return records, token
+
+
+def raise_oai_error(element):
+    """
+    Raises the pyoai exception corresponding to an OAI-PMH error element.
+    """
+    code = element.get('code') or ''
+    if code not in ['badArgument', 'badResumptionToken', 'badVerb',
+                    'cannotDisseminateFormat', 'idDoesNotExist',
+                    'noRecordsMatch', 'noMetadataFormats', 'noSetHierarchy']:
+        raise error.UnknownError(
+            "Unknown error code from server: %s, message: %s" % (code, element.text))
+    raise getattr(error, code[0].upper() + code[1:] + 'Error')(element.text)
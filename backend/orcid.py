@@ -20,10 +20,9 @@
 
 
 import logging
-import json
-import os
 
 from django.conf import settings
+from django.db import transaction
 
 from backend.citeproc import CrossRef
 from backend.papersource import PaperSource
@@ -33,6 +32,7 @@ import notification.levels as notification_levels
 from papers.baremodels import BareOaiRecord
 from papers.baremodels import BarePaper
 from papers.errors import MetadataSourceException
+from papers.models import IngestedOrcidWork
 from papers.models import OaiSource
 from papers.models import OaiRecord
 from papers.models import Researcher
@@ -51,6 +51,9 @@ class OrcidPaperSource(PaperSource):
     def __init__(self, *args, **kwargs):
         super(OrcidPaperSource, self).__init__(*args, **kwargs)
         self.oai_source = OaiSource.objects.get(identifier='orcid')
+        #: Number of works of the last :meth:`fetch_orcid_records` which have a DOI
+        #: but were not found by DOI, and were created from ORCID metadata instead
+        self.failed_doi_lookups = 0
 
     def _enhance_paper(self, paper, ref_name, orcid_id):
         """
@@ -123,10 +126,10 @@ class OrcidPaperSource(PaperSource):
 
         paper.add_oairecord(record)
 
+        # The authors_list of the paper is saved by the caller
         try:
             p = Paper.from_bare(paper)
             p = self.associate_researchers(p)
-            p.save()
             p.update_index()
         except ValueError:
             p = None
@@ -180,19 +183,21 @@ class OrcidPaperSource(PaperSource):
                         author.researcher_id = researcher.id
                 paper.authors_list = [author.serialize() for author in new_authors]
                 papers_to_update.append(paper)
-                paper.update_index()
 
         if papers_to_update:
             Paper.objects.bulk_update(papers_to_update, ['authors_list'])
+            Paper.bulk_update_index(papers_to_update)
 
 
-    def fetch_orcid_records(self, orcid_identifier, profile=None, use_doi=True):
+    def fetch_orcid_records(self, orcid_identifier, profile=None, use_doi=True, researcher=None):
         """
         Queries ORCiD to retrieve the publications associated with a given ORCiD.
         It also fetches such papers from the CrossRef search interface.
 
         :param profile: The ORCID profile if it has already been fetched before (format: parsed JSON).
         :param use_doi: Fetch the publications by DOI when we find one (recommended, but slow)
+        :param researcher: The Researcher of this ORCiD if it has already been created or
+                updated from the profile
         :returns: a generator, where all the papers found are yielded. (some of them could be in
                 free form, hence not imported)
         """
@@ -210,8 +215,10 @@ class OrcidPaperSource(PaperSource):
             return
 
         # As we have fetched the profile, let's update the Researcher
-        self.researcher = Researcher.get_or_create_by_orcid(orcid_identifier,
-                profile.json, update=True)
+        if researcher is None:
+            researcher = Researcher.get_or_create_by_orcid(orcid_identifier,
+                    profile.json, update=True)
+        self.researcher = researcher
         if not self.researcher:
             return
 
@@ -219,6 +226,19 @@ class OrcidPaperSource(PaperSource):
         ref_name = profile.name
         ignored_papers = []  # list of ignored papers due to incomplete metadata
 
+        # The works which did not change since their paper was saved are skipped
+        ingested = dict(IngestedOrcidWork.objects.filter(researcher=self.researcher)
+                        .values_list('put_code', 'last_modified'))
+        last_modified = {}  # last-modified dates of the works to fetch, by put code
+        saved_papers = {}  # papers saved, by put code of their work
+        # papers created from ORCID metadata, whose authors_list is not saved yet, by id:
+        # a later work can be merged into the same paper, whose last instance is saved
+        created_papers = {}
+        # put codes of the works whose DOI could not be looked up: CrossRef may have
+        # failed for a passing reason, so they are not remembered and tried again next time
+        failed_put_codes = set()
+        self.failed_doi_lookups = 0
+
         # Get summary publications and separate them in two classes:
         # - the ones with DOIs, that we will fetch with CrossRef
         dois_and_putcodes = []  # list of (DOIs,putcode) to fetch
@@ -226,42 +246,82 @@ class OrcidPaperSource(PaperSource):
         #   and try to create a paper with what they provide
         put_codes = []
         for summary in profile.work_summaries:
+            if (summary.put_code in ingested and summary.last_modified is not None and
+                ingested[summary.put_code] == summary.last_modified):
+                continue
+            last_modified[summary.put_code] = summary.last_modified
             if summary.doi and use_doi:
                 dois_and_putcodes.append((summary.doi.lower(), summary.put_code))
             else:
                 put_codes.append(summary.put_code)
 
-        # 1st attempt with DOIs
-        if use_doi:
-            # Let's grab papers with DOIs found in our ORCiD profile.
-            dois = [doi for doi, put_code in dois_and_putcodes]
-            for idx, paper in enumerate(self.fetch_metadata_from_dois(ref_name, orcid_id, dois)):
+        # The works are remembered even if we stop before the end,
+        # when the consumer stops iterating or an error occurs
+        try:
+            # 1st attempt with DOIs
+            if use_doi:
+                # Let's grab papers with DOIs found in our ORCiD profile.
+                dois = [doi for doi, put_code in dois_and_putcodes]
+                for idx, paper in enumerate(self.fetch_metadata_from_dois(ref_name, orcid_id, dois)):
+                    if paper is not None:
+                        saved_papers[dois_and_putcodes[idx][1]] = paper
+                        yield paper
+                    else:
+                        put_codes.append(dois_and_putcodes[idx][1])
+                        failed_put_codes.add(dois_and_putcodes[idx][1])
+                        self.failed_doi_lookups += 1
+
+            # 2nd attempt with ORCID's own crappy metadata
+            works = profile.fetch_works(put_codes)
+            for work in works:
+                if not work:
+                    continue
+
+                # If the paper is skipped due to invalid metadata.
+                # We first try to reconcile it with local researcher author name.
+                # Then, we consider it missed.
+                if work.skipped:
+                    logger.warning("Work skipped due to incorrect metadata. \n %s \n %s" % (work.reason, work.skip_reason))
+
+                    ignored_papers.append(work.as_dict())
+                    continue
+
+                paper = self.create_paper(work)
                 if paper is not None:
-                    yield paper
-                else:
-                    put_codes.append(dois_and_putcodes[idx][1])
-
-        # 2nd attempt with ORCID's own crappy metadata
-        works = profile.fetch_works(put_codes)
-        for work in works:
-            if not work:
-                continue
-
-            # If the paper is skipped due to invalid metadata.
-            # We first try to reconcile it with local researcher author name.
-            # Then, we consider it missed.
-            if work.skipped:
-                logger.warning("Work skipped due to incorrect metadata. \n %s \n %s" % (work.reason, work.skip_reason))
-
-                ignored_papers.append(work.as_dict())
-                continue
-
-            yield self.create_paper(work)
+                    created_papers[paper.pk] = paper
+                    if work.put_code not in failed_put_codes:
+                        saved_papers[work.put_code] = paper
+                yield paper
+        finally:
+            # The researchers of the papers created from ORCID metadata are saved in one request
+            Paper.objects.bulk_update(list(created_papers.values()), ['authors_list'])
+            self.save_ingested_works(profile, saved_papers, last_modified)
 
         self.warn_user_of_ignored_papers(ignored_papers)
         if ignored_papers:
             logger.warning("Total ignored papers: %d" % (len(ignored_papers)))
 
+    def save_ingested_works(self, profile, papers, last_modified):
+        """
+        Remembers the works whose paper was saved, and forgets the ones
+        which were removed from the profile.
+
+        :param papers: the papers saved, by put code of their work
+        :param last_modified: the last-modified dates of the works, by put code
+        """
+        with transaction.atomic():
+            IngestedOrcidWork.objects.filter(researcher=self.researcher).exclude(
+                put_code__in=[summary.put_code for summary in profile.work_summaries]).delete()
+            IngestedOrcidWork.objects.filter(researcher=self.researcher, put_code__in=list(papers)).delete()
+            # papers merged into others during the harvest do not exist anymore
+            existing = set(Paper.objects.filter(pk__in=[paper.pk for paper in papers.values()])
+                           .values_list('pk', flat=True))
+            IngestedOrcidWork.objects.bulk_create([
+                IngestedOrcidWork(researcher=self.researcher, put_code=put_code, paper=paper,
+                                  last_modified=last_modified.get(put_code))
+                for put_code, paper in papers.items()
+                if put_code is not None and paper.pk in existing])
+
     def fetch_and_save(self, researcher, profile=None):
         """
         Fetch papers and save them to the database.
@@ -273,43 +333,40 @@ class OrcidPaperSource(PaperSource):
             if researcher.empty_orcid_profile == None:
                 self.update_empty_orcid(researcher, True)
 
-            for p in self.fetch_orcid_records(researcher.orcid, profile=profile):
-                if self.max_results is not None and count >= self.max_results:
-                    break
-
-                count += 1
+            if profile is None:
+                try:
+                    profile = OrcidProfile(orcid_id=researcher.orcid)
+                except MetadataSourceException:
+                    logger.exception("ORCID Profile Error")
+                    return
+                if profile.harvested:
+                    logger.info("The ORCID profile of %s did not change since it was harvested", researcher.orcid)
+                    return
+
+            # The papers are indexed in one request at the end of the harvest
+            complete = False
+            with Paper.batch_index_updates():
+                for p in self.fetch_orcid_records(researcher.orcid, profile=profile):
+                    if self.max_results is not None and count >= self.max_results:
+                        break
+
+                    count += 1
+                else:
+                    complete = True
+            # A profile whose papers were not all fetched, or not all found
+            # by DOI, is harvested again next time
+            if complete and not self.failed_doi_lookups:
+                profile.mark_harvested()
 
 
-    def bulk_import(self, directory, fetch_papers=True, use_doi=False):
-        """
-        Bulk-imports ORCID profiles from a dump
-        (warning: this still uses our DOI cache).
-        The directory should contain json versions
-        of orcid profiles, as in the official ORCID
-        dump.
+    def bulk_import(self, path, fetch_papers=True, use_doi=False):
         """
+        Bulk-imports ORCID profiles from the public data file
+        (see :class:`backend.orcid_dump.OrcidDump`).
 
-        for root, _, fnames in os.walk(directory):
-            for fname in fnames:
-                #if fname == '0000-0003-1349-4524.json':
-                #    seen = True
-                #if not seen:
-                #    continue
-
-                with open(os.path.join(root, fname), 'r') as f:
-                    try:
-                        profile = json.load(f)
-                        orcid = profile['orcid-profile'][
-                                        'orcid-identifier'][
-                                        'path']
-                        r = Researcher.get_or_create_by_orcid(
-                            orcid, profile, update=True)
-                        if fetch_papers:
-                            papers = self.fetch_orcid_records(orcid,
-                                profile=OrcidProfile(json=profile),
-                                use_doi=use_doi)
-                            for p in papers:
-                                self.save_paper(p, r)
-                    except (ValueError, KeyError):
-                        logger.warning("Invalid profile: %s" % fname)
+        :param path: the path of the data file, or of a directory
+            containing JSON versions of ORCID profiles
+        """
+        from backend.orcid_dump import OrcidDump
 
+        OrcidDump(fetch_papers=fetch_papers, use_doi=use_doi).load_dump(path)
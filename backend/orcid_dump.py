@@ -0,0 +1,227 @@
+# -*- encoding: utf-8 -*-
+
+# Dissemin: open access policy enforcement tool
+# Copyright (C) 2014 Antonin Delpeuch
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+
+"""
+Bulk import of the ORCID public data file.
+
+The data file is a (compressed) tarball with one member per profile.
+ORCID publishes it in XML, the members are expected in the JSON format
+of the public API v2.1, as output by ORCID's conversion library. The
+tarball is read as a stream, without extracting it.
+
+The data file can also be extracted to a directory first, with one JSON
+file per profile, as the earlier dumps that were published in JSON.
+
+The profiles are imported in batches, by worker processes: the
+researchers of a batch are created or updated in bulk, then their
+papers are fetched and saved.
+"""
+
+import json
+import logging
+import os
+import tarfile
+
+from django.db import IntegrityError
+from django.db import connections
+from django.db import transaction
+
+from backend.instrumentation import IngestMetrics
+from backend.instrumentation import PARSE
+from backend.instrumentation import active_metrics
+from backend.instrumentation import ingest_stage
+from backend.orcid import OrcidPaperSource
+from backend.utils import parallel_map
+from backend.utils import write_json_atomically
+from papers.errors import MetadataSourceException
+from papers.models import Paper
+from papers.models import Researcher
+from papers.orcid import OrcidProfile
+from papers.utils import jpath
+from papers.utils import validate_orcid
+
+logger = logging.getLogger('dissemin.' + __name__)
+
+
+class OrcidDump(object):
+    """
+    Imports the ORCID public data file
+    """
+
+    #: Number of profiles imported together
+    batch_size = 100
+    #: Number of batches read ahead of the workers
+    lookahead = 10
+
+    def __init__(self, workers=None, fetch_papers=True, use_doi=False):
+        """
+        :param workers: the number of processes importing the batches,
+            if None they are imported by the current process
+        :param fetch_papers: fetch the papers of the profiles, and not
+            only create the researchers
+        :param use_doi: fetch the papers with a DOI from CrossRef
+            (see :meth:`OrcidPaperSource.fetch_orcid_records`)
+        """
+        self.workers = workers
+        self.fetch_papers = fetch_papers
+        self.use_doi = use_doi
+        self.source = OrcidPaperSource()
+
+    def read_members(self, path):
+        """
+        Enumerates the JSON members of the data file, or the JSON files
+        of a directory (in a stable order, so that :meth:`load_dump`
+        can resume after any of them).
+
+        :returns: generator of (name, file) pairs, where the file is only
+            open until the next pair is requested
+        """
+        if os.path.isdir(path):
+            for root, dirs, fnames in os.walk(path):
+                dirs.sort()
+                for fname in sorted(fnames):
+                    if not fname.endswith('.json'):
+                        continue
+                    full_path = os.path.join(root, fname)
+                    with open(full_path, 'rb') as f:
+                        yield os.path.relpath(full_path, path), f
+        else:
+            with tarfile.open(path, mode='r|*') as tar:
+                for member in tar:
+                    if member.isfile() and member.name.endswith('.json'):
+                        yield member.name, tar.extractfile(member)
+
+    def read_dump(self, path, start_after=None):
+        """
+        Enumerates the profiles of the data file in batches.
+
+        :param path: the path of the tarball, or of a directory
+            where it was extracted
+        :param start_after: skip the members of the data file up to this one
+        :returns: generator of (name of the last member, profiles) pairs,
+            where the profiles are the contents of the members
+        """
+        batch = []
+        name = None
+        skipping = start_after is not None
+        for member_name, f in self.read_members(path):
+            if skipping:
+                skipping = member_name != start_after
+                continue
+            with ingest_stage(PARSE):
+                batch.append(f.read())
+            name = member_name
+            if len(batch) >= self.batch_size:
+                yield name, batch
+                batch = []
+        if batch:
+            yield name, batch
+        if skipping:
+            raise ValueError('{} is not a member of the data file'.format(start_after))
+
+    def parse_profiles(self, contents):
+        """
+        :returns: a dict mapping the ORCID ids to the :class:`OrcidProfile`
+            of the members, without the invalid ones
+        """
+        profiles = {}
+        for content in contents:
+            try:
+                record = json.loads(content)
+                orcid = validate_orcid(jpath('orcid-identifier/path', record))
+            except (ValueError, AttributeError):
+                # not JSON, or not a JSON object
+                orcid = None
+            if orcid is None:
+                logger.warning('Invalid profile: %s', content[:100])
+                continue
+            profiles[orcid] = OrcidProfile(orcid_id=orcid, json=record)
+        return profiles
+
+    def import_batch(self, batch):
+        """
+        Imports a batch of profiles, as returned by :meth:`read_dump`
+
+        :returns: the name of the last member of the batch
+        """
+        name, contents = batch
+        profiles = self.parse_profiles(contents)
+        try:
+            with transaction.atomic():
+                researchers = Researcher.bulk_get_or_create_by_orcid(profiles)
+        except IntegrityError:
+            # a researcher or a name of the batch was created concurrently
+            # (for instance by a login), so we fall back on the slow path
+            logger.warning('Conflict while creating the researchers of %s, '
+                           'creating them one by one', name)
+            researchers = {}
+            for orcid, profile in profiles.items():
+                researcher = Researcher.get_or_create_by_orcid(orcid, profile, update=True)
+                if researcher is not None:
+                    researchers[orcid] = researcher
+        if self.fetch_papers:
+            with Paper.batch_index_updates():
+                for orcid, researcher in researchers.items():
+                    try:
+                        for paper in self.source.fetch_orcid_records(orcid, profile=profiles[orcid],
+                                                                     use_doi=self.use_doi, researcher=researcher):
+                            pass
+                    except MetadataSourceException:
+                        logger.exception('Could not fetch the papers of %s', orcid)
+        return name
+
+    def import_batch_in_worker(self, batch):
+        """
+        Imports a batch in a worker process of :meth:`load_dump`
+        """
+        name = self.import_batch(batch)
+        # worker processes are terminated without leaving the
+        # context of the metrics, so we push them batch by batch
+        metrics = active_metrics()
+        if metrics is not None:
+            metrics.push()
+        return name
+
+    def load_dump(self, path, checkpoint=None):
+        """
+        Imports the data file.
+
+        :param checkpoint: the path of a JSON file where the name of the
+            last member imported is saved after each batch. If it exists,
+            the import resumes after that member.
+        """
+        start_after = None
+        if checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint, 'r') as f:
+                start_after = json.load(f)['member']
+            logger.info('Resuming after {}'.format(start_after))
+
+        with IngestMetrics('orcid').activate():
+            batches = self.read_dump(path, start_after)
+            if self.workers:
+                # The workers are forked and must not share our connection to the database
+                connections.close_all()
+                names = parallel_map(self.import_batch_in_worker, batches, self.workers, self.lookahead)
+            else:
+                names = map(self.import_batch, batches)
+
+            for name in names:
+                if checkpoint:
+                    write_json_atomically(checkpoint, {'member': name})
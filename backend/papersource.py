@@ -45,17 +45,17 @@ class PaperSource(object):
 
     def associate_researchers(self, paper):
         """
-        Associate known ORCIDs to the corresponding researchers
+        Associate known ORCIDs to the corresponding researchers,
+        with one query. The paper is not saved.
         :params paper: Paper object
         :returns: Paper object with updated researchers
         """
-        for idx, author in enumerate(paper.authors_list):
-            if author['orcid']:
-                try:
-                    researcher = Researcher.objects.get(orcid=author['orcid'])
-                    paper.set_researcher(idx, researcher.pk)
-                except Researcher.DoesNotExist:
-                    pass
+        orcids = [author['orcid'] for author in paper.authors_list if author['orcid']]
+        if orcids:
+            researcher_ids = dict(Researcher.objects.filter(orcid__in=orcids).values_list('orcid', 'pk'))
+            for author in paper.authors_list:
+                if author['orcid'] in researcher_ids:
+                    author['researcher_id'] = researcher_ids[author['orcid']]
 
         return paper
 
@@ -84,28 +84,42 @@ class PaperSource(object):
             papers are fetched on the fly for an user.
         """
         count = 0
-        for p in self.fetch_bare(researcher):
-            try:
-                self.save_paper(p, researcher)
-            except ValueError:
-                continue
-            if self.max_results is not None and count >= self.max_results:
-                break
-
-            count += 1
-
-    def save_paper(self, bare_paper, researcher):
-        # Save the paper as non-bare
+        # the papers by id: when a later paper is merged into an earlier one,
+        # its last instance is saved
+        papers = {}
+        with Paper.batch_index_updates():
+            for p in self.fetch_bare(researcher):
+                try:
+                    paper = self.prepare_paper(p)
+                    papers[paper.pk] = paper
+                except ValueError:
+                    continue
+                if self.max_results is not None and count >= self.max_results:
+                    break
+
+                count += 1
+            # The researchers of the papers are saved in one request
+            Paper.objects.bulk_update(list(papers.values()), ['authors_list'])
+
+    def prepare_paper(self, bare_paper):
+        """
+        Saves a paper as non-bare and associates its authors to the
+        known researchers, without saving them: its authors_list
+        must be saved by the caller.
+        """
         paper = Paper.from_bare(bare_paper)
 
         # Associate known ORCIDs to the corresponding researchers
         paper = self.associate_researchers(paper)
-
-        paper.save()
         paper.update_index()
 
         return paper
 
+    def save_paper(self, bare_paper, researcher):
+        paper = self.prepare_paper(bare_paper)
+        paper.save(update_fields=['authors_list'])
+        return paper
+
     def update_empty_orcid(self, researcher, val):
         """
         Updates the empty_orcid_profile field of the provided :class:`Researcher` instance.
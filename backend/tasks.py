@@ -22,14 +22,16 @@
 
 from celery import shared_task
 from celery.utils.log import get_task_logger
-from datetime import datetime
 from datetime import timedelta
+from urllib.parse import urlparse
 
+from django.conf import settings
 from django.utils import timezone
 
 from backend.citeproc import CrossRef
 from backend.oai import OaiPaperSource
 from backend.orcid import OrcidPaperSource
+from backend.utils import redis_semaphore
 from backend.utils import run_only_once
 from backend.zotero import consolidate_publication
 from statistics.models import AccessStatistics
@@ -135,14 +137,41 @@ def update_crossref():
     CrossRef.fetch_latest_records()
 
 @shared_task(name='update_oai_sources')
-@run_only_once('update_oai_sources', timeout=24*3600)
+@run_only_once('update_oai_sources', timeout=10*60)
 def update_oai_sources():
     """
-    Fetches new and updated records from all configured OAI sources since
-    their last update.
+    Starts a harvest (see :func:`update_oai_source`) for each configured
+    OAI source, so that they run in parallel.
     """
-    for source in OaiSource.objects.filter(endpoint__isnull=False):
-        oai = OaiPaperSource(source)
-        oai.ingest(source.last_update.replace(tzinfo=None), metadataPrefix='base_dc')
-        source.last_update = datetime.now()
-        source.save()
+    for pk in OaiSource.objects.filter(endpoint__isnull=False).values_list('pk', flat=True):
+        update_oai_source.delay(pk=pk)
+
+@shared_task(name='update_oai_source', bind=True, max_retries=12)
+@run_only_once('update_oai_source', keys=['pk'], timeout=24*3600)
+def update_oai_source(self, pk):
+    """
+    Fetches new and updated records from an OAI source since its last
+    update, resuming an interrupted harvest where it stopped.
+
+    At most settings.OAI_MAX_HARVESTS_PER_ENDPOINT harvests run against
+    the same endpoint: if there are already that many, the task is retried
+    every 10 minutes, and dropped after two hours so that retrying tasks
+    do not pile up with the next runs of :func:`update_oai_sources`. At most
+    settings.OAI_MAX_DB_WRITERS harvests save records at the same time.
+    """
+    source = OaiSource.objects.get(pk=pk)
+    endpoint = redis_semaphore('oai-endpoint-' + urlparse(source.endpoint).netloc,
+                               settings.OAI_MAX_HARVESTS_PER_ENDPOINT, timeout=24*3600)
+    token = endpoint.acquire(blocking=False)
+    if token is None:
+        if self.request.retries >= self.max_retries:
+            logger.warning('Endpoint of {} still busy, dropping this harvest'.format(source.identifier))
+            return
+        logger.info('Endpoint of {} busy, retrying later'.format(source.identifier))
+        raise self.retry(countdown=10*60)
+    try:
+        db_writers = redis_semaphore('oai-db-writers', settings.OAI_MAX_DB_WRITERS)
+        oai = OaiPaperSource(source, db_writers=db_writers)
+        oai.update(metadataPrefix='base_dc')
+    finally:
+        endpoint.release(token)
@@ -3,6 +3,8 @@ import pytest
 import responses
 import zipfile
 
+from mock import patch
+from oaipmh.client import Client
 from urllib.parse import parse_qs
 from urllib.parse import urlparse
 
@@ -155,6 +157,28 @@ def rsps_fetch_day(requests_mocker):
     return requests_mocker
 
 
+@pytest.fixture
+def oai_endpoint(dummy_oaisource):
+    """
+    Mocks an OAI-PMH endpoint for the dummy OaiSource, serving two pages
+    of ListRecords results. Any resumption token other than the one of
+    the second page is rejected as expired.
+    Returns the mock of the request method.
+    """
+    dummy_oaisource.endpoint = 'https://example.org/oai'
+    dummy_oaisource.save()
+    data_dir = os.path.join(settings.BASE_DIR, 'backend', 'tests', 'data', 'list_records')
+
+    def make_request(**kwargs):
+        token = kwargs.get('resumptionToken')
+        f_name = {None: 'page1.xml', 'page2': 'page2.xml'}.get(token, 'bad_token.xml')
+        with open(os.path.join(data_dir, f_name), 'rb') as f:
+            return f.read()
+
+    with patch.object(Client, 'makeRequest', side_effect=make_request) as mock:
+        yield mock
+
+
 @pytest.fixture
 def researcher_lesot(django_user_model):
     """
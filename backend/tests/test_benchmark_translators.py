@@ -0,0 +1,32 @@
+import gzip
+import os
+import shutil
+
+from django.core.management import call_command
+
+data_dir = os.path.join(os.path.dirname(__file__), 'data')
+
+# These tests do not use the database: pytest-django makes them fail
+# if the command tries to access it
+
+
+def test_benchmark_oai(tmpdir, capsys):
+    for f_name in ['page1.xml', 'page2.xml']:
+        with open(os.path.join(data_dir, 'list_records', f_name), 'rb') as f_in:
+            with gzip.open(str(tmpdir.join(f_name + '.gz')), 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+
+    call_command('benchmark_translators', str(tmpdir), format='oai_dc', source='hal')
+    out = capsys.readouterr().out
+    assert 'Records: 4' in out
+    assert 'translated' in out
+    assert 'deleted' in out
+    assert 'Hotspots' in out
+
+
+def test_benchmark_citeproc(capsys):
+    call_command('benchmark_translators', os.path.join(data_dir, 'sample_crossref_dump.json.bz2'),
+                 format='citeproc', hotspots=0, limit=5)
+    out = capsys.readouterr().out
+    assert 'Records: 5' in out
+    assert 'Hotspots' not in out
@@ -1,5 +1,7 @@
+import json
 import os
 import pytest
+import requests
 import responses
 
 from datetime import date
@@ -22,9 +24,11 @@ from backend.citeproc import CiteprocTitleError
 from backend.citeproc import Citeproc
 from backend.citeproc import CrossRef
 from backend.citeproc import DOIResolver
+from dissemin.settings import redis_client
 from papers.baremodels import BareName
 from papers.doi import doi_to_crossref_identifier
 from papers.doi import doi_to_url
+from papers.models import HarvestedDay
 from papers.models import OaiRecord
 from papers.models import OaiSource
 from papers.models import Paper
@@ -277,6 +281,18 @@ class TestCiteproc():
         assert r['splash_url'] == doi_to_url(citeproc['DOI'])
         assert r['volume'] == citeproc['volume']
 
+    def test_parse_oairecord_data(self, container_title, issn, citeproc):
+        """
+        Same as _get_oairecord_data, without database lookups
+        """
+        r = self.test_class._parse_oairecord_data(citeproc)
+        assert r['doi'] == citeproc['DOI']
+        assert r['issn'] == issn
+        assert r['journal_title'] == container_title
+        assert 'journal' not in r
+        assert 'publisher' not in r
+        assert 'source' not in r
+
     @pytest.mark.usefixtures('db', 'mock_journal_find', 'mock_publisher_find')
     def test_get_oairecord_data_missing(self, monkeypatch, container_title, issn, citeproc):
         """
@@ -539,6 +555,41 @@ class TestCrossRef(TestCiteproc):
         source.refresh_from_db()
         assert source.last_update.date() == timezone.now().date() - timedelta(days=1)
 
+    @pytest.mark.usefixtures('db')
+    def test_fetch_latest_records_failed_day(self, monkeypatch):
+        """
+        The source date only advances up to the day that failed, which is fetched again on the next run
+        """
+        today = date.today()
+        failed_day = today - timedelta(days=4)
+
+        def ret_func(day):
+            if day == failed_day:
+                raise requests.exceptions.ConnectionError()
+
+        monkeypatch.setattr(self.test_class, '_fetch_day', ret_func)
+        monkeypatch.setattr(self.test_class, 'concurrent_days', 1)
+
+        source = OaiSource.objects.get(identifier='crossref')
+        source.last_update = timezone.now() - timedelta(days=8)
+        source.save()
+        self.test_class.fetch_latest_records()
+        source.refresh_from_db()
+        assert source.last_update.date() == failed_day - timedelta(days=1)
+        assert not HarvestedDay.objects.filter(source=source, day=failed_day).exists()
+
+        # The next run only fetches the failed day
+        fetched = []
+        monkeypatch.setattr(self.test_class, '_fetch_day', fetched.append)
+        HarvestedDay.objects.bulk_create([
+            HarvestedDay(source=source, day=today - timedelta(days=i)) for i in range(1, 4)
+        ])
+        self.test_class.fetch_latest_records()
+        source.refresh_from_db()
+        assert fetched == [failed_day]
+        assert source.last_update.date() == today - timedelta(days=1)
+        assert HarvestedDay.objects.filter(source=source).count() == 0
+
     @responses.activate
     @pytest.mark.usefixtures('db')
     def test_fetch_batch(self):
@@ -606,6 +657,32 @@ class TestCrossRef(TestCiteproc):
         papers = self.test_class.fetch_batch(dois)
         assert papers[2] is None
 
+    @responses.activate
+    @pytest.mark.usefixtures('db')
+    def test_fetch_batch_concurrent(self, monkeypatch):
+        """
+        Batches are fetched concurrently, the result is still aligned with the DOIs, and failing batches give None
+        """
+        f_path = os.path.join(settings.BASE_DIR, 'backend', 'tests', 'data', 'crossref_batch.json')
+        with open(f_path, 'r') as f:
+            items = {item['DOI'] : item for item in json.load(f)['message']['items']}
+
+        def request_callback(request):
+            query = parse_qs(urlparse(request.url).query)
+            doi = query['filter'][0].split(':', 1)[1].lower()
+            if doi not in items:
+                return (500, {}, '')
+            return (200, {}, json.dumps({'message' : {'items' : [items[doi]]}}))
+
+        responses.add_callback(responses.GET, 'https://api.crossref.org/works', callback=request_callback)
+        monkeypatch.setattr(self.test_class, 'batch_length', 1)
+        dois = ['10.1109/sYnAsc.2010.88', '10.spanish/inquisition', '10.1016/j.gsd.2018.08.007']
+        papers = self.test_class.fetch_batch(dois)
+        assert len(responses.calls) == 3
+        assert papers[0].get_doi() == dois[0].lower()
+        assert papers[1] is None
+        assert papers[2].get_doi() == dois[2]
+
     @pytest.mark.usefixtures('db', 'mock_crossref')
     def test_fetch_batch_doi_with_backslash(self):
         """
@@ -635,6 +712,7 @@ class TestCrossRef(TestCiteproc):
             assert date_filter + ':{}'.format(day) in query_f
         assert query['rows'][0] == str(self.test_class.rows)
         assert query['mailto'][0] == settings.CROSSREF_MAILTO
+        assert query['select'][0].split(',') == self.test_class.selected_fields
 
     @pytest.mark.usefixtures('db')
     def test_fetch_day_citeproc_error(self, monkeypatch, rsps_fetch_day):
@@ -659,6 +737,18 @@ class TestCrossRef(TestCiteproc):
         self.test_class._fetch_day(day)
 
 
+    def test_read_page(self):
+        """
+        The header of a page is read without its items, which are decoded one by one
+        """
+        items = [{'DOI' : '10.1016/j.gsd.2018.08.007', 'score' : 1.5}, {'DOI' : '10.1109/synasc.2010.88'}]
+        content = json.dumps({'message' : {'items' : items, 'total-results' : 2, 'next-cursor' : 'abc'}}).encode('utf-8')
+        assert self.test_class._read_page_header(content) == (2, 'abc', True)
+        assert list(self.test_class._read_page_items(content)) == items
+
+        content = json.dumps({'message' : {'total-results' : 2, 'items' : []}}).encode('utf-8')
+        assert self.test_class._read_page_header(content) == (2, None, False)
+
     def test_filter_dois_by_comma(self):
         """
         Tests filtering of DOIs wheter they have a ',' or not
@@ -744,3 +834,51 @@ class TestDOI(TestCiteproc):
         q = self.test_class.save_doi(doi)
 
         assert p == q
+
+    @pytest.mark.usefixtures('db')
+    def test_save_dois(self, mock_doi, django_assert_num_queries):
+        """
+        Must save the papers, and only check with one query that they are up to date afterwards
+        """
+        dois = ['10.1016/j.gsd.2018.08.007', '10.1109/sYnAsc.2010.88']
+        papers = self.test_class.save_dois(dois)
+        for paper, doi in zip(papers, dois):
+            assert paper.get_doi() == doi.lower()
+        nb_calls = len(mock_doi.calls)
+        with django_assert_num_queries(1):
+            assert self.test_class.save_dois(dois) == papers
+        assert len(mock_doi.calls) == nb_calls
+
+    @pytest.mark.usefixtures('db')
+    def test_save_dois_invalid_paper(self, mock_doi, monkeypatch):
+        """
+        A DOI whose paper cannot be saved does not prevent saving the others
+        """
+        dois = ['10.1016/j.gsd.2018.08.007', '10.1109/sYnAsc.2010.88']
+        to_paper = self.test_class.to_paper
+
+        def invalid_first_doi(data):
+            if data['DOI'].lower() == dois[0].lower():
+                raise ValueError('Invalid paper')
+            return to_paper(data)
+        monkeypatch.setattr(self.test_class, 'to_paper', invalid_first_doi)
+        papers = self.test_class.save_dois(dois)
+        assert papers[0] is None
+        assert papers[1].get_doi() == dois[1].lower()
+
+    @pytest.mark.usefixtures('db')
+    def test_save_doi_not_found(self, mock_doi, settings):
+        """
+        A DOI which is not found is not requested again
+        """
+        settings.DOI_NEGATIVE_CACHE_DURATION = timedelta(minutes=1)
+        doi = '10.spanish/inquisition'
+        try:
+            with pytest.raises(requests.exceptions.HTTPError):
+                self.test_class.save_doi(doi)
+            with pytest.raises(CiteprocDOIError):
+                self.test_class.save_doi(doi)
+            assert self.test_class.save_dois([doi]) == [None]
+            assert len(mock_doi.calls) == 1
+        finally:
+            redis_client.delete(self.test_class.negative_cache_prefix + doi)
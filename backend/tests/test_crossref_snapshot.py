@@ -0,0 +1,64 @@
+import gzip
+import json
+import os
+import pytest
+
+from django.conf import settings
+
+from backend.crossref_snapshot import CrossRefSnapshot
+from backend.crossref_snapshot import snapshot_files
+from papers.models import Paper
+
+
+@pytest.fixture
+def snapshot_items():
+    f_path = os.path.join(settings.BASE_DIR, 'backend', 'tests', 'data', 'crossref_batch.json')
+    with open(f_path, 'r') as f:
+        return json.load(f)['message']['items']
+
+
+@pytest.fixture
+def snapshot_dir(tmpdir, snapshot_items):
+    """
+    A snapshot of two files, the first one holding the items of crossref_batch.json and
+    an invalid item, the second one being empty
+    """
+    with gzip.open(str(tmpdir.join('0.json.gz')), 'wt') as f:
+        json.dump({'items': snapshot_items[:1] + [{'DOI': 'invalid'}] + snapshot_items[1:]}, f)
+    with gzip.open(str(tmpdir.join('1.json.gz')), 'wt') as f:
+        json.dump({'items': []}, f)
+    return str(tmpdir)
+
+
+def test_snapshot_files(tmpdir):
+    for name in ['10.json.gz', '2.json.gz', '1.json.gz', 'README']:
+        tmpdir.join(name).write('')
+    assert snapshot_files(str(tmpdir)) == ['1.json.gz', '2.json.gz', '10.json.gz']
+
+
+def test_read_snapshot(snapshot_dir):
+    snapshot = CrossRefSnapshot()
+    snapshot.batch_size = 2
+    batches = list(snapshot.read_snapshot(snapshot_dir))
+    assert [(name, offset, len(items)) for name, offset, items in batches] == [('0.json.gz', 0, 2), ('0.json.gz', 2, 1)]
+    batches = list(snapshot.read_snapshot(snapshot_dir, '0.json.gz', 1))
+    assert [(name, offset, len(items)) for name, offset, items in batches] == [('0.json.gz', 1, 2)]
+
+
+@pytest.mark.usefixtures('db')
+def test_load_snapshot(snapshot_dir, tmpdir, snapshot_items):
+    checkpoint = str(tmpdir.join('checkpoint.json'))
+    CrossRefSnapshot().load_snapshot(snapshot_dir, checkpoint=checkpoint)
+    for item in snapshot_items:
+        assert Paper.get_by_doi(item['DOI']) is not None
+    with open(checkpoint, 'r') as f:
+        assert json.load(f) == {'file': '0.json.gz', 'offset': 3}
+
+
+@pytest.mark.usefixtures('db')
+def test_load_snapshot_resume(snapshot_dir, tmpdir, snapshot_items):
+    checkpoint = str(tmpdir.join('checkpoint.json'))
+    CrossRefSnapshot.save_checkpoint(checkpoint, '0.json.gz', 1)
+    CrossRefSnapshot().load_snapshot(snapshot_dir, checkpoint=checkpoint)
+    assert Paper.get_by_doi(snapshot_items[0]['DOI']) is None
+    assert Paper.get_by_doi(snapshot_items[1]['DOI']) is not None
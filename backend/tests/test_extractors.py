@@ -0,0 +1,105 @@
+import glob
+import os
+import pytest
+import re
+
+from time import perf_counter
+
+from lxml import etree
+
+from backend.extractors import REGISTERED_OAI_EXTRACTORS
+from backend.extractors import RegexExtractor
+from backend.extractors import baseExtractor
+from backend.extractors import defaultExtractor
+from backend.oaireader import base_dc_streaming_reader
+
+data_dir = os.path.join(os.path.dirname(__file__), 'data')
+
+
+def reference_urls(mappings, metadata):
+    """
+    The URLs found by trying each mapping on each value in turn
+    """
+    urls = dict()
+    for (field, regex, resource_type, skeleton) in mappings:
+        for val in metadata[field]:
+            val = val.strip()
+            if regex.match(val):
+                urls[resource_type] = regex.sub(skeleton, val)
+    return urls
+
+
+def fixture_metadata():
+    """
+    The metadata maps of the base_dc records of the test data
+    """
+    maps = []
+    for path in sorted(glob.glob(os.path.join(data_dir, 'ft*.xml'))):
+        tree = etree.parse(path)
+        for element in tree.iter('{http://www.openarchives.org/OAI/2.0/}metadata'):
+            maps.append(base_dc_streaming_reader(element).getMap())
+    return maps
+
+
+VALUES = [
+    'http://arxiv.org/abs/1234.5678',
+    'https://hal.archives-ouvertes.fr/hal-01062241/document',
+    'http://www.cairn.info/article.php?ID_ARTICLE=RFS_521_0005',
+    'http://www.ncbi.nlm.nih.gov/pubmed/24806729',
+    'https://www.ncbi.nlm.nih.gov/pmc/articles/PMC1968744/',
+    'https://doaj.org/article/0123 extra',
+    'http://www.numdam.org/item?id=AIF_1 http://www.numdam.org/item?id=AIF_2',
+    'https://zenodo.org/record/1234',
+    '  https://example.org/paper.pdf ',
+    'doi:10.1007/s10858-015-9994-8',
+]
+
+
+class TestRegexExtractor:
+
+    @pytest.mark.parametrize('name', sorted(REGISTERED_OAI_EXTRACTORS))
+    def test_same_urls_as_reference(self, name):
+        extractor = REGISTERED_OAI_EXTRACTORS[name]
+        metadata_list = [{field: VALUES[i:] + VALUES[:i] for field in ['identifier', 'relation', 'source', 'link']}
+                         for i in range(len(VALUES))]
+        for metadata in metadata_list + fixture_metadata():
+            extractor.metadata = metadata
+            assert extractor._urls() == reference_urls(extractor.mappings, metadata)
+
+    def test_later_mappings_take_precedence(self):
+        extractor = defaultExtractor
+        extractor.metadata = {'source': ['http://a.org/', 'http://b.org/']}
+        assert extractor._urls() == {'splash': 'http://b.org/'}
+
+    def test_incompatible_regexes(self):
+        extractor = RegexExtractor([
+            ('identifier', re.compile(r'(?P<id>http://.*)'), 'splash', r'\1'),
+            ('identifier', re.compile(r'(?P<id>http://.*\.pdf)'), 'pdf', r'\g<id>'),
+        ])
+        assert extractor.combined['identifier'] is None
+        extractor.metadata = {'identifier': ['http://a.org/b.pdf']}
+        assert extractor._urls() == {'splash': 'http://a.org/b.pdf', 'pdf': 'http://a.org/b.pdf'}
+
+
+@pytest.mark.benchmark
+def test_extractor_throughput():
+    """
+    Compares the compiled extractors with the reference implementation
+    """
+    metadata_list = fixture_metadata() * 500
+    for extractor, reference in [
+            (baseExtractor, lambda m: reference_urls(baseExtractor.mappings, m)),
+            (REGISTERED_OAI_EXTRACTORS['pmc'], lambda m: reference_urls(REGISTERED_OAI_EXTRACTORS['pmc'].mappings, m))]:
+        start = perf_counter()
+        for metadata in metadata_list:
+            reference(metadata)
+        reference_time = perf_counter() - start
+
+        start = perf_counter()
+        for metadata in metadata_list:
+            extractor.metadata = metadata
+            extractor._urls()
+        compiled_time = perf_counter() - start
+
+        print('{} records: reference {:.0f} records/s, compiled {:.0f} records/s'.format(
+            len(metadata_list), len(metadata_list) / reference_time, len(metadata_list) / compiled_time))
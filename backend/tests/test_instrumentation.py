@@ -0,0 +1,55 @@
+import pytest
+
+from backend.instrumentation import FETCH
+from backend.instrumentation import IngestMetrics
+from backend.instrumentation import PARSE
+from backend.instrumentation import active_metrics
+from backend.instrumentation import ingest_stage
+from backend.instrumentation import prometheus_text
+from backend.instrumentation import read_counters
+from backend.instrumentation import reset_counters
+
+
+@pytest.fixture(autouse=True)
+def no_redis(monkeypatch):
+    monkeypatch.setattr('backend.utils.get_redis_client', lambda: None)
+
+
+class TestIngestMetrics:
+
+    def test_record(self):
+        metrics = IngestMetrics('base')
+        metrics.record(FETCH, 1.5)
+        metrics.record(FETCH, 0.5, count=2)
+        assert metrics.as_dict() == {FETCH: {'seconds': 2., 'count': 3}}
+
+    def test_ingest_stage(self):
+        metrics = IngestMetrics('base')
+        with ingest_stage(FETCH):
+            pass
+        assert metrics.as_dict() == {}
+        with metrics.activate():
+            assert active_metrics() is metrics
+            with ingest_stage(PARSE, count=10):
+                pass
+        assert active_metrics() is None
+        assert metrics.as_dict()[PARSE]['count'] == 10
+
+    def test_stage_exception(self):
+        metrics = IngestMetrics('base')
+        with pytest.raises(ValueError):
+            with metrics.stage(PARSE):
+                raise ValueError
+        assert metrics.as_dict()[PARSE]['count'] == 1
+
+
+def test_prometheus_text():
+    text = prometheus_text({'base': {FETCH: {'seconds': 2.5, 'count': 3}}})
+    assert '# TYPE dissemin_ingest_stage_seconds_total counter' in text
+    assert 'dissemin_ingest_stage_seconds_total{source="base",stage="fetch"} 2.5' in text
+    assert 'dissemin_ingest_stage_items_total{source="base",stage="fetch"} 3' in text
+
+
+def test_counters_without_redis():
+    reset_counters()
+    assert read_counters() == {}
@@ -0,0 +1,60 @@
+import pytest
+
+from backend.lookups import LookupCache
+from backend.lookups import active_lookup_cache
+from backend.lookups import find_journal
+from backend.lookups import find_publisher
+from backend.lookups import get_oaisource
+from papers.models import OaiSource
+from publishers.models import Journal
+from publishers.models import Publisher
+
+
+class TestLookupCache:
+    """
+    Tests the caches of lookups per batch
+    """
+
+    def test_activate(self):
+        cache = LookupCache()
+        assert active_lookup_cache() is None
+        with cache.activate():
+            assert active_lookup_cache() is cache
+            with LookupCache().activate():
+                assert active_lookup_cache() is not cache
+            assert active_lookup_cache() is cache
+        assert active_lookup_cache() is None
+
+    @pytest.mark.usefixtures('db')
+    def test_get_oaisource(self, django_assert_num_queries):
+        with LookupCache().activate():
+            source = get_oaisource('crossref')
+            assert source == OaiSource.objects.get(identifier='crossref')
+            with django_assert_num_queries(0):
+                assert get_oaisource('crossref') == source
+
+    @pytest.mark.usefixtures('db')
+    def test_find_journal(self, dummy_publisher, django_assert_num_queries):
+        journal = Journal.objects.create(title='Slackline Review', issn='4353-2894', publisher=dummy_publisher)
+        with LookupCache().activate():
+            assert find_journal(issn='4353-2894', title='Slackline Review') == journal
+            assert find_journal(issn=None, title='slackline review') == journal
+            with django_assert_num_queries(0):
+                assert find_journal(issn='4353-2894', title='Slackline Review') == journal
+                assert find_journal(issn=None, title='Slackline review') == journal
+
+    @pytest.mark.usefixtures('db')
+    def test_find_journal_invalidated(self, dummy_publisher):
+        with LookupCache().activate():
+            assert find_journal(issn='4353-2894', title='Slackline Review') is None
+            journal = Journal.objects.create(title='Slackline Review', issn='4353-2894', publisher=dummy_publisher)
+            assert find_journal(issn='4353-2894', title='Slackline Review') == journal
+
+    @pytest.mark.usefixtures('db')
+    def test_find_publisher(self, django_assert_num_queries):
+        with LookupCache().activate():
+            assert find_publisher('Slackline Press') is None
+            with django_assert_num_queries(0):
+                assert find_publisher('Slackline Press') is None
+            publisher = Publisher.objects.create(name='Slackline Press')
+            assert find_publisher('Slackline Press') == publisher
@@ -1,9 +1,13 @@
+import json
 import os
 import pytest
+import tempfile
 
 import django.test
+from mock import patch
 
 from backend.oadoi import OadoiAPI
+from papers.models import OadoiDigest
 from papers.models import Paper
 
 @pytest.mark.usefixtures("load_test_data")
@@ -28,3 +32,82 @@ class OadoiAPITest(django.test.TestCase):
         # the paper is now OA, yay!
         p = Paper.get_by_doi(doi)
         self.assertEqual(p.pdf_url, 'http://europepmc.org/articles/pmc5718814?pdf=render')
+
+    def test_read_dump_checkpoint(self):
+        oadoi = OadoiAPI()
+        oadoi.checkpoint_every = 2
+        dump = os.path.join(self.testdir, 'data/sample_unpaywall_snapshot.jsonl.gz')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            checkpoint = os.path.join(tmpdir, 'checkpoint.json')
+            records = list(oadoi.read_dump(dump, checkpoint=checkpoint))
+            with open(checkpoint, 'r') as f:
+                position = json.load(f)
+            last_line = 2 * ((len(records) - 1) // 2)
+            self.assertEqual(position['line'], last_line)
+            self.assertEqual(position['doi'], records[last_line]['doi'])
+
+            # Resuming starts from the record saved in the checkpoint
+            self.assertEqual(list(oadoi.read_dump(dump, checkpoint=checkpoint)), records[last_line:])
+
+    def test_read_chunks(self):
+        oadoi = OadoiAPI()
+        oadoi.chunk_size = 3
+        dump = os.path.join(self.testdir, 'data/sample_unpaywall_snapshot.jsonl.gz')
+        chunks = list(oadoi.read_chunks(dump))
+        self.assertEqual([len(records) for records, _ in chunks], [3, 3, 3, 1])
+        self.assertEqual([position and position['line'] for _, position in chunks], [3, 6, 9, None])
+        self.assertEqual(chunks[1][0][0]['doi'], chunks[0][1]['doi'])
+
+    @pytest.mark.usefixtures('mock_doi')
+    def test_load_chunk(self):
+        doi = '10.1080/21645515.2017.1330236'
+        Paper.create_by_doi(doi)
+
+        oadoi = OadoiAPI()
+        dump = os.path.join(self.testdir, 'data/sample_unpaywall_snapshot.jsonl.gz')
+        oadoi.load_chunk(list(oadoi.read_dump(dump)), create_missing_dois=False)
+
+        p = Paper.get_by_doi(doi)
+        self.assertEqual(p.pdf_url, 'http://europepmc.org/articles/pmc5718814?pdf=render')
+
+    def test_load_chunk_in_worker_without_metrics(self):
+        oadoi = OadoiAPI()
+        position = {'line': 3, 'doi': '10.1080/21645515.2017.1330236'}
+        self.assertEqual(oadoi.load_chunk_in_worker(([], position), False, False), position)
+
+    @pytest.mark.usefixtures('mock_doi')
+    def test_skip_unchanged(self):
+        doi = '10.1080/21645515.2017.1330236'
+        Paper.create_by_doi(doi)
+        oadoi = OadoiAPI()
+        dump = os.path.join(self.testdir, 'data/sample_unpaywall_snapshot.jsonl.gz')
+        oadoi.load_dump(dump, create_missing_dois=False)
+        self.assertTrue(OadoiDigest.objects.filter(doi=doi).exists())
+
+        # The locations of the DOI did not change
+        with patch.object(OadoiAPI, 'add_locations') as add_locations:
+            oadoi.load_dump(dump, create_missing_dois=False)
+            oadoi.load_chunk(list(oadoi.read_dump(dump)), create_missing_dois=False)
+        add_locations.assert_not_called()
+
+        OadoiDigest.objects.filter(doi=doi).update(digest='changed')
+        with patch.object(OadoiAPI, 'add_locations', return_value=(False, True)) as add_locations:
+            oadoi.load_chunk(list(oadoi.read_dump(dump)), create_missing_dois=False)
+        self.assertEqual(add_locations.call_count, 1)
+        self.assertNotEqual(OadoiDigest.objects.get(doi=doi).digest, 'changed')
+
+    @pytest.mark.usefixtures('mock_doi')
+    def test_digest_after_failed_locations(self):
+        """
+        The digest is not saved if some locations could not be added,
+        so that the DOI is loaded again
+        """
+        doi = '10.1080/21645515.2017.1330236'
+        Paper.create_by_doi(doi)
+        oadoi = OadoiAPI()
+        records = list(oadoi.read_dump(os.path.join(self.testdir, 'data/sample_unpaywall_snapshot.jsonl.gz')))
+        with patch.object(OadoiAPI, 'add_locations', return_value=(False, False)):
+            oadoi.load_chunk(records, create_missing_dois=False)
+        self.assertFalse(OadoiDigest.objects.filter(doi=doi).exists())
+        oadoi.load_chunk(records, create_missing_dois=False)
+        self.assertTrue(OadoiDigest.objects.filter(doi=doi).exists())
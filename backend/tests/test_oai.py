@@ -21,11 +21,17 @@
 
 
 import codecs
+import hashlib
 import os
 import pytest
+import pytz
 import unittest
 
+from celery.exceptions import Retry
+from datetime import datetime
 from mock import patch
+from oaipmh.common import Header
+from oaipmh.common import Metadata
 from oaipmh.error import CannotDisseminateFormatError
 from oaipmh.error import IdDoesNotExistError
 from oaipmh.client import Client
@@ -33,11 +39,39 @@ from oaipmh.client import Client
 from django.test import TestCase
 
 from backend.oai import OaiPaperSource
+from backend.tasks import update_oai_source
+from backend.utils import redis_semaphore
 from papers.models import OaiRecord
 from papers.models import OaiSource
 from papers.models import Paper
 
 
+def synthetic_records(prefix, count):
+    """
+    Generates simple base_dc records, as returned by pyoai
+    """
+    words = ['labyrinth', 'library', 'garden', 'mirror', 'tiger', 'compass']
+    for i in range(count):
+        title = 'The {} of the {} ({}-{})'.format(
+            words[i % len(words)], words[(i // len(words)) % len(words)], prefix, i)
+        header = Header(None, 'oai:{}:{}'.format(prefix, i), datetime(2019, 10, 10), [], False)
+        metadata = Metadata(None, {
+            'title': [title],
+            'creator': ['Quain, Herbert', 'Borges, Jorge Luis'],
+            'date': ['2019-10-10'],
+            'description': ['A detective story'],
+            'subject': [],
+            'contributor': [],
+            'type': ['article'],
+            'identifier': ['https://example.com/{}/{}'.format(prefix, i)],
+            'relation': [],
+            'source': [],
+            'link': [],
+            'oa': ['1'],
+        })
+        yield header, metadata, None
+
+
 class OaiTest(TestCase):
 
     def setUp(self):
@@ -310,3 +344,207 @@ class OaiTest(TestCase):
                 'ftdatacite:oai:oai.datacite.org:3505359',
                 'base_dc')
         self.assertTrue(paper.pdf_url is not None)
+
+    def test_save_batch(self):
+        """
+        Records are inserted in bulk
+        """
+        records = list(synthetic_records('batch', 10))
+        batch = [(h, self.base_oai.translate_record(h, m._map, 'base_dc')) for h, m, _ in records]
+        self.base_oai.save_batch(batch)
+        for header, _, _ in records:
+            record = OaiRecord.objects.get(identifier=header.identifier())
+            self.assertEqual(len(record.about.oairecords), 1)
+            self.assertEqual(record.about.fingerprint, record.about.new_fingerprint())
+            self.assertEqual(record.priority, record.source.priority)
+
+    def test_save_batch_collisions(self):
+        """
+        Records which match existing papers are merged, also within the batch
+        """
+        header, metadata, _ = next(synthetic_records('collision', 1))
+        first = self.base_oai.process_record(header, metadata._map, 'base_dc')
+
+        # same identifier as an existing record
+        batch = [(header, self.base_oai.translate_record(header, metadata._map, 'base_dc'))]
+        # same fingerprint as an existing paper and as the next one in the batch
+        for i in range(2):
+            header = Header(None, 'oai:other:{}'.format(i), datetime(2019, 10, 10), [], False)
+            metadata._map['identifier'] = ['https://example.org/{}'.format(i)]
+            batch.append((header, self.base_oai.translate_record(header, metadata._map, 'base_dc')))
+        self.base_oai.save_batch(batch)
+
+        self.assertEqual(Paper.objects.filter(fingerprint=first.fingerprint).count(), 1)
+        first.cache_oairecords()
+        self.assertEqual(len(first.oairecords), 3)
+
+    def test_save_batch_concurrent_insert(self):
+        """
+        A record inserted by another process after the collisions were
+        checked makes the batch be saved record by record
+        """
+        records = list(synthetic_records('concurrent', 3))
+        batch = [(h, self.base_oai.translate_record(h, m._map, 'base_dc')) for h, m, _ in records]
+        header, metadata, _ = records[0]
+        bulk_create = OaiRecord.objects.bulk_create
+
+        def concurrent_bulk_create(objs, *args, **kwargs):
+            self.base_oai.process_record(header, metadata._map, 'base_dc')
+            return bulk_create(objs, *args, **kwargs)
+
+        with patch.object(OaiRecord.objects, 'bulk_create', side_effect=concurrent_bulk_create):
+            self.base_oai.save_batch(batch)
+        for header, _, _ in records:
+            self.assertEqual(OaiRecord.objects.filter(identifier=header.identifier()).count(), 1)
+
+
+@pytest.mark.usefixtures('db')
+class TestOaiHarvest():
+    """
+    Harvesting of a whole source, with checkpoints
+    """
+
+    identifiers = [
+        'oai:example.org:quain-1933',
+        'oai:example.org:quain-1936',
+        'oai:example.org:quain-1939',
+    ]
+
+    def test_update(self, oai_endpoint, dummy_oaisource):
+        OaiPaperSource(dummy_oaisource).update()
+        for identifier in self.identifiers:
+            assert OaiRecord.objects.filter(identifier=identifier).exists()
+        dummy_oaisource.refresh_from_db()
+        assert dummy_oaisource.resumption_token is None
+        assert dummy_oaisource.last_datestamp is None
+        assert dummy_oaisource.last_update.year > 1970
+
+    @pytest.mark.parametrize('batch_size', [None, 2])
+    def test_update_translation_workers(self, oai_endpoint, dummy_oaisource, batch_size):
+        OaiPaperSource(dummy_oaisource, batch_size=batch_size, translation_workers=2).update()
+        for identifier in self.identifiers:
+            assert OaiRecord.objects.filter(identifier=identifier).exists()
+
+    def test_update_checkpoints(self, monkeypatch, oai_endpoint, dummy_oaisource):
+        checkpoints = []
+        oai = OaiPaperSource(dummy_oaisource)
+        oai.checkpoint_every = 1
+        monkeypatch.setattr(oai, 'save_checkpoint', lambda token, datestamp: checkpoints.append((token, datestamp)))
+        oai.update()
+        assert checkpoints == [
+            ('page2', datetime(2019, 10, 11, 10, 0)),
+            (None, datetime(2019, 10, 12, 7, 30)),
+        ]
+
+    def test_save_checkpoint(self, dummy_oaisource):
+        oai = OaiPaperSource(dummy_oaisource)
+        oai.save_checkpoint('page2', datetime(2019, 10, 11, 10, 0))
+        oai.save_checkpoint('page3', datetime(2019, 10, 10, 10, 0))
+        dummy_oaisource.refresh_from_db()
+        assert dummy_oaisource.resumption_token == 'page3'
+        assert dummy_oaisource.last_datestamp == datetime(2019, 10, 11, 10, 0, tzinfo=pytz.UTC)
+
+    def test_update_resumes(self, oai_endpoint, dummy_oaisource):
+        dummy_oaisource.resumption_token = 'page2'
+        dummy_oaisource.save()
+        OaiPaperSource(dummy_oaisource).update()
+        assert oai_endpoint.call_args_list[0][1] == {'verb': 'ListRecords', 'resumptionToken': 'page2'}
+        assert not OaiRecord.objects.filter(identifier=self.identifiers[0]).exists()
+        assert OaiRecord.objects.filter(identifier=self.identifiers[2]).exists()
+
+    def test_update_expired_token(self, oai_endpoint, dummy_oaisource):
+        dummy_oaisource.resumption_token = 'expired'
+        dummy_oaisource.last_datestamp = datetime(2019, 10, 11, tzinfo=pytz.UTC)
+        dummy_oaisource.save()
+        OaiPaperSource(dummy_oaisource).update()
+        assert oai_endpoint.call_args_list[1][1] == {
+            'verb': 'ListRecords',
+            'metadataPrefix': 'oai_dc',
+            'from': '2019-10-11T00:00:00Z',
+        }
+        dummy_oaisource.refresh_from_db()
+        assert dummy_oaisource.resumption_token is None
+
+    def test_capture_and_replay(self, tmpdir, oai_endpoint, dummy_oaisource):
+        capture_dir = str(tmpdir.join('capture'))
+        OaiPaperSource(dummy_oaisource, capture_dir=capture_dir).update()
+        assert sorted(os.listdir(capture_dir)) == [
+            'first-oai_dc.xml.gz',
+            'token-%s.xml.gz' % hashlib.sha1(b'page2').hexdigest(),
+        ]
+
+        Paper.objects.all().delete()
+        calls = oai_endpoint.call_count
+        OaiPaperSource(dummy_oaisource, replay_dir=capture_dir).replay()
+        assert oai_endpoint.call_count == calls
+        for identifier in self.identifiers:
+            assert OaiRecord.objects.filter(identifier=identifier).exists()
+
+    def test_replay_keeps_harvest_state(self, tmpdir, oai_endpoint, dummy_oaisource):
+        capture_dir = str(tmpdir.join('capture'))
+        OaiPaperSource(dummy_oaisource, capture_dir=capture_dir).update()
+        dummy_oaisource.refresh_from_db()
+        last_update = dummy_oaisource.last_update
+
+        OaiPaperSource(dummy_oaisource, replay_dir=capture_dir).update()
+        dummy_oaisource.refresh_from_db()
+        assert dummy_oaisource.last_update == last_update
+        assert dummy_oaisource.resumption_token is None
+
+    def test_capture_into_non_empty_dir(self, tmpdir, dummy_oaisource):
+        tmpdir.join('first-oai_dc.xml.gz').write('')
+        with pytest.raises(ValueError):
+            OaiPaperSource(dummy_oaisource, capture_dir=str(tmpdir))
+
+    def test_replay_other_verbs(self, tmpdir, dummy_oaisource):
+        oai = OaiPaperSource(dummy_oaisource, replay_dir=str(tmpdir))
+        with pytest.raises(ValueError):
+            oai.client.makeRequest(verb='Identify')
+
+    def test_update_oai_source_task(self, oai_endpoint, dummy_oaisource):
+        update_oai_source(pk=dummy_oaisource.pk)
+        for identifier in self.identifiers:
+            assert OaiRecord.objects.filter(identifier=identifier).exists()
+
+    def test_update_oai_source_task_busy_endpoint(self, settings, oai_endpoint, dummy_oaisource):
+        settings.OAI_MAX_HARVESTS_PER_ENDPOINT = 1
+        endpoint = redis_semaphore('oai-endpoint-example.org', 1)
+        token = endpoint.acquire()
+        try:
+            with pytest.raises(Retry):
+                update_oai_source(pk=dummy_oaisource.pk)
+        finally:
+            endpoint.release(token)
+        assert not oai_endpoint.called
+
+    def test_update_oai_source_task_busy_endpoint_gives_up(self, settings, monkeypatch, oai_endpoint, dummy_oaisource):
+        settings.OAI_MAX_HARVESTS_PER_ENDPOINT = 1
+        monkeypatch.setattr(update_oai_source, 'max_retries', 0)
+        endpoint = redis_semaphore('oai-endpoint-example.org', 1)
+        token = endpoint.acquire()
+        try:
+            assert update_oai_source(pk=dummy_oaisource.pk) is None
+        finally:
+            endpoint.release(token)
+        assert not oai_endpoint.called
+
+
+@pytest.mark.benchmark
+@pytest.mark.django_db
+@pytest.mark.parametrize('batch_size', [None, 100, 500])
+def test_process_records_throughput(batch_size):
+    """
+    Compares the record-by-record path with the batched one
+    """
+    source = OaiSource.objects.get(identifier='base')
+    source.endpoint = 'https://some_endpoint'
+    oai = OaiPaperSource(source, batch_size=batch_size)
+    count = 2000
+    records = list(synthetic_records('bench-{}'.format(batch_size), count))
+
+    start = datetime.now()
+    oai.process_records(records, 'base_dc')
+    elapsed = (datetime.now() - start).total_seconds()
+
+    assert OaiRecord.objects.filter(identifier__startswith='oai:bench-{}:'.format(batch_size)).count() == count
+    print('batch_size={}: {:.0f} records/s'.format(batch_size, count / elapsed))
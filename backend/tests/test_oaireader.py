@@ -0,0 +1,76 @@
+import os
+import pytest
+
+from lxml import etree
+from oaipmh.error import BadResumptionTokenError
+from oaipmh.metadata import MetadataRegistry
+from oaipmh.metadata import oai_dc_reader
+
+from backend.oaireader import base_dc_reader
+from backend.oaireader import base_dc_streaming_reader
+from backend.oaireader import oai_dc_streaming_reader
+from backend.oaireader import read_records_page
+from backend.oaireader import StreamingMetadataReader
+
+data_dir = os.path.join(os.path.dirname(__file__), 'data', 'list_records')
+namespaces = {'oai': 'http://www.openarchives.org/OAI/2.0/'}
+
+
+def read_page(f_name):
+    with open(os.path.join(data_dir, f_name), 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture
+def registry():
+    registry = MetadataRegistry()
+    registry.registerReader('oai_dc', oai_dc_streaming_reader)
+    return registry
+
+
+class TestStreamingMetadataReader:
+    """
+    The streaming readers must produce the same maps as the XPath ones
+    """
+
+    def test_oai_dc(self):
+        tree = etree.fromstring(read_page('page1.xml'))
+        for metadata in tree.xpath('//oai:metadata', namespaces=namespaces):
+            assert oai_dc_streaming_reader(metadata).getMap() == oai_dc_reader(metadata).getMap()
+
+    def test_base_dc(self):
+        metadata = etree.fromstring(
+            '<metadata xmlns:base_dc="http://oai.base-search.net/base_dc/" '
+            'xmlns:dc="http://purl.org/dc/elements/1.1/">'
+            '<base_dc:dc><dc:title>On <i>Quain</i> and others</dc:title>'
+            '<dc:creator>Borges, Jorge Luis</dc:creator><dc:creator/>'
+            '<base_dc:oa>1</base_dc:oa><base_dc:typenorm>121</base_dc:typenorm>'
+            '</base_dc:dc></metadata>')
+        assert base_dc_streaming_reader(metadata).getMap() == base_dc_reader(metadata).getMap()
+
+    def test_unsupported_field(self):
+        with pytest.raises(ValueError):
+            StreamingMetadataReader({'title': ('text', 'dc:title')}, {})
+
+
+class TestReadRecordsPage:
+
+    def test_read_records_page(self, registry):
+        records, token = read_records_page(read_page('page2.xml'), 'oai_dc', registry)
+        assert token is None
+        assert [header.identifier() for header, _, _ in records] == [
+            'oai:example.org:quain-1939',
+            'oai:example.org:quain-draft',
+        ]
+        header, metadata, _ = records[1]
+        assert header.isDeleted()
+        assert metadata is None
+        assert records[0][1].getMap()['title'] == ['Statements']
+
+    def test_token(self, registry):
+        _, token = read_records_page(read_page('page1.xml'), 'oai_dc', registry)
+        assert token == 'page2'
+
+    def test_error(self, registry):
+        with pytest.raises(BadResumptionTokenError):
+            read_records_page(read_page('bad_token.xml'), 'oai_dc', registry)
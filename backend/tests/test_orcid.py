@@ -4,11 +4,20 @@
 import pytest
 import unittest
 
+from datetime import datetime
+from datetime import timedelta
+from itertools import islice
+from django.core.cache.backends.locmem import LocMemCache
+from mock import patch
+
 from backend.citeproc import CrossRef
 from backend.orcid import affiliate_author_with_orcid
 from backend.orcid import OrcidPaperSource
+from papers.models import IngestedOrcidWork
 from papers.models import Paper
 from papers.models import Researcher
+from papers.orcid import OrcidProfile
+from papers.orcid import OrcidWorkSummary
 from papers.tests.test_orcid import OrcidProfileStub
 
 
@@ -96,6 +105,60 @@ class TestOrcid():
         assert len(papers) == 1
         assert papers[0] is None
 
+    @pytest.mark.usefixtures('db', 'mock_pub_orcid')
+    def test_fetch_and_save_unchanged_profile(self, settings, monkeypatch):
+        """
+        The papers are not harvested again if the profile did not change since
+        """
+        settings.ORCID_PROFILE_CACHE_DURATION = timedelta(days=1)
+        monkeypatch.setattr('papers.orcid.cache', LocMemCache('orcid-profiles', {}))
+        orcid = '0000-0002-8612-8827'
+        profile = OrcidProfile(orcid_id=orcid, instance='orcid.org')
+        assert not profile.harvested
+        profile.mark_harvested()
+        researcher = Researcher.get_or_create_by_orcid(orcid, profile=profile)
+
+        def fetch_orcid_records(*args, **kwargs):
+            raise AssertionError('The profile must not be harvested')
+        monkeypatch.setattr(OrcidPaperSource, 'fetch_orcid_records', fetch_orcid_records)
+        OrcidPaperSource().fetch_and_save(researcher)
+
+    @pytest.mark.usefixtures('db', 'mock_pub_orcid')
+    def test_fetch_and_save_failed_doi_lookups(self, settings, monkeypatch):
+        """
+        The profile is not marked as harvested if some works were not found by DOI
+        """
+        settings.ORCID_PROFILE_CACHE_DURATION = timedelta(days=1)
+        monkeypatch.setattr('papers.orcid.cache', LocMemCache('orcid-profiles', {}))
+        orcid = '0000-0002-8612-8827'
+        profile = OrcidProfile(orcid_id=orcid, instance='orcid.org')
+        researcher = Researcher.get_or_create_by_orcid(orcid, profile=profile)
+
+        def fetch_orcid_records(self, *args, **kwargs):
+            self.failed_doi_lookups = 1
+            yield None
+        monkeypatch.setattr(OrcidPaperSource, 'fetch_orcid_records', fetch_orcid_records)
+        OrcidPaperSource().fetch_and_save(researcher, profile=profile)
+        assert not OrcidProfile(orcid_id=orcid, instance='orcid.org').harvested
+
+    @pytest.mark.usefixtures('db', 'mock_pub_orcid')
+    @pytest.mark.parametrize('max_results, harvested', [(None, True), (3, True), (2, False)])
+    def test_fetch_and_save_max_results(self, settings, monkeypatch, max_results, harvested):
+        """
+        The profile is marked as harvested only if all its papers were fetched
+        """
+        settings.ORCID_PROFILE_CACHE_DURATION = timedelta(days=1)
+        monkeypatch.setattr('papers.orcid.cache', LocMemCache('orcid-profiles', {}))
+        orcid = '0000-0002-8612-8827'
+        profile = OrcidProfile(orcid_id=orcid, instance='orcid.org')
+        researcher = Researcher.get_or_create_by_orcid(orcid, profile=profile)
+
+        def fetch_orcid_records(*args, **kwargs):
+            yield from [None, None, None]
+        monkeypatch.setattr(OrcidPaperSource, 'fetch_orcid_records', fetch_orcid_records)
+        OrcidPaperSource(max_results=max_results).fetch_and_save(researcher, profile=profile)
+        assert OrcidProfile(orcid_id=orcid, instance='orcid.org').harvested == harvested
+
 
 class OrcidUnitTest(unittest.TestCase):
 
@@ -127,6 +190,74 @@ class OrcidIntegrationTest(unittest.TestCase):
         self.assertTrue(len(papers) > 1)
         self.check_papers(papers)
 
+    @pytest.mark.usefixtures('mock_crossref', 'mock_doi')
+    def test_fetch_orcid_records_incremental(self):
+        profile = OrcidProfileStub('0000-0002-8612-8827', instance='orcid.org')
+        papers = list(self.source.fetch_orcid_records(self.researcher.orcid, profile=profile))
+        ingested = IngestedOrcidWork.objects.filter(researcher__orcid=self.researcher.orcid)
+        self.assertEqual(ingested.count(), len([p for p in papers if p is not None]))
+
+        # The works which did not change are not fetched again
+        profile = OrcidProfileStub('0000-0002-8612-8827', instance='orcid.org')
+        put_code = ingested.first().put_code
+        ingested.filter(put_code=put_code).update(last_modified=0)
+        papers = list(self.source.fetch_orcid_records(self.researcher.orcid, profile=profile))
+        self.assertEqual(len(papers), 1)
+
+    @pytest.mark.usefixtures('mock_crossref', 'mock_doi')
+    def test_fetch_orcid_records_stopped(self):
+        """
+        The works whose paper was yielded are remembered when we stop early
+        """
+        profile = OrcidProfileStub('0000-0002-8612-8827', instance='orcid.org')
+        records = self.source.fetch_orcid_records(self.researcher.orcid, profile=profile)
+        papers = list(islice(records, 2))
+        records.close()
+        ingested = IngestedOrcidWork.objects.filter(researcher__orcid=self.researcher.orcid)
+        self.assertEqual(ingested.count(), len([p for p in papers if p is not None]))
+
+    @pytest.mark.usefixtures('mock_crossref', 'mock_doi')
+    def test_fetch_orcid_records_deleted_paper(self):
+        """
+        The works whose paper was deleted are fetched again
+        """
+        profile = OrcidProfileStub('0000-0002-8612-8827', instance='orcid.org')
+        list(self.source.fetch_orcid_records(self.researcher.orcid, profile=profile))
+        ingested = IngestedOrcidWork.objects.filter(researcher__orcid=self.researcher.orcid)
+        paper = ingested.first().paper
+        deleted = ingested.filter(paper=paper).count()
+        paper.delete()
+        self.assertFalse(ingested.filter(paper=paper).exists())
+
+        profile = OrcidProfileStub('0000-0002-8612-8827', instance='orcid.org')
+        papers = list(self.source.fetch_orcid_records(self.researcher.orcid, profile=profile))
+        self.assertEqual(len(papers), deleted)
+
+    @pytest.mark.usefixtures('mock_crossref', 'mock_doi')
+    def test_fetch_orcid_records_crossref_failure(self):
+        """
+        The works which could not be fetched by DOI are fetched again
+        """
+        profile = OrcidProfileStub('0000-0002-8612-8827', instance='orcid.org')
+        doi_put_codes = {summary.put_code for summary in profile.work_summaries if summary.doi}
+        self.assertTrue(doi_put_codes)
+        ingested = IngestedOrcidWork.objects.filter(researcher__orcid=self.researcher.orcid)
+
+        # CrossRef cannot be reached: the papers are created from ORCID metadata
+        with patch.object(CrossRef, 'fetch_batch', lambda dois: [None] * len(dois)), \
+                patch.object(Paper, 'create_by_doi', lambda doi: None):
+            list(self.source.fetch_orcid_records(self.researcher.orcid, profile=profile))
+        self.assertEqual(self.source.failed_doi_lookups, len(doi_put_codes))
+        self.assertFalse(ingested.filter(put_code__in=doi_put_codes).exists())
+
+        # CrossRef is back: the works with a DOI are fetched from it
+        profile = OrcidProfileStub('0000-0002-8612-8827', instance='orcid.org')
+        papers = list(self.source.fetch_orcid_records(self.researcher.orcid, profile=profile))
+        found = ingested.filter(put_code__in=doi_put_codes).count()
+        self.assertEqual(found, len(doi_put_codes) - self.source.failed_doi_lookups)
+        self.assertTrue(found > 0)
+        self.assertTrue(len([p for p in papers if p is not None]) >= found)
+
     @pytest.mark.usefixtures('mock_doi')
     def check_papers(self, papers):
         p = Paper.objects.get(
@@ -231,3 +362,68 @@ class OrcidIntegrationTest(unittest.TestCase):
                 
 
 
+
+def synthetic_profile(count):
+    """
+    The profile of Antonin Delpeuch, with `count` synthetic works without DOI
+    """
+    profile = OrcidProfileStub('0000-0002-8612-8827', instance='orcid.org')
+    profile.__dict__['work_summaries'] = [
+        OrcidWorkSummary({'put-code': put_code, 'last-modified-date': {'value': 1}})
+        for put_code in range(count)]
+
+    def request_element(path):
+        return {'bulk': [{'work': {
+            'put-code': int(put_code),
+            'title': {'title': {'value': 'Synthetic work number {} on pregroup grammars'.format(put_code)}},
+            'publication-date': {'year': {'value': '2019'}},
+            'type': 'JOURNAL_ARTICLE',
+        }} for put_code in path[len('works/'):].split(',')]}
+    profile.request_element = request_element
+    return profile
+
+
+def harvest(profile, monkeypatch):
+    """
+    Harvests a profile, and returns the number of requests to update the search index
+    """
+    index_requests = []
+    bulk_update_index = Paper.bulk_update_index
+    monkeypatch.setattr(Paper, 'bulk_update_index',
+                        lambda papers: index_requests.append(len(papers)) or bulk_update_index(papers))
+    researcher = Researcher.get_or_create_by_orcid(profile.id, profile=profile)
+    OrcidPaperSource().fetch_and_save(researcher, profile=profile)
+    return index_requests
+
+
+@pytest.mark.django_db
+def test_fetch_and_save_index_batched(monkeypatch):
+    index_requests = harvest(synthetic_profile(30), monkeypatch)
+    assert index_requests == [30]
+
+
+@pytest.mark.django_db
+def test_fetch_and_save_researchers_saved(monkeypatch):
+    """
+    The researchers of the papers are saved in one request at the end of the harvest
+    """
+    harvest(synthetic_profile(5), monkeypatch)
+    researcher = Researcher.objects.get(orcid='0000-0002-8612-8827')
+    papers = Paper.objects.filter(title__startswith='Synthetic work number')
+    assert papers.count() == 5
+    for paper in papers:
+        assert researcher.pk in paper.researcher_ids
+
+
+@pytest.mark.benchmark
+@pytest.mark.django_db
+def test_fetch_and_save_throughput(monkeypatch):
+    """
+    Harvests a synthetic profile of 1000 works
+    """
+    count = 1000
+    start = datetime.now()
+    index_requests = harvest(synthetic_profile(count), monkeypatch)
+    elapsed = (datetime.now() - start).total_seconds()
+    assert Paper.objects.filter(title__startswith='Synthetic work number').count() == count
+    print('{} works: {:.0f} papers/s, {} index requests'.format(count, count / elapsed, len(index_requests)))
@@ -0,0 +1,135 @@
+import io
+import json
+import os
+import pytest
+import tarfile
+
+from django.conf import settings
+from django.db import IntegrityError
+
+from backend.orcid import OrcidPaperSource
+from backend.orcid_dump import OrcidDump
+from papers.errors import MetadataSourceException
+from papers.models import Researcher
+
+orcids = ['0000-0002-8612-8827', '0000-0003-0524-631X']
+
+
+@pytest.fixture
+def orcid_dump(tmpdir):
+    """
+    A data file with two profiles and an invalid one
+    """
+    path = str(tmpdir.join('summaries.tar.gz'))
+    with tarfile.open(path, 'w:gz') as tar:
+        for name in orcids[:1] + ['invalid'] + orcids[1:]:
+            if name == 'invalid':
+                content = json.dumps({'orcid-identifier': None}).encode('utf-8')
+            else:
+                with open(os.path.join(settings.BASE_DIR, 'papers', 'fixtures', 'orcid', name + '.json'), 'rb') as f:
+                    content = f.read()
+            member = tarfile.TarInfo('summaries/{}/{}.json'.format(name[-3:], name))
+            member.size = len(content)
+            tar.addfile(member, io.BytesIO(content))
+    return path
+
+
+@pytest.mark.usefixtures('db')
+def test_read_dump(orcid_dump):
+    dump = OrcidDump(fetch_papers=False)
+    dump.batch_size = 2
+    batches = list(dump.read_dump(orcid_dump))
+    assert [(name, len(contents)) for name, contents in batches] == [('summaries/lid/invalid.json', 2),
+                                                                      ('summaries/31X/0000-0003-0524-631X.json', 1)]
+    batches = list(dump.read_dump(orcid_dump, start_after='summaries/lid/invalid.json'))
+    assert [name for name, contents in batches] == ['summaries/31X/0000-0003-0524-631X.json']
+    with pytest.raises(ValueError):
+        list(dump.read_dump(orcid_dump, start_after='summaries/000/0000-0000-0000-0000.json'))
+
+
+@pytest.mark.usefixtures('db')
+def test_load_dump(orcid_dump, tmpdir):
+    checkpoint = str(tmpdir.join('checkpoint.json'))
+    OrcidDump(fetch_papers=False).load_dump(orcid_dump, checkpoint=checkpoint)
+    researchers = Researcher.objects.filter(orcid__in=orcids)
+    assert sorted(r.orcid for r in researchers) == orcids
+    assert Researcher.objects.get(orcid=orcids[0]).name.last == 'Delpeuch'
+    with open(checkpoint, 'r') as f:
+        assert json.load(f) == {'member': 'summaries/31X/0000-0003-0524-631X.json'}
+
+    # loading the profiles again updates the researchers
+    Researcher.objects.filter(orcid=orcids[0]).update(homepage='https://example.com/')
+    OrcidDump(fetch_papers=False).load_dump(orcid_dump)
+    assert Researcher.objects.filter(orcid__in=orcids).count() == 2
+    assert Researcher.objects.get(orcid=orcids[0]).homepage != 'https://example.com/'
+
+
+@pytest.mark.usefixtures('db')
+def test_parse_profiles_invalid():
+    contents = [b'not json', b'[1, 2]', b'"0000-0002-8612-8827"', b'{"orcid-identifier": []}']
+    assert OrcidDump(fetch_papers=False).parse_profiles(contents) == {}
+
+
+@pytest.mark.usefixtures('db')
+def test_load_dump_fetch_papers(orcid_dump, monkeypatch):
+    calls = []
+
+    def fetch_orcid_records(self, orcid, profile=None, use_doi=True, researcher=None):
+        calls.append((orcid, profile.id, researcher))
+        if orcid == orcids[0]:
+            raise MetadataSourceException('ORCID is down')
+        yield None
+    monkeypatch.setattr(OrcidPaperSource, 'fetch_orcid_records', fetch_orcid_records)
+
+    OrcidDump().load_dump(orcid_dump)
+    assert sorted(orcid for orcid, profile_id, researcher in calls) == orcids
+    for orcid, profile_id, researcher in calls:
+        # the researchers created in bulk are passed on, not looked up again
+        assert profile_id == orcid
+        assert researcher.pk is not None
+        assert researcher.orcid == orcid
+
+
+@pytest.mark.usefixtures('transactional_db')
+def test_load_dump_workers(orcid_dump, tmpdir):
+    checkpoint = str(tmpdir.join('checkpoint.json'))
+    dump = OrcidDump(workers=2, fetch_papers=False)
+    dump.batch_size = 1
+    dump.load_dump(orcid_dump, checkpoint=checkpoint)
+    assert sorted(Researcher.objects.filter(orcid__in=orcids).values_list('orcid', flat=True)) == orcids
+    with open(checkpoint, 'r') as f:
+        assert json.load(f) == {'member': 'summaries/31X/0000-0003-0524-631X.json'}
+
+
+@pytest.mark.usefixtures('db')
+def test_import_batch_in_worker_without_metrics():
+    dump = OrcidDump(fetch_papers=False)
+    assert dump.import_batch_in_worker(('summaries/lid/invalid.json', [b'not json'])) == 'summaries/lid/invalid.json'
+
+
+@pytest.mark.usefixtures('db')
+def test_load_dump_directory(orcid_dump, tmpdir):
+    directory = str(tmpdir.join('summaries'))
+    with tarfile.open(orcid_dump, 'r:gz') as tar:
+        tar.extractall(directory)
+    tmpdir.join('summaries', 'README').write('not a profile')
+    dump = OrcidDump(fetch_papers=False)
+    assert [name for name, f in dump.read_members(directory)] == [
+        'summaries/31X/0000-0003-0524-631X.json',
+        'summaries/827/0000-0002-8612-8827.json',
+        'summaries/lid/invalid.json',
+    ]
+    OrcidPaperSource().bulk_import(directory, fetch_papers=False)
+    assert sorted(Researcher.objects.filter(orcid__in=orcids).values_list('orcid', flat=True)) == orcids
+
+
+@pytest.mark.usefixtures('db')
+def test_import_batch_integrity_error(orcid_dump, monkeypatch):
+    def bulk_get_or_create_by_orcid(profiles):
+        raise IntegrityError('duplicate key value violates unique constraint')
+    monkeypatch.setattr(Researcher, 'bulk_get_or_create_by_orcid', bulk_get_or_create_by_orcid)
+
+    dump = OrcidDump(fetch_papers=False)
+    for batch in dump.read_dump(orcid_dump):
+        dump.import_batch(batch)
+    assert sorted(Researcher.objects.filter(orcid__in=orcids).values_list('orcid', flat=True)) == orcids
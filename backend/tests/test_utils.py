@@ -1,7 +1,13 @@
 from datetime import timedelta
 from time import sleep
 
+import pytest
+
+from backend.utils import parallel_map
+from backend.utils import prefetch
+from backend.utils import redis_semaphore
 from backend.utils import report_speed
+from backend.utils import run_only_once
 from backend.utils import utf8_truncate
 from backend.utils import with_speed_report
 
@@ -17,6 +23,114 @@ def test_report_speed():
     
     assert list(second_generator(20)) == list(range(20))
 
+def square(x):
+    if x == 13:
+        raise ValueError('unlucky')
+    return x * x
+
+class TestParallelMap:
+    """
+    Tests mapping in worker processes
+    """
+
+    def test_parallel_map_order(self):
+        assert list(parallel_map(square, range(12), 3, 4)) == [x * x for x in range(12)]
+
+    def test_parallel_map_empty(self):
+        assert list(parallel_map(square, [], 2, 4)) == []
+
+    def test_parallel_map_exception(self):
+        with pytest.raises(ValueError):
+            list(parallel_map(square, range(20), 2, 4))
+
+    def test_parallel_map_lookahead(self):
+        consumed = []
+        def items():
+            for x in range(100):
+                consumed.append(x)
+                yield x
+        results = parallel_map(square, items(), 2, 5)
+        assert next(results) == 0
+        sleep(0.5)
+        assert len(consumed) <= 6
+        results.close()
+
+class TestPrefetch:
+    """
+    Tests iterating in a background thread
+    """
+
+    def test_prefetch_order(self):
+        assert list(prefetch(range(50), 3)) == list(range(50))
+
+    def test_prefetch_empty(self):
+        assert list(prefetch([])) == []
+
+    def test_prefetch_exception(self):
+        with pytest.raises(ValueError):
+            list(prefetch(map(square, range(20))))
+
+    def test_prefetch_size(self):
+        consumed = []
+        def items():
+            for x in range(100):
+                consumed.append(x)
+                yield x
+        results = prefetch(items(), 2)
+        assert next(results) == 0
+        sleep(0.2)
+        # The item consumed, the items prefetched and the one waiting for a slot
+        assert len(consumed) <= 4
+        results.close()
+
+class TestRedisSemaphore:
+    """
+    Tests the semaphore shared through Redis
+    """
+
+    def test_limit(self):
+        semaphore = redis_semaphore('test-limit', 2)
+        tokens = [semaphore.acquire(blocking=False) for _ in range(3)]
+        assert None not in tokens[:2]
+        assert tokens[2] is None
+        semaphore.release(tokens[0])
+        token = semaphore.acquire(blocking=False)
+        assert token is not None
+        for token in [token, tokens[1]]:
+            semaphore.release(token)
+
+    def test_timeout(self):
+        semaphore = redis_semaphore('test-timeout', 1, timeout=0.1)
+        semaphore.acquire()
+        sleep(0.2)
+        token = semaphore.acquire(blocking=False)
+        assert token is not None
+        semaphore.release(token)
+
+    def test_slot(self):
+        semaphore = redis_semaphore('test-slot', 1)
+        with semaphore.slot():
+            assert semaphore.acquire(blocking=False) is None
+        token = semaphore.acquire(blocking=False)
+        assert token is not None
+        semaphore.release(token)
+
+    def test_without_redis(self, monkeypatch):
+        monkeypatch.setattr('backend.utils.get_redis_client', lambda: None)
+        semaphore = redis_semaphore('test-without-redis', 1)
+        tokens = [semaphore.acquire(blocking=False) for _ in range(2)]
+        assert None not in tokens
+        for token in tokens:
+            semaphore.release(token)
+
+def test_run_only_once_without_redis(monkeypatch):
+    monkeypatch.setattr('backend.utils.get_redis_client', lambda: None)
+
+    @run_only_once('test-without-redis')
+    def task():
+        return 'done'
+    assert task() == 'done'
+
 class TestUtf8Truncate:
     """
     Tests truncation by utf-8 length
@@ -48,6 +48,7 @@ class OaiTranslator(object):
         given OaiSource
         """
         self.oaisource = oaisource
+        self.extractor = REGISTERED_OAI_EXTRACTORS.get(oaisource.identifier, defaultExtractor)
 
     def format(self):
         """
@@ -120,7 +121,10 @@ class OAIDCTranslator(OaiTranslator):
             to a page where we think a human user can find the
             full text by themselves (and for free).
         """
-        extractor = REGISTERED_OAI_EXTRACTORS.get(source_identifier, defaultExtractor)
+        if source_identifier == self.oaisource.identifier:
+            extractor = self.extractor
+        else:
+            extractor = REGISTERED_OAI_EXTRACTORS.get(source_identifier, defaultExtractor)
         urls = extractor.extract(header, metadata)
         pdf_url = urls.get('pdf')
         splash_url = urls.get('splash')
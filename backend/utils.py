@@ -21,19 +21,44 @@
 
 
 from time import sleep
+from time import time
 
+import json
 import logging
+import os
 import requests
 import requests.exceptions
+import threading
+import uuid
+from contextlib import contextmanager
+from contextlib import nullcontext
 from datetime import datetime
 from datetime import timedelta
+from multiprocessing import Process
+from multiprocessing import Queue
+from queue import Empty
+from queue import SimpleQueue
 
-from dissemin.settings import redis_client
+from backend.instrumentation import IngestMetrics
+from backend.instrumentation import active_metrics
 from memoize import memoize
 
 
 logger = logging.getLogger('dissemin.' + __name__)
 
+
+def get_redis_client():
+    """
+    The Redis client configured in the settings, or None if the redis
+    package is not installed. Redis is not mandatory: without it, the
+    locks and semaphores below let everyone in.
+    """
+    try:
+        from dissemin.settings import redis_client
+    except ImportError:
+        return None
+    return redis_client
+
 # Run a task at most one at a time
 
 
@@ -48,6 +73,9 @@ class run_only_once(object):
         def inner(*args, **kwargs):
             lock_id = self.base_id+'-' + \
                 ('-'.join([str(kwargs.get(key, 'none')) for key in self.keys]))
+            redis_client = get_redis_client()
+            if redis_client is None:
+                return f(*args, **kwargs)
             lock = redis_client.lock(lock_id, timeout=self.timeout)
             have_lock = False
             result = None
@@ -62,6 +90,67 @@ class run_only_once(object):
         return inner
 
 
+class redis_semaphore(object):
+    """
+    A semaphore shared by all the processes using our Redis server,
+    letting at most `limit` holders in at the same time.
+
+    The holders are stored in a sorted set, scored by the time they
+    acquired the semaphore: a holder which did not release it after
+    `timeout` seconds (because its process died) loses its slot.
+    """
+
+    def __init__(self, name, limit, timeout=60*10):
+        self.key = 'semaphore-' + name
+        self.limit = limit
+        self.timeout = timeout
+
+    def acquire(self, blocking=True, poll_delay=1):
+        """
+        Takes a slot of the semaphore.
+
+        :param blocking: wait until a slot is free (otherwise, give up
+            straight away if there is none)
+        :returns: the token identifying the holder, to give to :meth:`release`,
+            or None if no slot could be taken
+        """
+        token = str(uuid.uuid4())
+        redis_client = get_redis_client()
+        if redis_client is None:
+            # without Redis, there is always a free slot
+            return token
+        while True:
+            now = time()
+            pipe = redis_client.pipeline()
+            pipe.zremrangebyscore(self.key, '-inf', now - self.timeout)
+            pipe.zadd(self.key, {token: now})
+            pipe.zrank(self.key, token)
+            _, _, rank = pipe.execute()
+            if rank < self.limit:
+                return token
+            redis_client.zrem(self.key, token)
+            if not blocking:
+                return None
+            sleep(poll_delay)
+
+    def release(self, token):
+        redis_client = get_redis_client()
+        if redis_client is not None:
+            redis_client.zrem(self.key, token)
+
+    @contextmanager
+    def slot(self):
+        """
+        Holds a slot of the semaphore during a with block, waiting
+        for one to be free if needed.
+        """
+        token = self.acquire()
+        try:
+            yield
+        finally:
+            self.release(token)
+
+
 # Open an URL with retries
 
 def request_retry(url, **kwargs):
@@ -114,6 +203,17 @@ def cached_urlopen_retry(*args, **kwargs):
     return urlopen_retry(*args, **kwargs)
 
 
+def write_json_atomically(path, data):
+    """
+    Writes data as JSON to a file, which is replaced at once so that
+    it is never left half-written (for instance by an interrupted ingest).
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
 def utf8_truncate(s, length=1024):
     """
     Truncates a string to given length when converted to utf8.
@@ -165,3 +265,142 @@ def report_speed(name=None, report_delay=timedelta(seconds=10)):
             return with_speed_report(func(*args, **kwargs), name=logging_name, report_delay=report_delay)
         return wrapped_generator
     return decorator
+
+
+def parallel_map(func, iterable, processes, lookahead, get_timeout=10):
+    """
+    Applies a function to the items of an iterable in worker processes,
+    and yields the results in the order of the iterable.
+
+    Unlike :meth:`multiprocessing.Pool.imap`, the iterable is consumed
+    lazily: at most `lookahead` items are read ahead of the consumer,
+    so that memory stays bounded even if the consumer is slower than
+    the workers.
+
+    The workers are forked, so `func` does not need to be picklable,
+    but the items and the results do. Exceptions raised by `func`
+    or by the iterable are raised by this generator.
+
+    :param processes: the number of worker processes
+    :param lookahead: the maximum number of items read but not consumed yet
+    :param get_timeout: the number of seconds after which we check that the
+        workers are still alive, when waiting for a result
+    """
+    tasks = Queue()
+    results = Queue()
+    slots = threading.Semaphore(lookahead)
+    stopped = threading.Event()
+
+    def work():
+        for idx, item in iter(tasks.get, None):
+            try:
+                results.put((idx, func(item), None))
+            except Exception as e:
+                results.put((idx, None, e))
+
+    def feed():
+        count = 0
+        error = None
+        try:
+            for item in iterable:
+                slots.acquire()
+                if stopped.is_set():
+                    break
+                tasks.put((count, item))
+                count += 1
+        except Exception as e:
+            error = e
+        results.put((None, count, error))
+
+    # The workers are started before the feeder thread, forking with
+    # running threads is unsafe
+    workers = [Process(target=work) for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+
+    pending = {}
+    next_idx = 0
+    total = None
+    feed_error = None
+    try:
+        while total is None or next_idx < total:
+            try:
+                idx, result, error = results.get(timeout=get_timeout)
+            except Empty:
+                if not all(worker.is_alive() for worker in workers):
+                    raise RuntimeError('A worker process died unexpectedly.')
+                continue
+            if idx is None:
+                total, feed_error = result, error
+                continue
+            pending[idx] = (result, error)
+            while next_idx in pending:
+                result, error = pending.pop(next_idx)
+                if error is not None:
+                    raise error
+                yield result
+                next_idx += 1
+                slots.release()
+        if feed_error is not None:
+            raise feed_error
+    finally:
+        stopped.set()
+        slots.release()
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+
+
+# Marks the end of the iterable in the queue of prefetch
+_end_of_iteration = object()
+
+
+def prefetch(iterable, size=1):
+    """
+    Iterates over an iterable in a background thread, so that the next
+    items are produced (for instance fetched from the network) while the
+    consumer processes the current one.
+
+    At most `size` items are produced ahead of the consumer, which
+    applies backpressure on a producer faster than the consumer.
+    Exceptions raised by the iterable are raised by this generator.
+
+    If ingest metrics are active, the stages of the iterable are recorded
+    in metrics of the same source, activated in the background thread.
+
+    :param size: the maximum number of items produced but not consumed yet
+    """
+    items = SimpleQueue()
+    slots = threading.Semaphore(size)
+    stopped = threading.Event()
+    metrics = active_metrics()
+
+    def produce():
+        try:
+            with IngestMetrics(metrics.source).activate() if metrics else nullcontext():
+                for item in iterable:
+                    slots.acquire()
+                    if stopped.is_set():
+                        return
+                    items.put((item, None))
+        except Exception as e:
+            items.put((None, e))
+        else:
+            items.put((_end_of_iteration, None))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is _end_of_iteration:
+                return
+            yield item
+            slots.release()
+    finally:
+        stopped.set()
+        slots.release()
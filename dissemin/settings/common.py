@@ -97,6 +97,13 @@ DOI_PROXY_SUPPORTS_BATCH = True
 #DOI_PROXY_SUPPORTS_BATCH = False
 
 DOI_OUTDATED_DURATION = timedelta(days=180)
+# Time during which a DOI that could not be resolved is not tried again (None to always try again)
+DOI_NEGATIVE_CACHE_DURATION = timedelta(days=7)
+# Size of the shared Bloom filter of the known DOIs, which saves the lookups of
+# unknown DOIs (None to disable it). It must be built with the rebuild_doi_filter
+# command, and takes 171 MiB in Redis for 150 million DOIs at 1% of false positives.
+DOI_FILTER_CAPACITY = 150000000
+DOI_FILTER_ERROR_RATE = 0.01
 # Endpoint to fetch DOI from
 DOI_RESOLVER_ENDPOINT= 'https://dx.doi.org/'
 
@@ -107,6 +114,14 @@ DOI_RESOLVER_ENDPOINT= 'https://dx.doi.org/'
 CROSSREF_MAILTO = 'dev@dissem.in'
 CROSSREF_USER_AGENT = 'Dissemin/0.1 (https://dissem.in/; mailto:dev@dissem.in)'
 
+### OAI-PMH harvesting ###
+# Maximum number of harvests running at the same time against
+# the same OAI-PMH endpoint (host)
+OAI_MAX_HARVESTS_PER_ENDPOINT = 1
+# Maximum number of harvests saving records to the database
+# at the same time
+OAI_MAX_DB_WRITERS = 4
+
 ### Paper deposits ###
 # Max size of the PDFs (in bytes)
 # 2.5MB - 2621440
@@ -122,6 +137,9 @@ URL_DEPOSIT_DOWNLOAD_TIMEOUT = 10
 # On login of an user, minimum time between the last harvest to trigger
 # a new harvest for that user.
 PROFILE_REFRESH_ON_LOGIN = timedelta(days=1)
+# Time during which the ORCID records are cached. The papers of a researcher are
+# not harvested again if their record did not change since. None to disable it.
+ORCID_PROFILE_CACHE_DURATION = timedelta(days=30)
 
 ### Application definition ###
 # You should not have to change anything in this section.
@@ -4,6 +4,13 @@ from dissemin.celery import app
 DEBUG_TOOLBAR_CONFIG = {'SHOW_TOOLBAR_CALLBACK': lambda r: False}
 app.conf.task_always_eager = True
 
+# Tests must not depend on the DOIs that failed resolution in previous runs
+DOI_NEGATIVE_CACHE_DURATION = None
+DOI_FILTER_CAPACITY = None
+
+# Tests must harvest the ORCID profiles every time
+ORCID_PROFILE_CACHE_DURATION = None
+
 # We delete the logger 'dissemin', so that it goes to root logger and gets catched by pytest caplog fixture
 try:
     del LOGGING['loggers']['dissemin']
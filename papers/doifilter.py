@@ -0,0 +1,264 @@
+# -*- encoding: utf-8 -*-
+
+# Dissemin: open access policy enforcement tool
+# Copyright (C) 2014 Antonin Delpeuch
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+
+"""
+Bloom filters of the DOIs known to Dissemin, which tell without querying
+the database that a DOI is *not* known (a DOI they contain may still be
+unknown, with a probability of `error_rate`).
+
+:class:`BloomFilter` is kept in memory, for an importer which builds it
+once and adds the DOIs it creates. :class:`RedisBloomFilter` is shared
+by all processes through Redis: :func:`shared_doi_filter` returns it, as
+configured by the DOI_FILTER_* settings. It is filled by
+:func:`rebuild_doi_filter` and kept up to date when records are saved,
+and contains every DOI only once it is fully built. A rebuild fills a
+new bitmap, which replaces the current one at the end.
+
+A filter of n DOIs with an error rate p takes -n ln(p) / ln(2)² bits:
+for 150 million DOIs and 1% of false positives, 171 MiB.
+"""
+
+import hashlib
+import logging
+import math
+
+from django.conf import settings
+
+from backend.utils import get_redis_client
+
+logger = logging.getLogger('dissemin.' + __name__)
+
+
+class BloomFilter(object):
+    """
+    A Bloom filter of strings, kept in memory
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        """
+        :param capacity: the number of strings the filter is sized for
+        :param error_rate: the probability that a string which was not
+            added is reported as contained, once `capacity` strings are added
+        """
+        self.configure(capacity, error_rate)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def configure(self, capacity, error_rate):
+        """
+        Computes the optimal number of bits and hash functions
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        #: number of bits of the filter
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        #: number of bits set for each string
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+
+    def positions(self, key):
+        """
+        The positions of the bits set for a string, by double hashing
+        """
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        self.add_many([key])
+
+    def add_many(self, keys):
+        for key in keys:
+            for position in self.positions(key):
+                self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return self.contains_many([key])[0]
+
+    def contains_many(self, keys):
+        """
+        :returns: for each string, False if it was certainly not added
+        """
+        return [all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+                for key in keys]
+
+
+class RedisBloomFilter(BloomFilter):
+    """
+    A Bloom filter of strings stored in a Redis bitmap, shared between
+    processes. Until it is marked as ready, it reports every string as
+    contained.
+
+    While it is rebuilt (between :meth:`start_rebuild` and
+    :meth:`finish_rebuild`), the strings added to it are also added to
+    the new bitmap, so that the new bitmap does not miss them.
+    """
+
+    #: Sets the bits of the filter, and of the new filter if it is being rebuilt
+    add_script = """
+        local rebuilding = redis.call('EXISTS', KEYS[2]) == 1
+        for _, position in ipairs(ARGV) do
+            redis.call('SETBIT', KEYS[1], position, 1)
+            if rebuilding then
+                redis.call('SETBIT', KEYS[3], position, 1)
+            end
+        end
+    """
+    #: Whether adding strings failed
+    add_failed = False
+
+    def __init__(self, key, capacity, error_rate=0.01, client=None):
+        """
+        :param key: the Redis key of the bitmap
+        :param client: the Redis client, by default the one of the settings
+        """
+        self.key = key
+        self.client = client or get_redis_client()
+        self.configure(capacity, error_rate)
+        if self.size > 2 ** 32:
+            raise ValueError('A Redis bitmap holds at most 2^32 bits')
+        self.add_bits = self.client.register_script(self.add_script)
+
+    def add_many(self, keys):
+        """
+        Adds strings to the filter. If this fails, the filter is marked as
+        not ready, as it would otherwise miss these strings, and so is the
+        new filter if it is being rebuilt.
+        """
+        positions = [position for key in keys for position in self.positions(key)]
+        if not positions:
+            return
+        try:
+            self.add_bits(keys=[self.key, self.key + ':rebuilding', self.key + ':new'], args=positions)
+        except Exception:
+            logger.exception('Could not add to the Bloom filter %s, it must be rebuilt', self.key)
+            self.add_failed = True
+            try:
+                self.client.delete(self.key + ':ready', self.key + ':rebuilding')
+            except Exception:
+                pass
+
+    def contains_many(self, keys):
+        """
+        :returns: for each string, False if it was certainly not added.
+            Everything is reported as contained if Redis cannot be reached.
+        """
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.exists(self.key + ':ready')
+            for key in keys:
+                for position in self.positions(key):
+                    pipe.getbit(self.key, position)
+            bits = pipe.execute()
+        except Exception:
+            logger.warning('Could not read the Bloom filter %s', self.key, exc_info=True)
+            return [True] * len(keys)
+        if not bits[0]:
+            return [True] * len(keys)
+        return [all(bits[1 + i * self.hashes:1 + (i + 1) * self.hashes]) for i in range(len(keys))]
+
+    def clear(self):
+        """
+        Empties the filter, which is not ready anymore
+        """
+        self.client.delete(self.key + ':ready', self.key, self.key + ':new', self.key + ':rebuilding')
+
+    def start_rebuild(self):
+        """
+        Starts building a new version of the filter: from now on, the
+        strings added to this filter are also added to the new one.
+
+        :returns: the new filter, to fill with all the strings
+        """
+        self.client.delete(self.key + ':new')
+        self.client.set(self.key + ':rebuilding', 1)
+        return RedisBloomFilter(self.key + ':new', self.capacity, self.error_rate, self.client)
+
+    def finish_rebuild(self):
+        """
+        Replaces the filter by the new one, and marks it as ready, unless
+        adding strings failed since :meth:`start_rebuild`.
+
+        :returns: whether the filter was replaced
+        """
+        marker = self.key + ':rebuilding'
+
+        def replace(pipe):
+            if not pipe.exists(marker):
+                return False
+            pipe.multi()
+            # the new filter does not exist if nothing was added to it
+            pipe.append(self.key + ':new', b'')
+            pipe.rename(self.key + ':new', self.key)
+            pipe.set(self.key + ':ready', 1)
+            pipe.delete(marker)
+            return True
+        return self.client.transaction(replace, marker, value_from_callable=True)
+
+    def abort_rebuild(self):
+        """
+        Drops the new filter started by :meth:`start_rebuild`
+        """
+        self.client.delete(self.key + ':rebuilding', self.key + ':new')
+
+    def mark_ready(self):
+        """
+        Marks that all the strings have been added
+        """
+        self.client.set(self.key + ':ready', 1)
+
+
+def shared_doi_filter():
+    """
+    The shared filter of the known DOIs, or None if it is disabled
+    """
+    if get_redis_client() is None or not settings.DOI_FILTER_CAPACITY:
+        return None
+    return RedisBloomFilter('known-dois', settings.DOI_FILTER_CAPACITY, settings.DOI_FILTER_ERROR_RATE)
+
+
+def rebuild_doi_filter(doi_filter, batch_size=10000):
+    """
+    Fills a filter with the DOIs of all the records in the database.
+    A shared filter is rebuilt in a new bitmap, which replaces it and
+    is marked as ready at the end: the DOIs saved meanwhile are added
+    to both bitmaps.
+    """
+    from papers.models import OaiRecord
+
+    shared_filter = None
+    if isinstance(doi_filter, RedisBloomFilter):
+        # this must happen before the records are read, so that the
+        # records saved after that are added to the new bitmap
+        shared_filter, doi_filter = doi_filter, doi_filter.start_rebuild()
+    dois = (OaiRecord.objects.exclude(doi__isnull=True).exclude(doi='')
+            .values_list('doi', flat=True).iterator(chunk_size=batch_size))
+    batch = []
+    for doi in dois:
+        batch.append(doi)
+        if len(batch) >= batch_size:
+            doi_filter.add_many(batch)
+            batch = []
+    doi_filter.add_many(batch)
+    if shared_filter is not None:
+        if doi_filter.add_failed:
+            shared_filter.abort_rebuild()
+        if doi_filter.add_failed or not shared_filter.finish_rebuild():
+            raise ValueError('Adding DOIs to {} failed during the rebuild, it must be rebuilt again'.format(
+                shared_filter.key))
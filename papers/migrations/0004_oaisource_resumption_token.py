@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('papers', '0003_institution_repository'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='oaisource',
+            name='last_datestamp',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='oaisource',
+            name='resumption_token',
+            field=models.CharField(blank=True, max_length=1024, null=True),
+        ),
+    ]
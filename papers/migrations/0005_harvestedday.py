@@ -0,0 +1,23 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('papers', '0004_oaisource_resumption_token'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HarvestedDay',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='papers.OaiSource')),
+            ],
+            options={
+                'unique_together': {('source', 'day')},
+            },
+        ),
+    ]
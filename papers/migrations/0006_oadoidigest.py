@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('papers', '0005_harvestedday'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OadoiDigest',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('doi', models.CharField(max_length=1024, unique=True)),
+                ('digest', models.CharField(max_length=32)),
+            ],
+        ),
+    ]
@@ -0,0 +1,24 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('papers', '0006_oadoidigest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestedOrcidWork',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('put_code', models.BigIntegerField()),
+                ('last_modified', models.BigIntegerField(null=True)),
+                ('researcher', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='papers.Researcher')),
+            ],
+            options={
+                'unique_together': {('researcher', 'put_code')},
+            },
+        ),
+    ]
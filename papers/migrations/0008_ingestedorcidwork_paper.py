@@ -0,0 +1,28 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def forget_ingested_works(apps, schema_editor):
+    """
+    The works ingested so far are not linked to their paper,
+    so they are fetched again at the next harvest
+    """
+    IngestedOrcidWork = apps.get_model('papers', 'IngestedOrcidWork')
+    IngestedOrcidWork.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('papers', '0007_ingestedorcidwork'),
+    ]
+
+    operations = [
+        migrations.RunPython(forget_ingested_works, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='ingestedorcidwork',
+            name='paper',
+            field=models.ForeignKey(default=None, on_delete=django.db.models.deletion.CASCADE, to='papers.Paper'),
+            preserve_default=False,
+        ),
+    ]
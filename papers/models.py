@@ -42,9 +42,11 @@ This module defines most of the models used in the platform.
 
 
 
+from contextlib import contextmanager
 from datetime import datetime
 from datetime import timedelta
 import re
+import threading
 import haystack
 import pytz
 import logging
@@ -70,12 +72,18 @@ from django.core.exceptions import ObjectDoesNotExist
 from django.urls import reverse
 from django.db import DataError
 from django.db import models
+from django.db import transaction
 from django.db.models import prefetch_related_objects
+from django.db.models.signals import post_save
 from django.template.defaultfilters import slugify
 from django.utils import timezone
 from django.utils.functional import cached_property
 from django.utils.translation import ugettext_lazy as _
 from django.utils.http import urlencode
+from backend.instrumentation import FINGERPRINT_LOOKUP
+from backend.instrumentation import INDEX_UPDATE
+from backend.instrumentation import OAIRECORD_DEDUP
+from backend.instrumentation import ingest_stage
 from papers.baremodels import BareAuthor
 from papers.baremodels import BareName
 from papers.baremodels import BareOaiRecord
@@ -84,6 +92,7 @@ from papers.baremodels import MAX_NAME_LENGTH
 from papers.baremodels import PAPER_TYPE_CHOICES
 from papers.baremodels import PAPER_TYPE_PREFERENCE
 from papers.doi import to_doi
+from papers.doifilter import shared_doi_filter
 from papers.errors import MetadataSourceException
 from papers.name import match_names
 from papers.name import unify_name_lists
@@ -98,6 +107,9 @@ from search import SearchQuerySet
 
 logger = logging.getLogger('dissemin.' + __name__)
 
+# Papers whose index update is deferred, in the current thread
+_deferred_index_updates = threading.local()
+
 UPLOAD_TYPE_CHOICES = [
    ('preprint', _('Preprint')),
    ('postprint', _('Postprint')),
@@ -500,6 +512,55 @@ class Researcher(models.Model):
 
         return researcher
 
+    @classmethod
+    def bulk_get_or_create_by_orcid(cls, profiles):
+        """
+        Same as :meth:`get_or_create_by_orcid` with `update=True`, for
+        many profiles: the researchers and their names are looked up with
+        one query each, and the new and modified ones are saved in bulk.
+        Each distinct institution is only looked up once.
+
+        :param profiles: a dict mapping ORCID ids to :class:`OrcidProfile` objects
+        :returns: a dict mapping ORCID ids to their :class:`Researcher`,
+            without the profiles with an invalid name
+        """
+        existing = {r.orcid: r for r in cls.objects.filter(orcid__in=list(profiles))}
+        researchers = {}
+        new_researchers = []
+        updated_researchers = []
+        fields = ['homepage', 'email', 'institution', 'name']
+        names = Name.bulk_lookup_names([profile.name for profile in profiles.values()])
+        institutions = {}
+        for orcid, profile in profiles.items():
+            name = names[profile.name]
+            if not name:
+                continue
+            homepage = profile.homepage
+            if homepage:
+                homepage = homepage[:1024]
+            institution = profile.institution
+            if institution:
+                key = (institution['name'].strip(), institution['country'].strip(),
+                       institution.get('identifier'))
+                if key not in institutions:
+                    institutions[key] = Institution.create(institution)
+                institution = institutions[key]
+            values = dict(zip(fields, [homepage, profile.email, institution, name]))
+
+            researcher = existing.get(orcid)
+            if researcher is None:
+                researcher = cls(orcid=orcid, **values)
+                new_researchers.append(researcher)
+            elif any(getattr(researcher, kw) != val for kw, val in values.items()):
+                for kw, val in values.items():
+                    setattr(researcher, kw, val)
+                updated_researchers.append(researcher)
+            researchers[orcid] = researcher
+
+        cls.objects.bulk_create(new_researchers)
+        cls.objects.bulk_update(updated_researchers, fields)
+        return researchers
+
     @classmethod
     def create_by_name(cls, first, last, **kwargs):
         """
@@ -647,6 +708,42 @@ class Name(models.Model, BareName):
         n, _ = cls.get_or_create(author_name[0], author_name[1])
         return n
 
+    @classmethod
+    def bulk_lookup_names(cls, author_names):
+        """
+        Same as :meth:`lookup_name` for many names, with one query to
+        look them up: the missing ones are created in bulk.
+
+        :param author_names: a list of (first,last) pairs
+        :returns: a dict mapping each pair to its :class:`Name`,
+            or to None if the pair is not a valid name
+        """
+        bare_names = {}
+        for first, last in set(author_names):
+            n = None
+            if first or last:
+                n = cls.create(first, last)
+                # same checks as in get_or_create
+                if (len(n.first or '') >= MAX_NAME_LENGTH-1 or
+                    len(n.last or '') >= MAX_NAME_LENGTH-1):
+                    n = None
+            bare_names[(first, last)] = n
+
+        new_names = {}
+        for n in bare_names.values():
+            if n is not None:
+                new_names.setdefault(n.full[:255], n)
+        names = {}
+        for name in cls.objects.filter(full__in=list(new_names)):
+            names.setdefault(name.full, name)
+        created = [cls(full=full, first=n.first, last=n.last)
+                   for full, n in new_names.items() if full not in names]
+        cls.objects.bulk_create(created)
+        names.update((name.full, name) for name in created)
+
+        return {author_name: names[n.full[:255]] if n is not None else None
+                for author_name, n in bare_names.items()}
+
     @classmethod
     def from_bare(cls, bare_obj):
         """
@@ -878,7 +975,8 @@ class Paper(models.Model, BarePaper):
         try:
             # Look up the fingerprint
             fp = paper.fingerprint
-            matches = Paper.find_by_fingerprint(fp)
+            with ingest_stage(FINGERPRINT_LOOKUP):
+                matches = list(Paper.find_by_fingerprint(fp))
 
             p = None
             if matches:  # We have found a paper matching the fingerprint
@@ -901,6 +999,87 @@ class Paper(models.Model, BarePaper):
             raise ValueError(
                 'Invalid paper, does not fit in the database schema:\n'+str(e))
 
+    @classmethod
+    def bulk_from_bare(cls, bare_papers):
+        """
+        Saves a list of bare papers to the database with a constant
+        number of queries, as long as they do not collide with existing
+        papers or records.
+
+        A bare paper collides when its fingerprint, the identifier of one
+        of its records or the DOI of one of its records is already known,
+        either in the database or earlier in the list. Such papers are
+        not saved: they need to go through :meth:`from_bare` so that
+        they get merged.
+
+        This should be run inside a transaction.
+
+        :param bare_papers: a list of :class:`BarePaper`
+        :returns: the list of the bare papers that collide
+        """
+        for bare_paper in bare_papers:
+            bare_paper.update_availability()
+            bare_paper.fingerprint = bare_paper.new_fingerprint()
+
+        bare_records = [r for p in bare_papers for r in p.oairecords]
+        with ingest_stage(FINGERPRINT_LOOKUP, len(bare_papers)):
+            known_fingerprints = set(Paper.objects.filter(
+                fingerprint__in=[p.fingerprint for p in bare_papers]
+                ).values_list('fingerprint', flat=True))
+        with ingest_stage(OAIRECORD_DEDUP, len(bare_records)):
+            known_identifiers = set(OaiRecord.objects.filter(
+                identifier__in=[r.identifier for r in bare_records]
+                ).values_list('identifier', flat=True))
+            known_dois = set(OaiRecord.objects.filter(
+                doi__in=[r.doi for r in bare_records if r.doi]
+                ).values_list('doi', flat=True))
+
+        new_papers = []
+        colliding = []
+        for bare_paper in bare_papers:
+            identifiers = [r.identifier for r in bare_paper.oairecords]
+            dois = [r.doi for r in bare_paper.oairecords if r.doi]
+            if (bare_paper.fingerprint in known_fingerprints or
+                known_identifiers.intersection(identifiers) or
+                known_dois.intersection(dois)):
+                colliding.append(bare_paper)
+            else:
+                new_papers.append(bare_paper)
+            known_fingerprints.add(bare_paper.fingerprint)
+            known_identifiers.update(identifiers)
+            known_dois.update(dois)
+
+        papers = []
+        for bare_paper in new_papers:
+            # Same as BarePaper.from_bare, without saving
+            paper = super(BarePaper, cls).from_bare(bare_paper)
+            for idx, a in enumerate(bare_paper.authors):
+                paper.add_author(a, position=idx)
+            papers.append(paper)
+
+        try:
+            cls.objects.bulk_create(papers)
+
+            records = []
+            for paper, bare_paper in zip(papers, new_papers):
+                for bare_record in bare_paper.oairecords:
+                    bare_record.cleanup_description()
+                    record = OaiRecord.from_bare(bare_record)
+                    record.about = paper
+                    record.priority = record.source.priority
+                    if record.pubtype is None:
+                        record.pubtype = record.source.default_pubtype
+                    records.append(record)
+            OaiRecord.objects.bulk_create(records)
+            doi_filter = shared_doi_filter()
+            if doi_filter is not None:
+                doi_filter.add_many([record.doi for record in records if record.doi])
+        except DataError as e:
+            raise ValueError(
+                'Invalid paper, does not fit in the database schema:\n'+str(e))
+
+        return colliding
+
     ### Other methods, specific to this non-bare subclass ###
 
     def update_author_stats(self):
@@ -1114,6 +1293,9 @@ class Paper(models.Model, BarePaper):
         doi = to_doi(doi)
         if doi is None:
             return None
+        doi_filter = shared_doi_filter()
+        if doi_filter is not None and doi not in doi_filter:
+            return None
         # there should not be more than one paper in this
         # queryset
         for record in OaiRecord.objects.filter(doi=doi)[:1]:
@@ -1315,6 +1497,9 @@ class Paper(models.Model, BarePaper):
         Remove this paper from Haystack's index
         (to be called before deleting the paper for real)
         """
+        deferred = getattr(_deferred_index_updates, 'papers', None)
+        if deferred is not None:
+            deferred.pop(self.pk, None)
         using_backends = haystack.connection_router.for_write(instance=self)
         for using in using_backends:
             try:
@@ -1326,17 +1511,69 @@ class Paper(models.Model, BarePaper):
 
     def update_index(self):
         """
-        Updates Haystack's index for this paper
+        Updates Haystack's index for this paper, or defers it to the
+        end of the enclosing :meth:`batch_index_updates` block
         """
+        deferred = getattr(_deferred_index_updates, 'papers', None)
+        if deferred is not None:
+            deferred[self.pk] = self
+            return
         using_backends = haystack.connection_router.for_write(instance=self)
         for using in using_backends:
             try:
                 index = haystack.connections[using].get_unified_index(
                                         ).get_index(Paper)
-                index.update_object(self, using=using)
+                with ingest_stage(INDEX_UPDATE):
+                    index.update_object(self, using=using)
+            except haystack.exceptions.NotHandled:
+                pass
+
+    @classmethod
+    def bulk_update_index(cls, papers):
+        """
+        Same as :meth:`update_index` for many papers, sent to the search
+        engine in one request
+        """
+        if not papers:
+            return
+        using_backends = haystack.connection_router.for_write()
+        for using in using_backends:
+            try:
+                engine = haystack.connections[using]
+                index = engine.get_unified_index().get_index(Paper)
+                with ingest_stage(INDEX_UPDATE, len(papers)):
+                    engine.get_backend().update(index, papers)
             except haystack.exceptions.NotHandled:
                 pass
 
+    @staticmethod
+    @contextmanager
+    def batch_index_updates():
+        """
+        Defers the index updates of the papers in the block, in the
+        current thread: they are sent in one request when the block is
+        left, once per paper. Nested blocks are part of the outermost one.
+        """
+        if getattr(_deferred_index_updates, 'papers', None) is not None:
+            yield
+            return
+        _deferred_index_updates.papers = {}
+        try:
+            yield
+        except BaseException:
+            papers = _deferred_index_updates.papers
+            _deferred_index_updates.papers = None
+            # The papers saved before the error are indexed all the same,
+            # but an indexing failure must not replace the original error
+            try:
+                Paper.bulk_update_index(list(papers.values()))
+            except Exception:
+                logger.exception('Could not update the index of %d papers', len(papers))
+            raise
+        papers = _deferred_index_updates.papers
+        _deferred_index_updates.papers = None
+        Paper.bulk_update_index(list(papers.values()))
+
 # Rough data extracted through OAI-PMH
 
 class OaiSourceManager(CachingManager):
@@ -1381,6 +1618,13 @@ class OaiSource(CachingMixin, models.Model):
     #: Last time we harvested this source.
     last_update = models.DateTimeField(default=datetime(1970,1,1,0,0,0,tzinfo=pytz.UTC))
 
+    #: Resumption token of the next page to fetch, if a harvest of this
+    #: source is in progress (or was interrupted).
+    resumption_token = models.CharField(max_length=1024, null=True, blank=True)
+
+    #: Latest datestamp of the records processed by the harvest in progress.
+    last_datestamp = models.DateTimeField(null=True, blank=True)
+
     def __str__(self):
         return self.name
 
@@ -1391,6 +1635,47 @@ class OaiSource(CachingMixin, models.Model):
         verbose_name = "OAI source"
 
 
+class HarvestedDay(models.Model):
+    """
+    A day whose records have been fetched from a source harvested one
+    day at a time (CrossRef), while a previous day is still being fetched:
+    the last_update of the source can only advance over contiguous days.
+    """
+    source = models.ForeignKey(OaiSource, on_delete=models.CASCADE)
+    day = models.DateField()
+
+    class Meta:
+        unique_together = ('source', 'day')
+
+
+class OadoiDigest(models.Model):
+    """
+    A digest of the OA locations of a DOI in the last oaDOI dump loaded,
+    so that the DOIs whose locations did not change are skipped when the
+    next dump is loaded.
+    """
+    doi = models.CharField(max_length=1024, unique=True)
+    digest = models.CharField(max_length=32)
+
+
+class IngestedOrcidWork(models.Model):
+    """
+    A work of the ORCID profile of a researcher, as it was when its paper
+    was last saved, so that only the new or modified works are fetched
+    when the profile is refreshed.
+    """
+    researcher = models.ForeignKey(Researcher, on_delete=models.CASCADE)
+    #: The paper saved for the work: the work is fetched again
+    #: if this paper is deleted or merged into another one
+    paper = models.ForeignKey(Paper, on_delete=models.CASCADE)
+    put_code = models.BigIntegerField()
+    #: The last-modified-date of the work summary, in milliseconds
+    last_modified = models.BigIntegerField(null=True)
+
+    class Meta:
+        unique_together = ('researcher', 'put_code')
+
+
 class OaiRecord(models.Model, BareOaiRecord):
     source = models.ForeignKey(OaiSource, on_delete=models.CASCADE)
     about = models.ForeignKey(Paper, on_delete=models.CASCADE)
@@ -1465,24 +1750,25 @@ class OaiRecord(models.Model, BareOaiRecord):
         # created? If so, we should not search for duplicate records in
         # the paper itself.
         match = None
-        if not about.just_created:
-            # Search for duplicate records
-            match = OaiRecord.find_duplicate_records(
-                    about,
-                    splash_url,
-                    pdf_url)
-
-        # We check that there are not already too many records in this
-        # paper
-        if about.cached_oairecords and len(about.cached_oairecords) >= MAX_OAIRECORDS_PER_PAPER:
-            raise ValueError('Too many records in paper %d' % about.pk)
-
-        # We don't search for records with the same identifier yet,
-        # we will rather catch the exception thrown by the DB
-        if not match:
-            same_identifier = OaiRecord.objects.filter(identifier=identifier)
-            if same_identifier:
-                match = same_identifier[0]
+        with ingest_stage(OAIRECORD_DEDUP):
+            if not about.just_created:
+                # Search for duplicate records
+                match = OaiRecord.find_duplicate_records(
+                        about,
+                        splash_url,
+                        pdf_url)
+
+            # We check that there are not already too many records in this
+            # paper
+            if about.cached_oairecords and len(about.cached_oairecords) >= MAX_OAIRECORDS_PER_PAPER:
+                raise ValueError('Too many records in paper %d' % about.pk)
+
+            # We don't search for records with the same identifier yet,
+            # we will rather catch the exception thrown by the DB
+            if not match:
+                same_identifier = OaiRecord.objects.filter(identifier=identifier)
+                if same_identifier:
+                    match = same_identifier[0]
 
         if not match:
             # Otherwise create a new record
@@ -1619,6 +1905,43 @@ class OaiRecord(models.Model, BareOaiRecord):
         verbose_name = "OAI record"
 
 
+#: DOIs of the records saved by the current thread, not added to the
+#: shared filter yet
+_pending_doi_filter_adds = threading.local()
+
+
+def add_to_doi_filter(sender, instance, **kwargs):
+    """
+    Keeps the shared filter of the known DOIs up to date: the DOIs saved
+    in a transaction are added together when it is committed.
+    """
+    if not instance.doi:
+        return
+    pending = getattr(_pending_doi_filter_adds, 'dois', None)
+    if pending is None:
+        pending = _pending_doi_filter_adds.dois = set()
+    pending.add(instance.doi)
+    transaction.on_commit(flush_doi_filter_adds)
+
+
+def flush_doi_filter_adds():
+    """
+    Adds the pending DOIs to the shared filter. The callbacks of the other
+    records of a transaction find nothing left to add. The DOIs of records
+    rolled back are added at the next commit, which only adds false positives.
+    """
+    dois = getattr(_pending_doi_filter_adds, 'dois', None)
+    if not dois:
+        return
+    _pending_doi_filter_adds.dois = None
+    doi_filter = shared_doi_filter()
+    if doi_filter is not None:
+        doi_filter.add_many(sorted(dois))
+
+
+post_save.connect(add_to_doi_filter, sender=OaiRecord)
+
+
 def create_default_stats():
     return AccessStatistics.objects.create().pk
 
@@ -22,7 +22,11 @@
 import logging
 import requests
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from django.conf import settings
+from django.core.cache import cache
 from django.utils.functional import cached_property
 from papers.errors import MetadataSourceException
 from papers.name import normalize_name_words
@@ -94,6 +98,11 @@ class OrcidProfile(object):
     An orcid profile as returned by the ORCID public API (in JSON)
     """
 
+    #: Number of works fetched by each request of :meth:`fetch_works`
+    works_batch_size = 25
+    #: Number of requests of :meth:`fetch_works` made concurrently
+    works_workers = 4
+
     def __init__(self, orcid_id=None, json=None, instance=settings.ORCID_BASE_DOMAIN):
         """
         Create a profile by ORCID ID or by providing directly the parsed JSON payload.
@@ -101,6 +110,9 @@ class OrcidProfile(object):
         self.json = json
         self.id = orcid_id
         self.instance = instance
+        #: Whether the papers of this profile were harvested since it last
+        #: changed (see :meth:`mark_harvested`)
+        self.harvested = False
         if self.instance not in ['orcid.org', 'sandbox.orcid.org']:
             raise ValueError('Unexpected instance')
 
@@ -129,13 +141,73 @@ class OrcidProfile(object):
         """
         return 'https://pub.{instance}/v2.1/{orcid}/'.format(instance=self.instance, orcid=self.id)
 
+    @cached_property
+    def session(self):
+        """
+        The session of the requests to the API, which keeps the
+        connections open for the concurrent requests of :meth:`fetch_works`
+        """
+        session = requests.Session()
+        session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=self.works_workers))
+        return session
+
     def request_element(self, path):
         """
         Returns the base URL of the profile on the API
         """
         headers = {'Accept': 'application/orcid+json'}
         url = self.api_uri + path
-        return requests.get(url, headers=headers).json()
+        return self.session.get(url, headers=headers).json()
+
+    @property
+    def cache_key(self):
+        return 'orcid-profile:{instance}:{orcid}'.format(instance=self.instance, orcid=self.id)
+
+    @property
+    def last_modified(self):
+        """
+        The date of the last modification of the record, in milliseconds
+        """
+        return jpath('history/last-modified-date/value', self.json)
+
+    def request_record(self):
+        """
+        Requests the record of the profile. The previous response is cached,
+        and returned if the server replies that the record is unchanged.
+
+        :returns: the parsed record and the cached entry of the previous one
+        """
+        entry = cache.get(self.cache_key) if settings.ORCID_PROFILE_CACHE_DURATION else None
+        headers = {'Accept': 'application/orcid+json'}
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['http_last_modified']:
+                headers['If-Modified-Since'] = entry['http_last_modified']
+        response = self.session.get(self.api_uri, headers=headers)
+        if response.status_code == 304 and entry is not None:
+            return entry['json'], entry
+        parsed = response.json()
+        if settings.ORCID_PROFILE_CACHE_DURATION and parsed.get('orcid-identifier') is not None:
+            cache.set(self.cache_key, {
+                    'json': parsed,
+                    'etag': response.headers.get('ETag'),
+                    'http_last_modified': response.headers.get('Last-Modified'),
+                    'harvested': entry['harvested'] if entry is not None else None,
+                }, settings.ORCID_PROFILE_CACHE_DURATION.total_seconds())
+        return parsed, entry
+
+    def mark_harvested(self):
+        """
+        Remembers that the papers of this version of the profile were harvested,
+        so that the next :meth:`fetch` of the same version sets :attr:`harvested`
+        """
+        if not settings.ORCID_PROFILE_CACHE_DURATION or self.last_modified is None:
+            return
+        entry = cache.get(self.cache_key)
+        if entry is not None:
+            entry['harvested'] = self.last_modified
+            cache.set(self.cache_key, entry, settings.ORCID_PROFILE_CACHE_DURATION.total_seconds())
 
     def fetch(self):
         """
@@ -143,7 +215,7 @@ class OrcidProfile(object):
         This only fetches the summaries, subsequent requests will be made for works.
         """
         try:
-            parsed = self.request_element('')
+            parsed, entry = self.request_record()
             if parsed.get('orcid-identifier') is None:
                 # TEMPORARY: also check from the sandbox
                 if self.instance == 'orcid.org':
@@ -151,6 +223,8 @@ class OrcidProfile(object):
                     return self.fetch()
                 raise ValueError
             self.json = parsed
+            self.harvested = (entry is not None and self.last_modified is not None and
+                              entry['harvested'] == self.last_modified)
         except (requests.exceptions.HTTPError, ValueError):
             raise MetadataSourceException(
                 'The ORCiD {id} could not be found from {instance}'.format(id=self.id, instance=self.instance))
@@ -166,7 +240,8 @@ class OrcidProfile(object):
         return list(self._work_summaries_generator())
 
     def _work_summaries_generator(self):
-        works_summary = self.request_element('works')
+        # The records of the public data files include the summaries
+        works_summary = jpath('activities-summary/works', self.json) or self.request_element('works')
         for group in works_summary.get('group') or []:
             for summary in group.get('work-summary') or []:
                 yield OrcidWorkSummary(summary)
@@ -261,16 +336,28 @@ class OrcidProfile(object):
     def fetch_works(self, put_codes):
         """
         Retrieves the full metadata of the given works in this profile.
-        """
-        batch_size = 25
-        # TODO
-        i = 0
-        while i < len(put_codes):
-            batch = put_codes[i:(i+batch_size)]
-            i += batch_size
-            works_meta = self.request_element('works/'+','.join([str(c) for c in batch]))
-            for work in works_meta.get('bulk') or []:
-                yield OrcidWork(self, work)
+        The batches of works are requested concurrently, at most
+        :attr:`works_workers` ahead of the consumer, and the works are
+        yielded in the order of the put codes. If the consumer stops
+        early, the batches not requested yet are cancelled.
+        """
+        batch_size = self.works_batch_size
+        paths = iter(['works/'+','.join([str(c) for c in put_codes[i:(i+batch_size)]])
+                      for i in range(0, len(put_codes), batch_size)])
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.works_workers) as executor:
+            try:
+                while True:
+                    for path in islice(paths, self.works_workers - len(pending)):
+                        pending.append(executor.submit(self.request_element, path))
+                    if not pending:
+                        break
+                    works_meta = pending.popleft().result()
+                    for work in works_meta.get('bulk') or []:
+                        yield OrcidWork(self, work)
+            finally:
+                for future in pending:
+                    future.cancel()
 
 
 class OrcidWorkSummary(object):
@@ -310,6 +397,13 @@ class OrcidWorkSummary(object):
     def put_code(self):
         return self.json.get('put-code')
 
+    @property
+    def last_modified(self):
+        """
+        The date of the last modification of this work, in milliseconds
+        """
+        return jpath('last-modified-date/value', self.json)
+
     def __str__(self):
         return self.title or '(no title)'
 
@@ -0,0 +1,130 @@
+import pytest
+import uuid
+
+from datetime import datetime
+from django.db import transaction
+
+from dissemin.settings import redis_client
+from papers.doifilter import BloomFilter
+from papers.doifilter import RedisBloomFilter
+from papers.doifilter import rebuild_doi_filter
+from papers.models import OaiRecord
+from papers.models import Paper
+from papers.models import add_to_doi_filter
+
+
+def synthetic_dois(prefix, count):
+    return ['10.{}/{}'.format(prefix, i) for i in range(count)]
+
+
+class TestBloomFilter:
+
+    def test_configure(self):
+        doi_filter = BloomFilter(1000000, 0.01)
+        assert doi_filter.hashes == 7
+        assert 9500000 < doi_filter.size < 9600000
+
+    def test_contains(self):
+        doi_filter = BloomFilter(1000)
+        dois = synthetic_dois(1234, 1000)
+        doi_filter.add_many(dois)
+        doi_filter.add('10.1145/1721837.1721839')
+        assert all(doi_filter.contains_many(dois))
+        assert '10.1145/1721837.1721839' in doi_filter
+
+    def test_error_rate(self):
+        doi_filter = BloomFilter(10000, 0.01)
+        doi_filter.add_many(synthetic_dois(1234, 10000))
+        false_positives = sum(doi_filter.contains_many(synthetic_dois(5678, 10000)))
+        assert false_positives < 200
+
+
+class TestRedisBloomFilter:
+
+    @pytest.fixture
+    def doi_filter(self):
+        key = 'test-known-dois-' + uuid.uuid4().hex
+        yield RedisBloomFilter(key, 1000)
+        redis_client.delete(key, key + ':ready', key + ':new', key + ':rebuilding')
+
+    def test_not_ready(self, doi_filter):
+        assert '10.1145/1721837.1721839' in doi_filter
+
+    def test_contains(self, doi_filter):
+        doi_filter.add_many(synthetic_dois(1234, 100))
+        doi_filter.mark_ready()
+        assert all(doi_filter.contains_many(synthetic_dois(1234, 100)))
+        assert sum(doi_filter.contains_many(synthetic_dois(5678, 100))) < 10
+        doi_filter.clear()
+        assert '10.5678/1' in doi_filter
+
+    @pytest.mark.usefixtures('db')
+    def test_rebuild(self, doi_filter, book_god_of_the_labyrinth):
+        rebuild_doi_filter(doi_filter)
+        dois = list(OaiRecord.objects.filter(doi__isnull=False).values_list('doi', flat=True))
+        assert all(doi_filter.contains_many(dois))
+        assert sum(doi_filter.contains_many(synthetic_dois(5678, 100))) < 10
+
+    def test_add_while_rebuilding(self, doi_filter):
+        """
+        The strings added while the filter is rebuilt are kept in the new filter
+        """
+        doi_filter.add_many(synthetic_dois(5678, 100))
+        doi_filter.mark_ready()
+        new_filter = doi_filter.start_rebuild()
+        assert all(doi_filter.contains_many(synthetic_dois(5678, 100)))
+        new_filter.add_many(synthetic_dois(1234, 50))
+        doi_filter.add('10.1145/1721837.1721839')
+        assert doi_filter.finish_rebuild()
+        assert all(doi_filter.contains_many(synthetic_dois(1234, 50) + ['10.1145/1721837.1721839']))
+        assert sum(doi_filter.contains_many(synthetic_dois(5678, 100))) < 10
+
+    def test_rebuild_failed_add(self, doi_filter):
+        doi_filter.start_rebuild()
+        doi_filter.client.delete(doi_filter.key + ':rebuilding')
+        assert not doi_filter.finish_rebuild()
+        assert '10.5678/1' in doi_filter
+
+    def test_too_large(self):
+        with pytest.raises(ValueError):
+            RedisBloomFilter('test-known-dois', 10 ** 9, 0.001)
+
+
+@pytest.mark.usefixtures('db')
+def test_get_by_doi_unknown(monkeypatch, django_assert_num_queries):
+    doi_filter = BloomFilter(1000)
+    monkeypatch.setattr('papers.models.shared_doi_filter', lambda: doi_filter)
+    with django_assert_num_queries(0):
+        assert Paper.get_by_doi('10.1145/1721837.1721839') is None
+
+
+@pytest.mark.usefixtures('transactional_db')
+def test_add_to_doi_filter_on_commit(monkeypatch):
+    """
+    The DOIs of the records saved in a transaction are added together once it is committed
+    """
+    added = []
+    doi_filter = BloomFilter(1000)
+    monkeypatch.setattr(doi_filter, 'add_many', lambda dois: added.append(list(dois)))
+    monkeypatch.setattr('papers.models.shared_doi_filter', lambda: doi_filter)
+    dois = synthetic_dois(1234, 3)
+    with transaction.atomic():
+        for doi in dois:
+            add_to_doi_filter(OaiRecord, OaiRecord(doi=doi))
+        assert added == []
+    assert added == [sorted(dois)]
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize('capacity', [100000, 1000000])
+def test_error_rate_and_size(capacity):
+    """
+    Measures the false positive rate and the memory of a full filter
+    """
+    doi_filter = BloomFilter(capacity, 0.01)
+    start = datetime.now()
+    doi_filter.add_many(synthetic_dois(1234, capacity))
+    elapsed = (datetime.now() - start).total_seconds()
+    false_positives = sum(doi_filter.contains_many(synthetic_dois(5678, capacity)))
+    print('capacity={}: {:.2%} false positives, {:.1f} MiB, {:.0f} DOIs/s'.format(
+        capacity, false_positives / capacity, doi_filter.size / 8 / 2 ** 20, capacity / elapsed))
@@ -37,6 +37,7 @@ import papers.doi
 
 from oaipmh.client import Client
 from papers.baremodels import BareName
+from papers.baremodels import MAX_NAME_LENGTH
 from papers.models import Name
 from papers.models import OaiRecord
 from papers.models import OaiSource
@@ -111,6 +112,34 @@ class TestPaper():
         assert p is None
 
 
+    def test_batch_index_updates(self, monkeypatch):
+        """
+        The papers are indexed in one request at the end of the block
+        """
+        requests = []
+        monkeypatch.setattr(Paper, 'bulk_update_index', lambda papers: requests.append(papers))
+        paper = Paper(pk=1)
+        with Paper.batch_index_updates():
+            paper.update_index()
+            paper.update_index()
+            assert requests == []
+        assert requests == [[paper]]
+
+    def test_batch_index_updates_error(self, monkeypatch):
+        """
+        An indexing failure does not replace the error raised in the block
+        """
+        def bulk_update_index(papers):
+            raise RuntimeError('index unavailable')
+        monkeypatch.setattr(Paper, 'bulk_update_index', bulk_update_index)
+        with pytest.raises(ValueError):
+            with Paper.batch_index_updates():
+                Paper(pk=1).update_index()
+                raise ValueError('harvest failed')
+        with pytest.raises(RuntimeError):
+            with Paper.batch_index_updates():
+                Paper(pk=1).update_index()
+
     @pytest.mark.parametrize('on_list', [True, False])
     def test_on_todolist(self, book_god_of_the_labyrinth, user_isaac_newton, on_list):
         if on_list:
@@ -400,6 +429,16 @@ Temperature & Pressure Calibrator Models are Certified by DNV. Nagman
 also""", "Nagman")),
             None)
 
+    def test_bulk_lookup_names(self):
+        existing = Name.lookup_name(('Jean', 'Saisrien'))
+        names = Name.bulk_lookup_names([('Jean', 'Saisrien'), ('Marie', 'Curie'),
+                                        ('Marie', 'Curie'), ('', ''), ('A'*MAX_NAME_LENGTH, 'B')])
+        self.assertEqual(names[('Jean', 'Saisrien')], existing)
+        self.assertEqual(names[('Marie', 'Curie')], Name.lookup_name(('Marie', 'Curie')))
+        self.assertEqual(names[('', '')], None)
+        self.assertEqual(names[('A'*MAX_NAME_LENGTH, 'B')], None)
+        self.assertEqual(Name.objects.filter(full='marie curie').count(), 1)
+
 class OaiRecordTest(django.test.TestCase):
 
     @classmethod
@@ -25,6 +25,7 @@ import unittest
 import json
 import requests
 import os
+import time
 
 from papers.orcid import OrcidProfile
 from papers.orcid import OrcidWorkSummary
@@ -283,6 +284,45 @@ class OrcidProfileTest(unittest.TestCase):
         pubtypes = [work.pubtype for work in works]
         self.assertTrue('journal-article' in pubtypes)
 
+    def test_works_order(self):
+        """
+        The works are yielded in the order of the put codes,
+        even if the batches are not fetched in that order
+        """
+        profile = self.loadProfile(id='0000-0002-8612-8827')
+        profile.works_batch_size = 2
+
+        def request_element(path):
+            put_codes = [int(c) for c in path[len('works/'):].split(',')]
+            time.sleep(0.01 * (10 - put_codes[0]))
+            return {'bulk': [{'work': {'put-code': c, 'title': {'title': {'value': str(c)}}}} for c in put_codes]}
+
+        profile.request_element = request_element
+        works = list(profile.fetch_works(list(range(10))))
+        self.assertEqual([work.put_code for work in works], list(range(10)))
+
+    def test_works_early_stop(self):
+        """
+        The batches are requested at most works_workers ahead of the
+        consumer, and no more once it stops
+        """
+        profile = self.loadProfile(id='0000-0002-8612-8827')
+        profile.works_batch_size = 1
+        profile.works_workers = 2
+        requested = []
+
+        def request_element(path):
+            put_code = int(path[len('works/'):])
+            requested.append(put_code)
+            return {'bulk': [{'work': {'put-code': put_code, 'title': {'title': {'value': str(put_code)}}}}]}
+
+        profile.request_element = request_element
+        works = profile.fetch_works(list(range(10)))
+        self.assertEqual(next(works).put_code, 0)
+        works.close()
+        # the second batch may have been cancelled before it was requested
+        self.assertTrue(set(requested) <= {0, 1})
+
 
 class OrcidWorkTest(unittest.TestCase):
     @classmethod